@@ -14,11 +14,25 @@
 # python imports
 
 from maxcul._communication import MaxConnection
+from maxcul._aio import AsyncMaxConnection
+from maxcul._registry import DeviceRegistry, DeviceState
+from maxcul._links import LinkMonitor, LinkHistory
+from maxcul._timeseries import TimeSeriesStore, Readings
+from maxcul._sharedstate import SharedStateTable
+from maxcul._archive import CaptureWriter, CaptureArchive, CapturedFrame
+from maxcul._demand import (
+    HeatingDemand, DEMAND_MAX, DEMAND_MEAN, DEMAND_ABOVE)
+from maxcul._metrics import MetricsRegistry
+from maxcul._tracing import Tracer, FrameTrace
 from maxcul._const import (
     # Events
     EVENT_DEVICE_PAIRED,
     EVENT_DEVICE_REPAIRED,
     EVENT_THERMOSTAT_UPDATE,
+    EVENT_WALL_THERMOSTAT_UPDATE,
+    EVENT_SHUTTER_CONTACT_UPDATE,
+    EVENT_PUSH_BUTTON_UPDATE,
+    EVENT_COMMAND_DROPPED,
     # Thermostat modes
     MODE_AUTO, MODE_BOOST, MODE_MANUAL, MODE_TEMPORARY,
     # Temperature constants
@@ -29,12 +43,29 @@ from maxcul._const import (
     ATTR_MEASURED_TEMPERATURE,
     ATTR_MODE,
     ATTR_BATTERY_LOW,
+    ATTR_VALVE_POSITION,
+    ATTR_STATE,
+    ATTR_CHANGES,
+    ATTR_COMMAND,
+    ATTR_REASON,
+    # Reasons for dropped commands
+    REASON_EXPIRED, REASON_SUPERSEDED, REASON_NOT_ACKNOWLEDGED,
+    REASON_SEND_FAILED,
+    # Command priorities
+    PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH,
+    # Stages of traced frames
+    DIRECTION_RECEIVE, DIRECTION_TRANSMIT,
+    STAGE_READ, STAGE_FRAMED, STAGE_ENQUEUED, STAGE_DEQUEUED, STAGE_DECODED,
+    STAGE_CALLBACK, STAGE_HANDLED,
+    STAGE_CREATED, STAGE_ENCODED, STAGE_QUEUED, STAGE_WRITTEN,
+    STAGE_ACKNOWLEDGED,
 )
 from maxcul._exceptions import (
     MoritzError,
     UnknownMessageError,
     LengthNotMatchingError,
-    MissingPayloadParameterError)
+    MissingPayloadParameterError,
+    CommunicationError)
 
 # environment imports
 
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.__main__
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Runs the daemon sharing a CUL stick, see maxcul.daemon.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from maxcul._daemon import main
+
+main()
@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.aio
+    ~~~~~~~~~~~~~~~~~~
+
+    asyncio front end for the moritz protocol. AsyncCulIo talks to the CUL
+    stick from within the event loop, either through a serial device or
+    through a TCP connection given as socket://host:port. AsyncMaxConnection
+    shares its protocol logic with MaxConnection but needs no threads, so any
+    number of sticks can be driven from a single event loop.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import asyncio
+from collections import deque
+
+# environment imports
+import logging
+from serial import Serial, SerialException
+
+# custom imports
+from maxcul._exceptions import CommunicationError
+from maxcul._io import (
+    MAX_QUEUED_COMMANDS, COMMAND_REQUEST_BUDGET, MIN_REQUIRED_BUDGET,
+    INIT_COMMANDS, SEND_COMMANDS, parse_budget
+)
+from maxcul._protocol import MaxProtocol, DEFAULT_CUBE_ID
+from maxcul._dispatch import DEFAULT_MAX_QUEUED_EVENTS
+from maxcul._const import PRIORITY_NORMAL, STAGE_WRITTEN
+from maxcul._communication import DEFAULT_DEVICE, DEFAULT_BAUDRATE
+
+# local constants
+LOGGER = logging.getLogger(__name__)
+
+TCP_PREFIX = 'socket://'
+
+VERSION_TIMEOUT = 1
+BUDGET_TIMEOUT = 1
+RESEND_CHECK_INTERVAL = 0.3
+RECONNECT_DELAYS = (5, 10, 20, 40)
+
+DEFAULT_EVENT_QUEUE_SIZE = 100
+
+CONNECTION_LOST = "Connection to CUL was lost, cannot communicate"
+
+
+class AsyncCulIo(object):
+    """Low-level CUL communication driven by the running event loop"""
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, device_path, baudrate, line_callback, lost_callback=None):
+        self._device_path = device_path
+        self._baudrate = baudrate
+        self._line_callback = line_callback
+        self._lost_callback = lost_callback
+        self._send_queue = deque([], MAX_QUEUED_COMMANDS)
+        self._cul_version = None
+        self._com_port = None
+        self._reader = None
+        self._writer = None
+        self._remaining_budget = 0
+        self._budget_received = None
+        self._send_wakeup = None
+        self._connected = None
+        self._closing = False
+        self._tasks = []
+
+    @property
+    def cul_version(self):
+        """Returns the version reported from the CUL stick"""
+        return self._cul_version
+
+    @property
+    def has_send_budget(self):
+        """Ask CUL if we have enough budget of the 1 percent rule left"""
+        return self._remaining_budget >= 2000
+
+    @property
+    def pending_commands(self):
+        """Number of commands waiting to be sent"""
+        return len(self._send_queue)
+
+    @property
+    def is_connected(self):
+        """True while the connection to the CUL stick is up"""
+        return bool(self._tasks) and self._connected.is_set() and not any(
+            task.done() for task in self._tasks)
+
+    def enqueue_command(self, command, trace=None):
+        """Pushes a new command to be sent to the CUL stick onto the queue"""
+        self._send_queue.appendleft((command, trace))
+        self._send_wakeup.set()
+
+    async def open(self):
+        """Connects to the CUL stick and starts processing"""
+        self._budget_received = asyncio.Event()
+        self._send_wakeup = asyncio.Event()
+        self._connected = asyncio.Event()
+        self._closing = False
+        await self._connect()
+        for _ in range(10):
+            self._writeline("V")
+            try:
+                self._cul_version = await asyncio.wait_for(
+                    self._readline(), VERSION_TIMEOUT)
+            except asyncio.TimeoutError:
+                self._cul_version = None
+            if self._cul_version is not None:
+                LOGGER.debug("CUL reported version %s", self._cul_version)
+                break
+            LOGGER.info("No version from CUL reported?")
+        if self._cul_version is None:
+            self._disconnect()
+            raise CommunicationError("No version from CUL, cannot communicate")
+        await self._initialize()
+        self._tasks = [
+            asyncio.ensure_future(self._send_loop()),
+            asyncio.ensure_future(self._read_loop()),
+        ]
+
+    async def close(self):
+        """Stops processing and closes the connection to the CUL stick"""
+        self._closing = True
+        self._send_wakeup.set()
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        self._disconnect()
+
+    async def _initialize(self):
+        for command in INIT_COMMANDS:
+            self._writeline(command)
+            await asyncio.sleep(0.3)
+        self._connected.set()
+
+    async def _reconnect(self):
+        self._connected.clear()
+        self._disconnect()
+        for delay in RECONNECT_DELAYS:
+            await asyncio.sleep(delay)
+            if self._closing:
+                return False
+            try:
+                await self._connect()
+            except CommunicationError as err:
+                LOGGER.error("Reconnecting to CUL failed: %s", err)
+                continue
+            await self._initialize()
+            return True
+        return False
+
+    async def _connect(self):
+        if self._device_path.startswith(TCP_PREFIX):
+            host, _, port = self._device_path[len(TCP_PREFIX):].rpartition(':')
+            try:
+                self._reader, self._writer = await asyncio.open_connection(
+                    host, int(port))
+            except OSError as err:
+                raise CommunicationError(
+                    "Unable to connect to <%s>: %s" % (self._device_path, err))
+            return
+        try:
+            self._com_port = Serial(
+                self._device_path, self._baudrate, timeout=0)
+        except SerialException as err:
+            raise CommunicationError("Unable to open serial device <%s>" % err)
+        self._reader = asyncio.StreamReader()
+        asyncio.get_running_loop().add_reader(
+            self._com_port.fileno(), self._serial_readable)
+        # was required for my nanoCUL
+        await asyncio.sleep(2)
+
+    def _disconnect(self):
+        if self._com_port is not None:
+            asyncio.get_running_loop().remove_reader(self._com_port.fileno())
+            self._com_port.close()
+            self._com_port = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._remaining_budget = 0
+
+    def _serial_readable(self):
+        try:
+            data = self._com_port.read(self._com_port.in_waiting or 1)
+        except SerialException as err:
+            LOGGER.error("Error reading from serial device <%s>", err)
+            asyncio.get_running_loop().remove_reader(self._com_port.fileno())
+            self._reader.feed_eof()
+            return
+        self._reader.feed_data(data)
+
+    async def _readline(self):
+        while True:
+            try:
+                line = await self._reader.readline()
+            except ConnectionError as err:
+                LOGGER.error("Error reading from CUL <%s>", err)
+                return None
+            if not line:
+                return None
+            line = line.decode('utf-8').rstrip('\r\n')
+            if line:
+                return line
+
+    def _writeline(self, command):
+        """Sends given command to CUL. Invalidates has_send_budget if command sends a frame"""
+        LOGGER.debug("Writing command %s", command)
+        if command.startswith(SEND_COMMANDS):
+            self._remaining_budget = 0
+        data = (command + "\r\n").encode()
+        if self._writer is not None:
+            self._writer.write(data)
+        elif self._com_port is not None:
+            self._com_port.write(data)
+        else:
+            LOGGER.debug("Not connected to CUL, dropping command %s", command)
+
+    def _handle_line(self, line):
+        budget = parse_budget(line)
+        if budget is not None:
+            self._remaining_budget = budget
+            self._budget_received.set()
+            LOGGER.debug("Got pending budget: %sms", self._remaining_budget)
+        elif line.startswith("Z"):
+            self._line_callback(line)
+        else:
+            LOGGER.debug("Got unhandled response from CUL: '%s'", line)
+
+    async def _read_loop(self):
+        while True:
+            line = await self._readline()
+            if line is None:
+                if self._closing:
+                    return
+                LOGGER.error("Connection to CUL was closed. Try reconnecting.")
+                if await self._reconnect():
+                    continue
+                LOGGER.error("Unable to reconnect to CUL, quitting")
+                self._closing = True
+                self._send_wakeup.set()
+                if self._lost_callback is not None:
+                    self._lost_callback()
+                return
+            self._handle_line(line)
+
+    async def _request_budget(self):
+        self._budget_received.clear()
+        self._writeline(COMMAND_REQUEST_BUDGET)
+        try:
+            await asyncio.wait_for(
+                self._budget_received.wait(), BUDGET_TIMEOUT)
+        except asyncio.TimeoutError:
+            LOGGER.debug("CUL did not report its budget in time")
+
+    async def _send_loop(self):
+        await self._request_budget()
+        while not self._closing:
+            if not self._connected.is_set():
+                await self._connected.wait()
+                await self._request_budget()
+                continue
+            if not self._send_queue:
+                self._send_wakeup.clear()
+                await self._send_wakeup.wait()
+                continue
+            pending_message, trace = self._send_queue[-1]
+            if self._remaining_budget > len(pending_message) * 10:
+                self._send_queue.pop()
+                self._writeline(pending_message)
+                if trace is not None:
+                    trace.mark(STAGE_WRITTEN)
+            elif self._remaining_budget:
+                missing = max(
+                    MIN_REQUIRED_BUDGET, len(pending_message) * 10) - self._remaining_budget
+                await asyncio.sleep(missing / 10)
+            await self._request_budget()
+
+
+class AsyncMaxConnection(MaxProtocol):
+    """High level message processing inside an asyncio event loop.
+
+    Commands, including sending a wake-up session, return awaitables which
+    resolve to True once the receiver acknowledged them and events can be
+    consumed with
+
+        async for event, payload in connection.events():
+            ...
+    """
+
+    def __init__(
+            self,
+            device_path=DEFAULT_DEVICE,
+            baudrate=DEFAULT_BAUDRATE,
+            sender_id=DEFAULT_CUBE_ID,
+            callback=None,
+            paired_devices=None,
+            event_queue_size=DEFAULT_EVENT_QUEUE_SIZE,
+            callback_workers=0,
+            max_queued_events=DEFAULT_MAX_QUEUED_EVENTS,
+            store_path=None,
+            journal_path=None,
+            metrics=None,
+            tracer=None,
+            timeseries=None,
+            demand=None,
+            shared_state=None,
+            capture=None):
+        super().__init__(
+            sender_id=sender_id,
+            callback=callback,
+            paired_devices=paired_devices,
+            callback_workers=callback_workers,
+            max_queued_events=max_queued_events,
+            store_path=store_path,
+            journal_path=journal_path,
+            metrics=metrics,
+            tracer=tracer,
+            timeseries=timeseries,
+            demand=demand,
+            shared_state=shared_state,
+            capture=capture)
+        self.com = AsyncCulIo(
+            device_path, baudrate, self._process_frame, self._connection_lost)
+        self._event_queue_size = event_queue_size
+        self._event_queues = []
+        self._ack_waiters = {}
+        self._resend_task = None
+        self._lost = False
+
+    @property
+    def has_send_budget(self):
+        return self.com.has_send_budget
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.stop()
+
+    async def start(self):
+        """Opens the CUL stick and starts processing messages"""
+        self._lost = False
+        await self.com.open()
+        self._start_workers()
+        self._resend_task = asyncio.ensure_future(self._resend_loop())
+
+    async def stop(self):
+        LOGGER.info("Stopping MAXCUL")
+        if self._resend_task is not None:
+            self._resend_task.cancel()
+            try:
+                await self._resend_task
+            except asyncio.CancelledError:
+                pass
+            self._resend_task = None
+        await self.com.close()
+        # joins the writer and dispatcher threads, keep the loop running
+        await asyncio.get_running_loop().run_in_executor(None, self._stop_workers)
+        for msg in list(self._ack_waiters):
+            self._command_finished(msg, False)
+        self._end_events()
+
+    def _connection_lost(self):
+        """Fails pending and further commands and ends all event iterators
+        once AsyncCulIo gave up reconnecting"""
+        self._lost = True
+        for future in self._ack_waiters.values():
+            if not future.done():
+                future.set_exception(CommunicationError(CONNECTION_LOST))
+        self._ack_waiters.clear()
+        self._end_events()
+
+    def _end_events(self):
+        for queue in self._event_queues:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+    async def set_temperature(
+            self, receiver_id, temperature, mode, urgent=True,
+            deadline=None, priority=PRIORITY_NORMAL):
+        return await super().set_temperature(
+            receiver_id, temperature, mode, urgent, deadline, priority)
+
+    async def wakeup(self, receiver_id):
+        return await super().wakeup(receiver_id)
+
+    async def set_group_id(
+            self, receiver_id, group_id, urgent=True,
+            deadline=None, priority=PRIORITY_NORMAL):
+        return await super().set_group_id(
+            receiver_id, group_id, urgent, deadline, priority)
+
+    async def remove_group_id(
+            self, receiver_id, urgent=True,
+            deadline=None, priority=PRIORITY_NORMAL):
+        return await super().remove_group_id(
+            receiver_id, urgent, deadline, priority)
+
+    async def set_group_temperature(self, group_id, temperature, mode):
+        return await super().set_group_temperature(group_id, temperature, mode)
+
+    async def events(self):
+        """Asynchronously iterates over (event, payload) tuples until stopped"""
+        queue = asyncio.Queue(self._event_queue_size)
+        self._event_queues.append(queue)
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                yield item
+        finally:
+            self._event_queues.remove(queue)
+
+    async def _resend_loop(self):
+        while True:
+            self._resend_message()
+            await asyncio.sleep(RESEND_CHECK_INTERVAL)
+
+    def _transmit(self, raw_message):
+        self.com.enqueue_command(raw_message, self._sending_trace)
+
+    def _transport_ready(self):
+        return self.com.is_connected
+
+    def _transport_backlog(self):
+        return self.com.pending_commands
+
+    def _send_command(
+            self, msg, urgent=True, deadline=None, priority=PRIORITY_NORMAL):
+        return self._waiter(
+            msg, super()._send_command, msg, urgent, deadline, priority)
+
+    def _send_group_command(self, msg, members):
+        return self._waiter(msg, super()._send_group_command, msg, members)
+
+    def _send_session(self, session):
+        return self._waiter(session, super()._send_session, session)
+
+    def _waiter(self, key, send, *args):
+        """Returns a future of the outcome of send(*args), registered before
+        sending as a command may already be dropped while it is sent"""
+        if self._lost:
+            raise CommunicationError(CONNECTION_LOST)
+        future = self._ack_waiters[key] = asyncio.get_running_loop().create_future()
+        if not send(*args):
+            self._ack_waiters.pop(key, None)
+            if not future.done():
+                future.set_result(False)
+        return future
+
+    def _command_finished(self, msg, acknowledged):
+        future = self._ack_waiters.pop(msg, None)
+        if future is not None and not future.done():
+            future.set_result(acknowledged)
+
+    def _call_callback(self, event, payload):
+        super()._call_callback(event, payload)
+        for queue in self._event_queues:
+            try:
+                queue.put_nowait((event, payload))
+            except asyncio.QueueFull:
+                LOGGER.warning(
+                    "Event queue is full, dropping %s event", event)
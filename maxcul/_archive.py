@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.archive
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Capture archive of received frames. Frames are stored as fixed width
+    binary records in the order they were received, a sidecar index lists
+    the records of every device per hour. The index is only ever appended
+    to, every block of it lists the records written since the previous
+    block. Queries for a device and time range only touch the records
+    listed in the index, read them through mmap and decode nothing but the
+    frames which match.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+from array import array
+from collections import namedtuple
+import binascii
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+# environment imports
+import logging
+
+# custom imports
+from maxcul._exceptions import MoritzError
+from maxcul._messages import MoritzMessage, MORITZ_MESSAGE_CLASSES
+from maxcul._io import rssi_to_dbm
+
+# local constants
+LOGGER = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.idx'
+BUCKET_SECONDS = 3600
+FLUSH_RECORDS = 256
+MAX_PAYLOAD = 42
+
+# timestamp, sender, receiver, counter, flag, message type, group id,
+# raw signal strength, payload length, payload
+RECORD = struct.Struct('<dIIBBBBBB%ds' % MAX_PAYLOAD)
+TIMESTAMP = struct.Struct('<d')
+
+INDEX_MAGIC = b'MAXI'
+INDEX_VERSION = 2
+# magic, version, bucket seconds
+INDEX_HEADER = struct.Struct('<4sHI')
+# block size, records indexed up to the end of the block, first and last
+# bucket, entries
+BLOCK_HEADER = struct.Struct('<IIIII')
+# device id, bucket, offset of the first posting within the block, number
+# of postings
+INDEX_ENTRY = struct.Struct('<IIII')
+POSTING_SIZE = 4
+
+_STOP = object()
+
+CapturedFrame = namedtuple(
+    'CapturedFrame', ('timestamp', 'rssi', 'frame', 'message'))
+CapturedFrame.__doc__ = """A frame read from an archive, rssi in dBm, frame
+the Z line without signal strength and message the decoded MoritzMessage or
+None if it could not be decoded"""
+
+
+def encode_record(line, timestamp):
+    """Returns the record of a Z line as received from the CUL"""
+    try:
+        data = binascii.unhexlify(line[1:])
+    except (binascii.Error, ValueError) as err:
+        raise MoritzError("Unable to archive '%s': %s" % (line, err))
+    length = data[0] if data else 0
+    if len(data) < 12 or length < 10 or len(data) < length + 2:
+        raise MoritzError("Unable to archive '%s': frame is truncated" % line)
+    payload = data[11:length + 1]
+    if len(payload) > MAX_PAYLOAD:
+        raise MoritzError("Unable to archive '%s': payload is too long" % line)
+    return RECORD.pack(
+        timestamp,
+        int.from_bytes(data[4:7], 'big'),
+        int.from_bytes(data[7:10], 'big'),
+        data[1], data[2], data[3], data[10],
+        data[length + 1],
+        len(payload), payload)
+
+
+def decode_frame(fields):
+    """Returns the Z line of unpacked record fields"""
+    (_, sender_id, receiver_id, counter, flag, msg_type, group_id, _,
+     payload_length, payload) = fields
+    return "Z%02X%02X%02X%02X%06X%06X%02X%s" % (
+        10 + payload_length, counter, flag, msg_type, sender_id, receiver_id,
+        group_id, binascii.hexlify(payload[:payload_length]).decode().upper())
+
+
+def _devices_of(fields):
+    sender_id, receiver_id = fields[1], fields[2]
+    if receiver_id and receiver_id != sender_id:
+        return (sender_id, receiver_id)
+    return (sender_id,)
+
+
+def _blocks_of(index, size):
+    """Yields (offset, indexed, size, first bucket, last bucket, entries) of
+    every complete block in the first size bytes of an index"""
+    offset = INDEX_HEADER.size
+    while offset + BLOCK_HEADER.size <= size:
+        block_size, indexed, first_bucket, last_bucket, entries = \
+            BLOCK_HEADER.unpack_from(index, offset)
+        if block_size < BLOCK_HEADER.size or offset + block_size > size:
+            return
+        yield offset, indexed, block_size, first_bucket, last_bucket, entries
+        offset += block_size
+
+
+class CaptureWriter(object):
+    """Appends frames to the archive at path and keeps its index up to date.
+
+    Frames are written and indexed by a writer thread, or by flush if the
+    writer thread was not started. Every FLUSH_RECORDS frames and on flush
+    or stop a block indexing the frames written since the previous block
+    is appended to the index, readers scan frames not indexed yet."""
+
+    def __init__(self, path, bucket_seconds=BUCKET_SECONDS):
+        self.path = path
+        self.bucket_seconds = bucket_seconds
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pending = {}
+        self._records = 0
+        self._indexed = 0
+        self._last_timestamp = None
+        self._file = open(path, 'ab')
+        self._index_file = None
+        self._load_index()
+
+    def __len__(self):
+        return self._records
+
+    def start(self):
+        """Starts the writer thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._write_loop, name="maxcul-capture", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Writes and indexes all queued frames and stops the writer thread"""
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+            self._thread = None
+        else:
+            self.flush()
+
+    def add_line(self, line, timestamp=None):
+        """Archives a Z line received from the CUL, including its signal
+        strength, timestamp defaults to now"""
+        if timestamp is None:
+            timestamp = time.time()
+        self._queue.put((timestamp, encode_record(line, timestamp)))
+
+    def flush(self):
+        """Synchronously writes and indexes all queued frames, for use
+        without writer thread"""
+        while not self._queue.empty():
+            self._write_batch(self._drain([]))
+        self._write_index()
+
+    def close(self):
+        self.stop()
+        self._file.close()
+        self._index_file.close()
+
+    def _drain(self, batch):
+        while len(batch) < FLUSH_RECORDS:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_loop(self):
+        stop = False
+        while not stop:
+            batch = self._drain([self._queue.get()])
+            stop = _STOP in batch
+            self._write_batch([item for item in batch if item is not _STOP])
+        while not self._queue.empty():
+            self._write_batch(self._drain([]))
+        self._write_index()
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        try:
+            for timestamp, record in batch:
+                if self._last_timestamp is not None and timestamp < self._last_timestamp:
+                    # the clock was set back, frames stay ordered by time
+                    timestamp = self._last_timestamp
+                    record = TIMESTAMP.pack(timestamp) + record[TIMESTAMP.size:]
+                self._last_timestamp = timestamp
+                self._file.write(record)
+                self._add_postings(RECORD.unpack(record), self._records)
+                self._records += 1
+            # readers scan frames which are not indexed yet
+            self._file.flush()
+            if self._records - self._indexed >= FLUSH_RECORDS:
+                self._write_index()
+        except OSError as err:
+            LOGGER.error("Unable to write capture archive: %s", err)
+
+    def _write_index(self):
+        """Appends a block indexing the frames written since the last one"""
+        if not self._pending:
+            return
+        entries = []
+        postings = array('I')
+        for (device_id, bucket), numbers in sorted(self._pending.items()):
+            entries.append(INDEX_ENTRY.pack(device_id, bucket, len(postings), len(numbers)))
+            postings.extend(numbers)
+        buckets = [bucket for _, bucket in self._pending]
+        size = BLOCK_HEADER.size + len(entries) * INDEX_ENTRY.size + \
+            len(postings) * POSTING_SIZE
+        try:
+            self._index_file.write(BLOCK_HEADER.pack(
+                size, self._records, min(buckets), max(buckets), len(entries)) +
+                b''.join(entries) + postings.tobytes())
+            self._index_file.flush()
+        except OSError as err:
+            LOGGER.error("Unable to write capture index: %s", err)
+            return
+        self._pending = {}
+        self._indexed = self._records
+
+    def _add_postings(self, fields, number):
+        bucket = int(fields[0] // self.bucket_seconds)
+        for device_id in _devices_of(fields):
+            numbers = self._pending.get((device_id, bucket))
+            if numbers is None:
+                numbers = self._pending[(device_id, bucket)] = array('I')
+            numbers.append(number)
+
+    def _load_index(self):
+        """Opens the index of the frames already in the archive, frames it
+        does not cover yet are indexed again"""
+        size = os.path.getsize(self.path)
+        if size % RECORD.size:
+            LOGGER.warning("Dropping a partly written frame from %s", self.path)
+            self._file.truncate(size - size % RECORD.size)
+            size -= size % RECORD.size
+        self._records = size // RECORD.size
+        self._indexed = self._open_index()
+        if not size:
+            return
+        with open(self.path, 'rb') as data:
+            with mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ) as records:
+                for number in range(self._indexed, self._records):
+                    self._add_postings(
+                        RECORD.unpack_from(records, number * RECORD.size), number)
+                self._last_timestamp = TIMESTAMP.unpack_from(
+                    records, (self._records - 1) * RECORD.size)[0]
+
+    def _open_index(self):
+        """Opens the index for appending and returns the number of frames
+        it covers, a damaged or foreign index is started over"""
+        index_path = self.path + INDEX_SUFFIX
+        try:
+            with open(index_path, 'rb') as index:
+                data = index.read()
+        except OSError:
+            data = b''
+        indexed = 0
+        valid = len(data) >= INDEX_HEADER.size and INDEX_HEADER.unpack_from(data) == (
+            INDEX_MAGIC, INDEX_VERSION, self.bucket_seconds)
+        if valid:
+            blocks = list(_blocks_of(data, len(data)))
+            if blocks:
+                indexed = blocks[-1][1]
+            end = blocks[-1][0] + blocks[-1][2] if blocks else INDEX_HEADER.size
+            valid = indexed <= self._records
+        if valid:
+            self._index_file = open(index_path, 'r+b')
+            # a block torn by a crash is written again
+            self._index_file.truncate(end)
+            self._index_file.seek(end)
+            return indexed
+        self._index_file = open(index_path, 'wb')
+        self._index_file.write(INDEX_HEADER.pack(
+            INDEX_MAGIC, INDEX_VERSION, self.bucket_seconds))
+        self._index_file.flush()
+        return 0
+
+
+class CaptureArchive(object):
+    """Read access to an archive written by CaptureWriter"""
+
+    def __init__(self, path):
+        self.path = path
+        self._data_file = open(path, 'rb')
+        self._count = 0
+        self._records = None
+        self._index_file = None
+        self._index = None
+        self.bucket_seconds = BUCKET_SECONDS
+        self._indexed = 0
+        self._blocks = []
+        self.refresh()
+
+    def __len__(self):
+        return self._count
+
+    def refresh(self):
+        """Maps frames and index written since the archive was opened"""
+        self._unmap()
+        size = os.path.getsize(self.path)
+        self._count = size // RECORD.size
+        if self._count:
+            self._records = mmap.mmap(
+                self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        index_path = self.path + INDEX_SUFFIX
+        if not os.path.exists(index_path):
+            return
+        self._index_file = open(index_path, 'rb')
+        self._index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.bucket_seconds = INDEX_HEADER.unpack_from(self._index)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise MoritzError("%s is no capture index" % index_path)
+        # a block being appended right now is left to the next refresh
+        self._blocks = [
+            block for block in _blocks_of(self._index, len(self._index))
+            if block[1] <= self._count]
+        self._indexed = self._blocks[-1][1] if self._blocks else 0
+
+    def close(self):
+        self._unmap()
+        self._data_file.close()
+
+    def query(self, device_id=None, start=None, end=None, message_types=None):
+        """Yields CapturedFrames sent by or to device_id, received from start
+        until before end (seconds since the epoch) and of one of the given
+        message classes, each of them None to match everything"""
+        if message_types is not None:
+            type_ids = frozenset(
+                MORITZ_MESSAGE_CLASSES[message_type] for message_type in message_types)
+        else:
+            type_ids = None
+        for number in self._candidates(device_id, start, end):
+            fields = RECORD.unpack_from(self._records, number * RECORD.size)
+            timestamp = fields[0]
+            if (start is not None and timestamp < start) or \
+                    (end is not None and timestamp >= end):
+                continue
+            if device_id is not None and device_id not in _devices_of(fields):
+                continue
+            if type_ids is not None and fields[5] not in type_ids:
+                continue
+            yield self._decode(fields)
+
+    def _candidates(self, device_id, start, end):
+        if device_id is None or self._index is None:
+            first = 0 if start is None else self._bisect(start)
+            last = self._count if end is None else self._bisect(end)
+            return range(first, last)
+        return self._indexed_candidates(device_id, start, end)
+
+    def _indexed_candidates(self, device_id, start, end):
+        first_bucket = 0 if start is None else int(start // self.bucket_seconds)
+        last_bucket = 0xFFFFFFFF if end is None else int(end // self.bucket_seconds)
+        for offset, _, _, block_first, block_last, entries in self._blocks:
+            if block_last < first_bucket or block_first > last_bucket:
+                continue
+            entries_offset = offset + BLOCK_HEADER.size
+            postings_offset = entries_offset + entries * INDEX_ENTRY.size
+            entry = self._find_entry(entries_offset, entries, device_id, first_bucket)
+            while entry < entries:
+                known_id, bucket, first, count = INDEX_ENTRY.unpack_from(
+                    self._index, entries_offset + entry * INDEX_ENTRY.size)
+                if known_id != device_id or bucket > last_bucket:
+                    break
+                begin = postings_offset + first * POSTING_SIZE
+                numbers = array('I')
+                numbers.frombytes(self._index[begin:begin + count * POSTING_SIZE])
+                for number in numbers:
+                    yield number
+                entry += 1
+        # frames archived after the last block was written
+        first = self._indexed if start is None else max(self._indexed, self._bisect(start))
+        last = self._count if end is None else self._bisect(end)
+        for number in range(first, last):
+            yield number
+
+    def _find_entry(self, entries_offset, entries, device_id, bucket):
+        """Returns the first entry of a block not before (device_id, bucket)"""
+        low, high = 0, entries
+        while low < high:
+            middle = (low + high) // 2
+            key = INDEX_ENTRY.unpack_from(
+                self._index, entries_offset + middle * INDEX_ENTRY.size)[:2]
+            if key < (device_id, bucket):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _bisect(self, timestamp):
+        """Returns the number of frames received before timestamp"""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if TIMESTAMP.unpack_from(self._records, middle * RECORD.size)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _decode(self, fields):
+        frame = decode_frame(fields)
+        try:
+            message = MoritzMessage.decode_message(frame)
+        except Exception as err:
+            LOGGER.debug("Unable to decode archived frame '%s': %s", frame, err)
+            message = None
+        return CapturedFrame(fields[0], rssi_to_dbm(fields[7]), frame, message)
+
+    def _unmap(self):
+        if self._records is not None:
+            self._records.close()
+            self._records = None
+        if self._index is not None:
+            self._index.close()
+            self._index_file.close()
+            self._index = self._index_file = None
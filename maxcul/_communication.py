@@ -4,10 +4,11 @@
     ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     There are two communication classes available which should run in their own thread.
-    CULComThread performs low-level serial communication, CULMessageThread performs high-level
-    communication and spawns a CULComThread for its low-level needs.
+    CulIoThread performs low-level serial communication, MaxConnection performs high-level
+    communication and spawns a CulIoThread for its low-level needs.
 
-    Generally just use CULMessageThread unless you have a good reason not to.
+    Generally just use MaxConnection unless you have a good reason not to. Code running
+    inside an asyncio event loop should use AsyncMaxConnection instead.
 
     :copyright: (c) 2014 by Markus Ullmann.
     :license: BSD, see LICENSE for more details.
@@ -16,7 +17,8 @@
 # environment constants
 
 # python imports
-from datetime import datetime
+from collections import namedtuple
+from concurrent.futures import Future
 import queue
 import threading
 import time
@@ -25,42 +27,39 @@ import time
 import logging
 
 # custom imports
-from maxcul._exceptions import MoritzError
-from maxcul._messages import (
-    MoritzMessage,
-    PairPingMessage, PairPongMessage,
-    TimeInformationMessage,
-    SetTemperatureMessage,
-    ThermostatStateMessage,
-    AckMessage,
-    ShutterContactStateMessage,
-    WallThermostatStateMessage,
-    WallThermostatControlMessage,
-    WakeUpMessage
-)
 from maxcul._io import CulIoThread
-from maxcul._const import (
-    EVENT_DEVICE_PAIRED, EVENT_DEVICE_REPAIRED, EVENT_THERMOSTAT_UPDATE,
-    ATTR_DEVICE_ID, ATTR_DESIRED_TEMPERATURE, ATTR_MEASURED_TEMPERATURE,
-    ATTR_MODE, ATTR_BATTERY_LOW
-)
+from maxcul._fastpath import FastResponder
+from maxcul._diversity import StickRouter, DUPLICATE_WINDOW, receiver_of
+from maxcul._dispatch import DEFAULT_MAX_QUEUED_EVENTS
+from maxcul._protocol import MaxProtocol, DEFAULT_CUBE_ID
+from maxcul._const import PRIORITY_NORMAL
 
 # local constants
 LOGGER = logging.getLogger(__name__)
 
-# Hardcodings based on FHEM recommendations
-DEFAULT_CUBE_ID = 0x123456
-
 DEFAULT_DEVICE = '/dev/ttyUSB0'
 DEFAULT_BAUDRATE = '38400'
-DEFAULT_PAIRING_TIMOUT = 30
 
-BACKOFF_INTERVAL = 10
-MAX_ATTEMPTS = 5
+CommandRequest = namedtuple(
+    'CommandRequest', ('function', 'args', 'kwargs', 'future'))
+CommandRequest.__doc__ = """A command posted to the connection thread"""
+
+
+class MaxConnection(MaxProtocol, threading.Thread):
+    """High level message processing.
 
+    Commands may be issued from any number of threads. They are posted to an
+    inbox and executed by the connection thread, which is the only one
+    touching the protocol state. Every command returns a
+    concurrent.futures.Future resolving to True once the receiver
+    acknowledged it.
 
-class MaxConnection(threading.Thread):
-    """High level message processing"""
+    With fast_path set, the IO thread itself answers PairPings and frames of
+    paired devices which need an ACK, instead of waiting for this thread.
+
+    device_path may also be a list of paths to drive several sticks at once.
+    Frames heard by more than one of them are processed once and commands
+    are sent through the stick hearing their receiver best."""
 
     def __init__(
             self,
@@ -68,225 +67,192 @@ class MaxConnection(threading.Thread):
             baudrate=DEFAULT_BAUDRATE,
             sender_id=DEFAULT_CUBE_ID,
             callback=None,
-            paired_devices=None):
-        super().__init__()
-        self.sender_id = sender_id
-        self.com_thread = CulIoThread(device_path, baudrate)
+            paired_devices=None,
+            callback_workers=0,
+            max_queued_events=DEFAULT_MAX_QUEUED_EVENTS,
+            store_path=None,
+            journal_path=None,
+            fast_path=False,
+            metrics=None,
+            tracer=None,
+            timeseries=None,
+            demand=None,
+            shared_state=None,
+            capture=None):
+        threading.Thread.__init__(self)
+        MaxProtocol.__init__(
+            self,
+            sender_id=sender_id,
+            callback=callback,
+            paired_devices=paired_devices,
+            callback_workers=callback_workers,
+            max_queued_events=max_queued_events,
+            store_path=store_path,
+            journal_path=journal_path,
+            metrics=metrics,
+            tracer=tracer,
+            timeseries=timeseries,
+            demand=demand,
+            shared_state=shared_state,
+            capture=capture)
+        device_paths = [device_path] if isinstance(device_path, str) else list(device_path)
+        self._responder = None
+        if fast_path:
+            self._responder = FastResponder(
+                sender_id, self._paired_devices, lambda: self.pairing_enabled,
+                DUPLICATE_WINDOW if len(device_paths) > 1 else 0)
+        read_queue = queue.Queue()
+        self.com_threads = [
+            CulIoThread(
+                path, baudrate, self._responder, self.metrics, self.tracer,
+                read_queue)
+            for path in device_paths]
+        self.com_thread = self.com_threads[0]
+        self._router = None
+        if len(self.com_threads) > 1:
+            self._router = StickRouter(self.com_threads)
         self.stop_requested = threading.Event()
-        self._pairing_enabled = threading.Event()
-        self._paired_devices = paired_devices or []
-        self._outstanding_acks = {}
-        self.callback = callback
-        self._msg_count = 0
+        self._inbox = queue.SimpleQueue()
+        self._ack_waiters = {}
+
+    @property
+    def has_send_budget(self):
+        return any(thread.has_send_budget for thread in self.com_threads)
 
     def run(self):
-        self.com_thread.start()
+        self._start_workers()
+        for thread in self.com_threads:
+            thread.start()
         while not self.stop_requested.is_set():
             self._receive_message()
+            self._process_inbox()
             self._resend_message()
             time.sleep(0.3)
 
     def stop(self, timeout=None):
         LOGGER.info("Stopping MAXCUL")
-        self.com_thread.stop(timeout)
+        for thread in self.com_threads:
+            thread.stop(timeout)
         self.stop_requested.set()
         self.join(timeout)
-
-    def enable_pairing(self, duration=DEFAULT_PAIRING_TIMOUT):
-        LOGGER.info("Enable pairing for %d seconds", duration)
-        self._pairing_enabled.set()
-
-        def clear_pair():
-            self._pairing_enabled.clear()
-        threading.Timer(duration, clear_pair).start()
-
-    def set_temperature(self, receiver_id, temperature, mode):
-        LOGGER.debug(
-            "Setting temperature for %d to %d %s",
-            receiver_id, temperature, mode)
-        msg = SetTemperatureMessage(
-            counter=self._next_counter(),
-            sender_id=self.sender_id,
-            receiver_id=receiver_id,
-            desired_temperature=float(temperature),
-            mode=mode
-        )
-        success = self._send_message(msg)
-        if success:
-            self._await_ack(msg)
-        return success
+        self._stop_workers(timeout)
+        for msg in list(self._ack_waiters):
+            self._command_finished(msg, False)
+        while True:
+            try:
+                self._inbox.get_nowait().future.set_result(False)
+            except queue.Empty:
+                break
+
+    def set_temperature(
+            self, receiver_id, temperature, mode, urgent=True,
+            deadline=None, priority=PRIORITY_NORMAL):
+        return self._post(
+            super().set_temperature,
+            receiver_id, temperature, mode, urgent, deadline, priority)
+
+    def set_group_id(
+            self, receiver_id, group_id, urgent=True,
+            deadline=None, priority=PRIORITY_NORMAL):
+        return self._post(
+            super().set_group_id,
+            receiver_id, group_id, urgent, deadline, priority)
+
+    def remove_group_id(
+            self, receiver_id, urgent=True,
+            deadline=None, priority=PRIORITY_NORMAL):
+        return self._post(
+            super().remove_group_id, receiver_id, urgent, deadline, priority)
+
+    def set_group_temperature(self, group_id, temperature, mode):
+        return self._post(
+            super().set_group_temperature, group_id, temperature, mode)
 
     def wakeup(self, receiver_id):
-        LOGGER.debug("Waking device %d", receiver_id)
-        msg = WakeUpMessage(
-            counter=self._next_counter(),
-            receiver_id=receiver_id)
-        success = self._send_message(msg)
-        if success:
-            self._await_ack(msg)
-        return success
-
-    def _next_counter(self):
-        self._msg_count += 1
-        return self._msg_count
+        return self._post(super().wakeup, receiver_id)
+
+    def _post(self, function, *args, **kwargs):
+        """Hands a command to the connection thread and returns a future of
+        its outcome"""
+        future = Future()
+        self._inbox.put(CommandRequest(function, args, kwargs, future))
+        return future
+
+    def _process_inbox(self):
+        """Executes all posted commands, only called by the connection thread"""
+        while True:
+            try:
+                request = self._inbox.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = request.function(*request.args, **request.kwargs)
+            except Exception as err:
+                LOGGER.error("Exception <%s> was raised while executing a command", err)
+                request.future.set_exception(err)
+                continue
+            if isinstance(result, Future):
+                result.add_done_callback(
+                    lambda done, future=request.future: future.set_result(done.result()))
+            else:
+                request.future.set_result(result)
 
     def _receive_message(self):
         try:
-            received_msg = self.com_thread.read_queue.get(True, 0.05)
-            message = MoritzMessage.decode_message(received_msg[:-2])
-            signal_strength = int(received_msg[-2:], base=16)
-            self._handle_message(message, signal_strength)
+            received_msg, answered, trace, thread, read_at = \
+                self.com_thread.read_queue.get(True, 0.05)
         except queue.Empty:
-            pass
-        except Exception as err:
-            LOGGER.error(
-                "Exception <%s> was raised while parsing message '%s'. Please consider reporting this as a bug.",
-                err,
-                received_msg)
-
-    def _send_message(self, msg):
-        if not self.com_thread.is_alive():
-            LOGGER.error(
-                "Communication with serial device is not established, unable to send a message")
-            return False
-        LOGGER.debug("Sending message %s", msg)
-        try:
-            raw_message = msg.encode_message()
-            self.com_thread.enqueue_command(raw_message)
-            return True
-        except Exception as err:
-            LOGGER.error(
-                "Exception <%s> was raised while encoding message %s. Please consider reporting this as a bug.",
-                err,
-                msg)
-            return False
-
-    def _await_ack(self, msg):
-        now = int(time.monotonic())
-        self._outstanding_acks[msg.counter] = (now, 1, msg)
-
-    def _resend_message(self):
-        now = int(time.monotonic())
-        for counter, (when, attempt,
-                      msg) in self._outstanding_acks.copy().items():
-            if when + BACKOFF_INTERVAL * attempt > now:
-                continue
-            if attempt == MAX_ATTEMPTS:
-                del self._outstanding_acks[counter]
-                LOGGER.warn("Did not receive an ACK for message %s", msg)
-                continue
-            if self._send_message(msg):
-                self._outstanding_acks[counter] = (now, attempt + 1, msg)
-            else:
-                del self._outstanding_acks[counter]
-
-    def _send_ack(self, msg):
-        ack_msg = msg.respond_with(
-            AckMessage,
-            counter=msg.counter,
-            sender_id=self.sender_id)
-        self._send_message(ack_msg)
-
-    def _send_timeinformation(self, msg):
-        resp_msg = msg.respond_with(
-            TimeInformationMessage,
-            counter=self._next_counter(),
-            sender_id=self.sender_id,
-            datetime=datetime.now()
-        )
-        self._send_message(resp_msg)
-
-    def _send_pong(self, msg):
-        resp_msg = msg.respond_with(
-            PairPongMessage,
-            counter=self._next_counter(),
-            sender_id=self.sender_id,
-            devicetype='Cube'
-        )
-        if self.com_thread.has_send_budget:
-            if self._send_message(resp_msg):
-                self._paired_devices.append(msg.sender_id)
-                return True
-            return False
-        LOGGER.info(
-            "NOT responding to pair send budget is insufficient to be on time")
-        return False
-
-    def _handle_message(self, msg, signal_strenth):
-        """Internal function to respond to incoming messages where appropriate"""
-        if msg.receiver_id != 0 and msg.receiver_id != self.sender_id:
-            # discard messages not addressed to us
-            return
-
-        LOGGER.debug("Received message %s (%d)", msg, signal_strenth)
-
-        if isinstance(msg, PairPingMessage):
-            # Some peer wants to pair. Let's see...
-            if msg.receiver_id == 0x0:
-                # pairing after factory reset
-                if not self._pairing_enabled.is_set():
-                    LOGGER.info(
-                        "Pairing requested but pairing disabled, not pairing to new device")
-                    return
-                if self._send_pong(msg):
-                    self._call_callback(
-                        EVENT_DEVICE_PAIRED, {
-                            ATTR_DEVICE_ID: msg.sender_id})
-            elif msg.receiver_id == self.sender_id:
-                # pairing after battery replacement
-                if self._send_pong(msg):
-                    self._call_callback(
-                        EVENT_DEVICE_REPAIRED, {
-                            ATTR_DEVICE_ID: msg.sender_id})
-            else:
-                # pair to someone else after battery replacement, don't care
-                LOGGER.debug(
-                    "pair after battery replacement sent to other device 0x%X, ignoring",
-                    msg.receiver_id)
             return
-
-        if msg.receiver_id == 0 and msg.sender_id not in self._paired_devices:
-            # discard broadcast messages from devices we are not paired with
+        # copies are told apart by when the sticks read them, not by how
+        # long they waited in the queue
+        if self._router is not None and \
+                not self._router.receive(thread, received_msg, read_at):
+            LOGGER.debug("Frame %s was already received", received_msg)
             return
-
-        if isinstance(msg, TimeInformationMessage):
-            if not msg.datetime:
-                # time information requested
-                self._send_timeinformation(msg)
-
-        elif isinstance(msg, ThermostatStateMessage):
-            self._send_ack(msg)
-            self._propagate_thermostat_change(msg)
-
-        elif isinstance(msg, AckMessage):
-            if msg.counter in self._outstanding_acks:
-                del self._outstanding_acks[msg.counter]
-            if msg.state == "ok":
-                self._propagate_thermostat_change(msg)
-
-        elif isinstance(msg, ShutterContactStateMessage, WallThermostatStateMessage, SetTemperatureMessage, WallThermostatControlMessage):
-            self._send_ack(msg)
-
-        else:
-            LOGGER.warning(
-                "Unhandled Message of type %s, contains %s",
-                msg.__class__.__name__, msg)
-
-    def _propagate_thermostat_change(self, msg):
-        payload = {
-            ATTR_DEVICE_ID: msg.sender_id,
-            ATTR_MEASURED_TEMPERATURE: msg.measured_temperature,
-            ATTR_DESIRED_TEMPERATURE: msg.desired_temperature,
-            ATTR_MODE: msg.mode,
-            ATTR_BATTERY_LOW: msg.battery_low
-
-        }
-        self._call_callback(EVENT_THERMOSTAT_UPDATE, payload)
-
-    def _call_callback(self, event, payload):
-        if self.callback:
-            try:
-                self.callback(event, payload)
-            except Exception as err:
-                LOGGER.warning(
-                    "Error while calling callback for thermostat update: %s", err)
+        self._process_frame(received_msg, answered, trace)
+
+    def _transmit(self, raw_message):
+        thread = self.com_thread
+        if self._router is not None:
+            thread = self._router.route(receiver_of(raw_message), time.monotonic())
+        thread.enqueue_command(raw_message, self._sending_trace)
+
+    def _transport_ready(self):
+        return any(thread.is_alive() for thread in self.com_threads)
+
+    def _transport_backlog(self):
+        return sum(thread.pending_commands for thread in self.com_threads)
+
+    def _add_paired_device(self, device_id):
+        super()._add_paired_device(device_id)
+        if self._responder is not None:
+            self._responder.paired_devices = frozenset(self._paired_devices)
+
+    def _send_command(
+            self, msg, urgent=True, deadline=None, priority=PRIORITY_NORMAL):
+        return self._waiter(
+            msg, super()._send_command, msg, urgent, deadline, priority)
+
+    def _send_group_command(self, msg, members):
+        return self._waiter(msg, super()._send_group_command, msg, members)
+
+    def _send_session(self, session):
+        return self._post(self._start_session, session)
+
+    def _start_session(self, session):
+        return self._waiter(session, super()._send_session, session)
+
+    def _waiter(self, key, send, *args):
+        """Returns a future of the outcome of send(*args), registered before
+        sending as a command may already be dropped while it is sent"""
+        future = self._ack_waiters[key] = Future()
+        if not send(*args):
+            self._ack_waiters.pop(key, None)
+            if not future.done():
+                future.set_result(False)
+        return future
+
+    def _command_finished(self, msg, acknowledged):
+        future = self._ack_waiters.pop(msg, None)
+        if future is not None and not future.done():
+            future.set_result(acknowledged)
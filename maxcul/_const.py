@@ -54,9 +54,50 @@ MAX_TEMPERATURE = 30.5
 EVENT_THERMOSTAT_UPDATE = 'thermostat_update'
 EVENT_DEVICE_PAIRED = 'device_paired'
 EVENT_DEVICE_REPAIRED = 'device_repaired'
+EVENT_WALL_THERMOSTAT_UPDATE = 'wall_thermostat_update'
+EVENT_SHUTTER_CONTACT_UPDATE = 'shutter_contact_update'
+EVENT_PUSH_BUTTON_UPDATE = 'push_button_update'
 
 ATTR_DEVICE_ID = 'device_id'
 ATTR_DESIRED_TEMPERATURE = 'desired_temperature'
 ATTR_MEASURED_TEMPERATURE = 'measured_temperature'
 ATTR_MODE = 'mode'
 ATTR_BATTERY_LOW = 'battery_low'
+ATTR_VALVE_POSITION = 'valve_position'
+ATTR_STATE = 'state'
+ATTR_CHANGES = 'changes'
+
+EVENT_COMMAND_DROPPED = 'command_dropped'
+
+ATTR_COMMAND = 'command'
+ATTR_REASON = 'reason'
+
+# Reasons for dropping a command
+REASON_EXPIRED = 'expired'
+REASON_SUPERSEDED = 'superseded'
+REASON_NOT_ACKNOWLEDGED = 'not_acknowledged'
+REASON_SEND_FAILED = 'send_failed'
+
+# Command priorities, higher ones are sent first
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+
+# Stages recorded on traces of received frames
+STAGE_READ = 'read'
+STAGE_FRAMED = 'framed'
+STAGE_ENQUEUED = 'enqueued'
+STAGE_DEQUEUED = 'dequeued'
+STAGE_DECODED = 'decoded'
+STAGE_CALLBACK = 'callback'
+STAGE_HANDLED = 'handled'
+
+# Stages recorded on traces of transmitted frames
+STAGE_CREATED = 'created'
+STAGE_ENCODED = 'encoded'
+STAGE_QUEUED = 'queued'
+STAGE_WRITTEN = 'written'
+STAGE_ACKNOWLEDGED = 'acknowledged'
+
+DIRECTION_RECEIVE = 'receive'
+DIRECTION_TRANSMIT = 'transmit'
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.daemon
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Only a single process can open a CUL stick. The daemon owns the
+    connection and shares it with any number of local clients through a
+    Unix domain socket, so adding a consumer costs no radio traffic.
+
+    Clients talk JSON, one object per line. Requests are
+
+        {"op": "subscribe", "events": [...], "devices": [...]}
+        {"op": "set_temperature", "id": 1, "device_id": 8978409,
+         "temperature": 21.5, "mode": "manual"}
+
+    subscribe limits the events sent to the client to the given event types
+    and device ids, an omitted list matches everything. Commands are the
+    public commands of AsyncMaxConnection with their arguments, they are
+    answered with {"id": 1, "result": true} once acknowledged or
+    {"id": 1, "error": "..."}. Events are sent as
+    {"event": "thermostat_update", "payload": {...}}.
+
+    Every event is encoded once for all clients. A client which lets more
+    than max_buffered bytes pile up is disconnected instead of slowing down
+    the others.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import argparse
+import asyncio
+import json
+import os
+
+# environment imports
+import logging
+
+# custom imports
+from maxcul._aio import AsyncMaxConnection
+from maxcul._communication import DEFAULT_DEVICE, DEFAULT_BAUDRATE
+from maxcul._const import ATTR_DEVICE_ID
+
+# local constants
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = '/run/maxcul.sock'
+DEFAULT_MAX_BUFFERED = 64 * 1024
+
+# requests executed as commands of the connection and their arguments
+COMMANDS = {
+    'set_temperature': ('device_id', 'temperature', 'mode'),
+    'set_group_id': ('device_id', 'group_id'),
+    'remove_group_id': ('device_id',),
+    'set_group_temperature': ('group_id', 'temperature', 'mode'),
+    'wakeup': ('device_id',),
+}
+
+
+class DaemonClient(object):
+    """A connected client and what it subscribed to, None matches all"""
+
+    __slots__ = ('reader', 'writer', 'events', 'devices')
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.events = None
+        self.devices = None
+
+    def wants(self, event, device_id):
+        return (self.events is None or event in self.events) and \
+            (self.devices is None or device_id in self.devices)
+
+
+class MaxDaemon(object):
+    """Serves an AsyncMaxConnection on a Unix domain socket"""
+
+    def __init__(self, connection, socket_path=DEFAULT_SOCKET_PATH,
+                 max_buffered=DEFAULT_MAX_BUFFERED):
+        self.connection = connection
+        self.socket_path = socket_path
+        self.max_buffered = max_buffered
+        self.clients = set()
+        self._server = None
+        self._events_task = None
+        # running commands, the event loop only keeps weak references
+        self._tasks = set()
+
+    async def start(self):
+        """Starts serving, the connection has to be started already"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = await asyncio.start_unix_server(
+            self._serve, self.socket_path)
+        self._events_task = asyncio.ensure_future(self._forward_events())
+
+    async def stop(self):
+        self._events_task.cancel()
+        try:
+            await self._events_task
+        except asyncio.CancelledError:
+            pass
+        self._server.close()
+        for client in list(self.clients):
+            self._disconnect(client)
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._server.wait_closed()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def publish(self, event, payload):
+        """Sends an event to all clients subscribed to it"""
+        device_id = payload.get(ATTR_DEVICE_ID)
+        line = None
+        for client in list(self.clients):
+            if not client.wants(event, device_id):
+                continue
+            if line is None:
+                line = _encode({'event': event, 'payload': payload})
+            self._write(client, line)
+
+    async def _forward_events(self):
+        async for event, payload in self.connection.events():
+            self.publish(event, payload)
+
+    def _write(self, client, line):
+        if client.writer.is_closing():
+            return
+        client.writer.write(line)
+        if client.writer.transport.get_write_buffer_size() > self.max_buffered:
+            LOGGER.warning("Client does not keep up, disconnecting it")
+            self._disconnect(client)
+
+    def _disconnect(self, client):
+        self.clients.discard(client)
+        client.writer.transport.abort()
+
+    async def _serve(self, reader, writer):
+        client = DaemonClient(reader, writer)
+        self.clients.add(client)
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError) as err:
+                    # the rest of an overlong line can not be told apart
+                    # from the next request
+                    self._write(client, _encode({'error': str(err)}))
+                    break
+                if not line:
+                    break
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                except ValueError as err:
+                    self._write(client, _encode({'error': str(err)}))
+                    continue
+                if not isinstance(request, dict):
+                    self._write(client, _encode({'error': "Requests have to be JSON objects"}))
+                    continue
+                self._handle(client, request)
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(client)
+            writer.close()
+
+    def _handle(self, client, request):
+        operation = request.get('op')
+        if operation == 'subscribe':
+            events = request.get('events')
+            devices = request.get('devices')
+            for name, value in (('events', events), ('devices', devices)):
+                if value is not None and not isinstance(value, list):
+                    self._reply(client, request, error="%s has to be a list" % name)
+                    return
+            try:
+                events = frozenset(events) if events is not None else None
+                devices = frozenset(devices) if devices is not None else None
+            except TypeError as err:
+                # lists of lists or objects
+                self._reply(client, request, error=str(err))
+                return
+            client.events = events
+            client.devices = devices
+            self._reply(client, request, True)
+        elif operation in COMMANDS:
+            task = asyncio.ensure_future(self._execute(client, request, operation))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            self._reply(client, request, error="Unknown operation %r" % operation)
+
+    async def _execute(self, client, request, operation):
+        try:
+            args = [request[name] for name in COMMANDS[operation]]
+            result = await getattr(self.connection, operation)(*args)
+        except Exception as err:
+            self._reply(client, request, error="%s: %s" % (err.__class__.__name__, err))
+            return
+        self._reply(client, request, result)
+
+    def _reply(self, client, request, result=None, error=None):
+        response = {'id': request.get('id')}
+        if error is not None:
+            response['error'] = error
+        else:
+            response['result'] = result
+        self._write(client, _encode(response))
+
+
+def _encode(message):
+    return (json.dumps(message, separators=(',', ':'), default=str) + "\n").encode('utf-8')
+
+
+def _device_id(value):
+    return int(value, 0)
+
+
+def main(argv=None):
+    """Runs the daemon until interrupted"""
+    parser = argparse.ArgumentParser(
+        prog='maxcul', description='Share a CUL stick through a Unix domain socket')
+    parser.add_argument('--device', default=DEFAULT_DEVICE)
+    parser.add_argument('--baudrate', default=DEFAULT_BAUDRATE)
+    parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH)
+    parser.add_argument('--paired', type=_device_id, action='append', default=[],
+                        help='id of a paired device, may be repeated')
+    parser.add_argument('--store', help='sqlite database for device state')
+    parser.add_argument('--journal', help='journal of commands awaiting an ACK')
+    parser.add_argument('--max-buffered', type=int, default=DEFAULT_MAX_BUFFERED)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    async def run():
+        connection = AsyncMaxConnection(
+            args.device, args.baudrate, paired_devices=args.paired,
+            store_path=args.store, journal_path=args.journal)
+        async with connection:
+            daemon = MaxDaemon(connection, args.socket, args.max_buffered)
+            await daemon.start()
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await daemon.stop()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
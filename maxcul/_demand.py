@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.demand
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Heating demand of a whole building derived from the valve positions of
+    all thermostats, as needed to control a boiler or heat pump. The
+    aggregate is updated with every reported valve position instead of
+    being recomputed over all devices, and watchers are only called when
+    it crosses one of their levels.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+from array import array
+
+# environment imports
+import logging
+
+# custom imports
+
+# local constants
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_VALVE_THRESHOLD = 30
+
+MAX_VALVE_POSITION = 100
+
+DEMAND_MAX = 'max'
+DEMAND_MEAN = 'mean'
+DEMAND_ABOVE = 'above'
+
+
+class HeatingDemand(object):
+    """Aggregate of the valve positions of all devices.
+
+    max is the highest valve position, mean the mean weighted by the weight
+    of every device, 1 unless given by set_weight, and above the number of
+    devices with a valve opened further than threshold percent. Updating a
+    device and reading any of them takes constant time."""
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, threshold=DEFAULT_VALVE_THRESHOLD):
+        self.threshold = threshold
+        self._positions = {}
+        self._weights = {}
+        self._histogram = array('I', bytes(4 * (MAX_VALVE_POSITION + 1)))
+        self._max = 0
+        self._weighted_sum = 0.0
+        self._total_weight = 0.0
+        self._above = 0
+        self._watchers = []
+
+    def __len__(self):
+        return len(self._positions)
+
+    @property
+    def max(self):
+        return self._max if self._positions else None
+
+    @property
+    def mean(self):
+        if not self._total_weight:
+            return None
+        return self._weighted_sum / self._total_weight
+
+    @property
+    def above(self):
+        return self._above
+
+    def as_dict(self):
+        return {
+            DEMAND_MAX: self.max,
+            DEMAND_MEAN: self.mean,
+            DEMAND_ABOVE: self.above,
+        }
+
+    def watch(self, aggregate, level, callback):
+        """Calls callback(aggregate, value, above) whenever aggregate, one of
+        DEMAND_MAX, DEMAND_MEAN or DEMAND_ABOVE, rises above level or falls
+        back to it"""
+        value = self.as_dict()[aggregate]
+        self._watchers.append(
+            [aggregate, level, callback, value is not None and value > level])
+
+    def set_weight(self, device_id, weight):
+        """Sets how much a device counts towards the mean, e.g. by the
+        output of its radiator"""
+        position = self._positions.get(device_id)
+        if position is not None:
+            self._remove(device_id, position)
+        self._weights[device_id] = weight
+        if position is not None:
+            self._add(device_id, position)
+            self._notify()
+
+    def update(self, device_id, valve_position):
+        """Records the valve position of a device in percent"""
+        valve_position = max(0, min(MAX_VALVE_POSITION, int(valve_position)))
+        previous = self._positions.get(device_id)
+        if previous == valve_position:
+            return
+        if previous is not None:
+            self._remove(device_id, previous)
+        self._add(device_id, valve_position)
+        self._notify()
+
+    def remove(self, device_id):
+        """Forgets a device"""
+        position = self._positions.get(device_id)
+        if position is None:
+            return
+        self._remove(device_id, position)
+        self._notify()
+
+    def _add(self, device_id, position):
+        weight = self._weights.get(device_id, 1)
+        self._positions[device_id] = position
+        self._histogram[position] += 1
+        if position > self._max:
+            self._max = position
+        self._weighted_sum += weight * position
+        self._total_weight += weight
+        if position > self.threshold:
+            self._above += 1
+
+    def _remove(self, device_id, position):
+        weight = self._weights.get(device_id, 1)
+        del self._positions[device_id]
+        self._histogram[position] -= 1
+        # at most MAX_VALVE_POSITION steps down to the next valve position in use
+        while self._max and not self._histogram[self._max]:
+            self._max -= 1
+        self._weighted_sum -= weight * position
+        self._total_weight -= weight
+        if not self._positions:
+            # no rounding errors left behind once the last device is gone
+            self._weighted_sum = self._total_weight = 0.0
+        if position > self.threshold:
+            self._above -= 1
+
+    def _notify(self):
+        if not self._watchers:
+            return
+        values = self.as_dict()
+        for watcher in self._watchers:
+            aggregate, level, callback, was_above = watcher
+            value = values[aggregate]
+            is_above = value is not None and value > level
+            if is_above == was_above:
+                continue
+            watcher[3] = is_above
+            try:
+                callback(aggregate, value, is_above)
+            except Exception as err:
+                LOGGER.warning("Error while calling heating demand watcher: %s", err)
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.dispatch
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Runs user callbacks on a small pool of worker threads so a slow consumer
+    never delays receiving, acknowledging or answering messages. Events of a
+    single device are always handled by the same worker and thus keep their
+    order. Callback latencies, slow calls, errors and dropped events are
+    exported through the metrics registry.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import queue
+import threading
+import time
+
+# environment imports
+import logging
+
+# custom imports
+from maxcul._const import ATTR_DEVICE_ID
+from maxcul._metrics import MetricsRegistry
+
+# local constants
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MAX_QUEUED_EVENTS = 100
+SLOW_CALLBACK_THRESHOLD = 0.5
+
+
+def _remaining(deadline):
+    """Seconds left until a time.monotonic() deadline, None for no deadline"""
+    if deadline is None:
+        return None
+    return max(0, deadline - time.monotonic())
+
+
+class _WorkerStatistics(object):
+    """Counters owned and updated by a single worker"""
+
+    __slots__ = ('calls', 'errors', 'slow_calls', 'total_latency',
+                 'max_latency', 'total_runtime', 'max_runtime')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.slow_calls = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.total_runtime = 0.0
+        self.max_runtime = 0.0
+
+
+class CallbackDispatcher(object):
+    """Bounded queue in front of a pool of callback worker threads"""
+
+    def __init__(
+            self,
+            callback,
+            workers,
+            max_queued=DEFAULT_MAX_QUEUED_EVENTS,
+            slow_threshold=SLOW_CALLBACK_THRESHOLD,
+            metrics=None):
+        self._callback = callback
+        self._slow_threshold = slow_threshold
+        self._high_watermark = max(1, max_queued // 2)
+        self._queues = [queue.Queue(max_queued) for _ in range(workers)]
+        self._statistics = [_WorkerStatistics() for _ in range(workers)]
+        self._threads = [
+            threading.Thread(
+                target=self._work,
+                args=(index, event_queue, statistics),
+                name="maxcul-callback-%d" % index,
+                daemon=True)
+            for index, (event_queue, statistics) in enumerate(
+                zip(self._queues, self._statistics))]
+        self._dropped = 0
+        # set by the dispatching thread, cleared by the worker of the queue
+        self._falling_behind = [False] * workers
+        self._register_metrics(metrics)
+
+    def _register_metrics(self, metrics):
+        # labeled by worker, each worker only updates its own metrics
+        metrics = metrics if metrics is not None else MetricsRegistry()
+        self._latency = metrics.histogram(
+            'maxcul_callback_latency_seconds',
+            'Time from queueing an event to the end of its callback', ('worker',))
+        self._slow_calls = metrics.counter(
+            'maxcul_callback_slow_calls_total',
+            'Callbacks running longer than the slow threshold', ('worker',))
+        self._errors = metrics.counter(
+            'maxcul_callback_errors_total', 'Callbacks which raised', ('worker',))
+        self._events_dropped = metrics.counter(
+            'maxcul_callback_events_dropped_total',
+            'Events dropped because their worker was too far behind')
+
+    @property
+    def slow_consumer(self):
+        """True while the callback does not keep up with incoming events"""
+        return any(self._falling_behind)
+
+    def start(self):
+        """Starts the worker threads"""
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        """Lets the workers finish pending events and waits up to timeout
+        seconds for them to exit. If a queue is still full once timeout
+        passed, its oldest event is dropped to make room for the stop
+        request."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for event_queue in self._queues:
+            try:
+                event_queue.put(None, timeout=_remaining(deadline))
+                continue
+            except queue.Full:
+                pass
+            while True:
+                try:
+                    event_queue.get_nowait()
+                    self._dropped += 1
+                    self._events_dropped.inc()
+                    LOGGER.warning("Callback worker is stuck, dropping an event to stop it")
+                except queue.Empty:
+                    pass
+                try:
+                    event_queue.put_nowait(None)
+                    break
+                except queue.Full:
+                    continue
+        for thread in self._threads:
+            if thread.is_alive():
+                thread.join(_remaining(deadline))
+
+    def dispatch(self, event, payload):
+        """Queues an event without ever blocking the caller.
+
+        Returns False if the event had to be dropped because the worker
+        responsible for the device is too far behind."""
+        device_id = payload.get(ATTR_DEVICE_ID, 0)
+        index = hash(device_id) % len(self._queues)
+        event_queue = self._queues[index]
+        try:
+            event_queue.put_nowait((time.monotonic(), event, payload))
+        except queue.Full:
+            self._dropped += 1
+            self._events_dropped.inc()
+            LOGGER.warning(
+                "Callback queue is full, dropping %s event for %s",
+                event, device_id)
+            return False
+        backlog = event_queue.qsize()
+        if backlog >= self._high_watermark and not self._falling_behind[index]:
+            self._falling_behind[index] = True
+            LOGGER.warning(
+                "Callback worker %d is falling behind, %d events queued",
+                index, backlog)
+        return True
+
+    def statistics(self):
+        """Returns a snapshot of callback counters and latencies in seconds"""
+        calls = sum(stats.calls for stats in self._statistics)
+        total_latency = sum(stats.total_latency for stats in self._statistics)
+        total_runtime = sum(stats.total_runtime for stats in self._statistics)
+        return {
+            'calls': calls,
+            'errors': sum(stats.errors for stats in self._statistics),
+            'dropped': self._dropped,
+            'slow_calls': sum(stats.slow_calls for stats in self._statistics),
+            'queued': sum(event_queue.qsize() for event_queue in self._queues),
+            'mean_latency': total_latency / calls if calls else 0.0,
+            'max_latency': max(stats.max_latency for stats in self._statistics),
+            'mean_runtime': total_runtime / calls if calls else 0.0,
+            'max_runtime': max(stats.max_runtime for stats in self._statistics),
+        }
+
+    def _work(self, index, event_queue, statistics):
+        worker = str(index)
+        latency_histogram = self._latency.labels(worker)
+        slow_calls = self._slow_calls.labels(worker)
+        errors = self._errors.labels(worker)
+        while True:
+            item = event_queue.get()
+            if item is None:
+                # every event before the stop request was handled
+                self._falling_behind[index] = False
+                return
+            queued_at, event, payload = item
+            started = time.monotonic()
+            try:
+                self._callback(event, payload)
+            except Exception as err:
+                statistics.errors += 1
+                errors.inc()
+                LOGGER.warning(
+                    "Error while calling callback for %s: %s", event, err)
+            finished = time.monotonic()
+            runtime = finished - started
+            latency = finished - queued_at
+            statistics.calls += 1
+            statistics.total_runtime += runtime
+            statistics.total_latency += latency
+            latency_histogram.observe(latency)
+            if runtime > statistics.max_runtime:
+                statistics.max_runtime = runtime
+            if latency > statistics.max_latency:
+                statistics.max_latency = latency
+            if runtime > self._slow_threshold:
+                statistics.slow_calls += 1
+                slow_calls.inc()
+                LOGGER.debug(
+                    "Callback for %s took %.3fs", event, runtime)
+            if self._falling_behind[index] and event_queue.empty():
+                self._falling_behind[index] = False
+                LOGGER.info("Callback worker %d caught up with pending events", index)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.diversity
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Several CUL sticks spread over a building act as a single one. A frame
+    heard by more than one stick is processed once, every stick remembers
+    how well it hears each device and commands leave through the stick
+    closest to their receiver which still has send budget left. Each stick
+    has a 1% budget of its own, so traffic spreads across all of them.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+from collections import OrderedDict
+
+# environment imports
+
+# custom imports
+from maxcul._io import rssi_to_dbm
+
+# local constants
+# copies of a frame heard by several sticks arrive within this many seconds
+DUPLICATE_WINDOW = 0.5
+
+# signal strengths older than this many seconds are not used for routing
+RSSI_MAX_AGE = 3600
+
+
+def frame_key(line):
+    """Returns (sender, counter, message type) of a received Z line, None if
+    the line is too short to tell"""
+    try:
+        return int(line[9:15], 16), int(line[3:5], 16), int(line[7:9], 16)
+    except ValueError:
+        return None
+
+
+def receiver_of(raw_message):
+    """Returns the receiver id of an encoded message"""
+    try:
+        return int(raw_message[15:21], 16)
+    except ValueError:
+        return None
+
+
+class DuplicateFilter(object):
+    """Remembers frames seen within the last window seconds"""
+
+    def __init__(self, window=DUPLICATE_WINDOW):
+        self.window = window
+        self._seen = OrderedDict()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def first_copy(self, key, now):
+        """Returns True unless key was seen within the window"""
+        seen = self._seen
+        # entries are kept in the order they were seen, expired ones first
+        while seen:
+            oldest_key, seen_at = next(iter(seen.items()))
+            if seen_at + self.window > now:
+                break
+            del seen[oldest_key]
+        if key in seen:
+            return False
+        seen[key] = now
+        return True
+
+
+class StickRouter(object):
+    """Deduplicates received frames and picks the stick to transmit through.
+
+    sticks need is_alive(), has_send_budget and send_budget like
+    CulIoThread."""
+
+    def __init__(self, sticks, window=DUPLICATE_WINDOW, max_age=RSSI_MAX_AGE):
+        self.sticks = list(sticks)
+        self.max_age = max_age
+        self._duplicates = DuplicateFilter(window)
+        self._heard = {}
+
+    def receive(self, stick, line, now):
+        """Records the signal strength of a frame heard by stick and returns
+        True if it is the first copy of the frame"""
+        key = frame_key(line)
+        if key is None:
+            return True
+        try:
+            rssi = rssi_to_dbm(int(line[-2:], 16))
+        except ValueError:
+            rssi = None
+        if rssi is not None:
+            self._heard.setdefault(key[0], {})[stick] = (rssi, now)
+        return self._duplicates.first_copy(key, now)
+
+    def signal_strengths(self, device_id, now):
+        """Returns the recent signal strength of a device in dBm by stick"""
+        return dict(
+            (stick, rssi)
+            for stick, (rssi, heard_at) in self._heard.get(device_id, {}).items()
+            if heard_at + self.max_age > now)
+
+    def route(self, device_id, now):
+        """Returns the stick to send a frame for device_id through: the one
+        hearing the device best among those with send budget left, the one
+        with the most budget left if none of them heard it recently"""
+        candidates = [stick for stick in self.sticks if stick.is_alive()] \
+            or self.sticks
+        heard = self.signal_strengths(device_id, now)
+
+        def rank(stick):
+            rssi = heard.get(stick)
+            return (stick.has_send_budget, rssi is not None,
+                    rssi if rssi is not None else 0, stick.send_budget)
+        return max(candidates, key=rank)
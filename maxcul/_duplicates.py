@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.duplicates
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Devices repeat a frame with the same counter when our ACK reaches them
+    too late or not at all. Recently received frames are remembered along
+    with the response they got, so a repeated frame is answered again
+    straight from the cache without being decoded or reported a second time.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+from collections import OrderedDict
+
+# environment imports
+
+# custom imports
+
+# local constants
+DEFAULT_TTL = 10
+DEFAULT_MAX_ENTRIES = 256
+
+
+class ReceivedFrame(object):
+    """A remembered frame and the encoded response it was answered with"""
+
+    __slots__ = ('expires', 'response')
+
+    def __init__(self, expires):
+        self.expires = expires
+        self.response = None
+
+
+class ReceiveCache(object):
+    """Frames received within the last ttl seconds keyed by (sender, counter,
+    message type). At most max_entries frames are kept, the least recently
+    seen ones are evicted first."""
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._frames = OrderedDict()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def lookup(self, key, now):
+        """Returns the ReceivedFrame if key was received within ttl, None
+        otherwise"""
+        frame = self._frames.get(key)
+        if frame is None:
+            return None
+        if frame.expires <= now:
+            del self._frames[key]
+            return None
+        self._frames.move_to_end(key)
+        return frame
+
+    def add(self, key, now):
+        """Remembers a received frame and returns its ReceivedFrame"""
+        frame = self._frames[key] = ReceivedFrame(now + self.ttl)
+        self._frames.move_to_end(key)
+        while len(self._frames) > self.max_entries:
+            self._frames.popitem(last=False)
+        return frame
@@ -42,3 +42,9 @@ class MissingPayloadParameterError(MoritzError):
     """Parameter missing to construct message"""
 
     pass
+
+
+class CommunicationError(MoritzError):
+    """Unable to communicate with the CUL device"""
+
+    pass
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.fastpath
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Responses which have to reach a device within a few milliseconds. The
+    IO thread recognises frames asking for an ACK or a PairPong by their raw
+    header and answers them right away, without decoding the message or
+    waiting for the connection thread.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import threading
+import time
+
+# environment imports
+
+# custom imports
+from maxcul._messages import (
+    PairPingMessage, PairPongMessage, AckMessage,
+    SetTemperatureMessage, ThermostatStateMessage,
+    ShutterContactStateMessage, PushButtonStateMessage,
+    WallThermostatStateMessage, WallThermostatControlMessage,
+    MORITZ_MESSAGE_CLASSES
+)
+from maxcul._const import DEVICE_TYPES_BY_NAME
+from maxcul._diversity import DuplicateFilter, frame_key
+
+# local constants
+PAIR_PING = MORITZ_MESSAGE_CLASSES[PairPingMessage]
+PAIR_PONG = MORITZ_MESSAGE_CLASSES[PairPongMessage]
+ACK = MORITZ_MESSAGE_CLASSES[AckMessage]
+
+# messages the default handlers acknowledge
+ACK_REQUIRED = frozenset(MORITZ_MESSAGE_CLASSES[klass] for klass in (
+    SetTemperatureMessage,
+    ThermostatStateMessage,
+    ShutterContactStateMessage,
+    PushButtonStateMessage,
+    WallThermostatStateMessage,
+    WallThermostatControlMessage,
+))
+
+
+class FastResponder(object):
+    """Builds ACK and PairPong frames straight from received CUL lines.
+
+    paired_devices is replaced as a whole whenever a device pairs, so the IO
+    thread never sees it half updated.
+
+    With a duplicate_window, the responder may be shared by the IO threads of
+    several sticks and only the first one hearing a frame answers it."""
+
+    def __init__(self, sender_id, paired_devices, pairing_enabled, duplicate_window=0):
+        self.sender_id = sender_id
+        self.paired_devices = frozenset(paired_devices)
+        self._pairing_enabled = pairing_enabled
+        self._pong_payload = "%02d" % DEVICE_TYPES_BY_NAME['Cube']
+        self._duplicates = None
+        if duplicate_window:
+            self._duplicates = DuplicateFilter(duplicate_window)
+            self._lock = threading.Lock()
+
+    def respond(self, line):
+        """Returns the frame answering a received Z line or None"""
+        response = self._respond(line)
+        if response is None or self._duplicates is None:
+            return response
+        with self._lock:
+            if self._duplicates.first_copy(frame_key(line), time.monotonic()):
+                return response
+        return None
+
+    def _respond(self, line):
+        try:
+            counter = int(line[3:5], 16)
+            msg_type = int(line[7:9], 16)
+            device_id = int(line[9:15], 16)
+            receiver_id = int(line[15:21], 16)
+            group_id = int(line[21:23], 16)
+        except ValueError:
+            return None
+        if msg_type in ACK_REQUIRED:
+            if device_id not in self.paired_devices or \
+                    receiver_id not in (0, self.sender_id):
+                return None
+            return "Zs0A%02X%02X%02X%06X%06X%02X" % (
+                counter, 0x4 if group_id else 0x0, ACK,
+                self.sender_id, device_id, group_id)
+        if msg_type == PAIR_PING:
+            if receiver_id == self.sender_id or \
+                    (receiver_id == 0 and self._pairing_enabled()):
+                return "Zs0B%02X00%02X%06X%06X%02X%s" % (
+                    (counter + 1) & 0xFF, PAIR_PONG,
+                    self.sender_id, device_id, group_id, self._pong_payload)
+        return None
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.groups
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Bookkeeping for group addressed commands. Devices sharing a group id
+    (usually all devices of a room) are reached by a single frame, each of
+    them acknowledges it individually.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+
+# environment imports
+
+# custom imports
+
+# local constants
+NO_GROUP = 0
+
+
+class GroupIndex(object):
+    """Members of every group by group id"""
+
+    def __init__(self):
+        self._members = {}
+        self._group_of = {}
+
+    def assign(self, device_id, group_id):
+        """Moves a device into a group, NO_GROUP removes it from its group"""
+        previous = self._group_of.pop(device_id, NO_GROUP)
+        if previous != NO_GROUP:
+            members = self._members[previous]
+            members.discard(device_id)
+            if not members:
+                del self._members[previous]
+        if group_id != NO_GROUP:
+            self._group_of[device_id] = group_id
+            self._members.setdefault(group_id, set()).add(device_id)
+
+    def group_of(self, device_id):
+        return self._group_of.get(device_id, NO_GROUP)
+
+    def members(self, group_id):
+        return frozenset(self._members.get(group_id, ()))
+
+    def as_dict(self):
+        return dict(
+            (group_id, frozenset(members))
+            for group_id, members in self._members.items())
+
+
+class GroupCommand(object):
+    """A group addressed command and the members which did not ACK it yet"""
+
+    __slots__ = ('msg', 'sent', 'pending', 'failed', 'retrying')
+
+    def __init__(self, msg, members, sent):
+        self.msg = msg
+        self.sent = sent
+        self.pending = set(members)
+        self.failed = set()
+        self.retrying = False
+
+    def member_finished(self, device_id, acknowledged):
+        """Marks a member as done, returns True once no member is pending"""
+        self.pending.discard(device_id)
+        if not acknowledged:
+            self.failed.add(device_id)
+        return not self.pending
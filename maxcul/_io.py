@@ -5,6 +5,11 @@ import threading
 import time
 import logging
 from serial import Serial, SerialException
+from maxcul._metrics import MetricsRegistry
+from maxcul._tracing import Tracer
+from maxcul._const import (
+    DIRECTION_RECEIVE, STAGE_READ, STAGE_FRAMED, STAGE_ENQUEUED, STAGE_WRITTEN
+)
 
 LOGGER = logging.getLogger(__name__)
 
@@ -13,16 +18,46 @@ READLINE_TIMEOUT = 0.5
 
 COMMAND_REQUEST_BUDGET = 'X'
 
+# regular and fast (no wake-up preamble) transmission of a frame
+SEND_COMMANDS = ("Zs", "Zf")
+
 MIN_REQUIRED_BUDGET = 1000
 
+# enable reporting of message strength, receive Moritz messages and
+# disable FHT mode by setting station to 0000
+INIT_COMMANDS = ("X21", "Zr", "T01")
+
+
+def parse_budget(line):
+    """Returns the remaining send budget in ms if line is a budget report, None otherwise"""
+    if line.startswith("21  "):
+        return int(line[3:].strip()) * 10 or 1
+    return None
+
+
+def rssi_to_dbm(raw):
+    """Converts the signal strength byte reported by the CUL into dBm"""
+    if raw >= 128:
+        raw -= 256
+    return raw / 2.0 - 74
+
 
 class CulIoThread(threading.Thread):
-    """Low-level serial communication thread base"""
+    """Low-level serial communication thread base.
+
+    Received frames are put on read_queue as (line, answered, trace, thread,
+    read_at) tuples, read_at being the time.monotonic() time the line was
+    read. Several threads may share a read_queue. With a responder, frames
+    it has an answer for are answered right away by this thread and marked
+    as answered. Traffic is counted in metrics, frames are traced while
+    tracer has hooks."""
 
     # pylint: disable=too-many-instance-attributes
-    def __init__(self, device_path, baudrate):
+    def __init__(self, device_path, baudrate, responder=None, metrics=None,
+                 tracer=None, read_queue=None):
         super().__init__()
-        self.read_queue = queue.Queue()
+        self.read_queue = read_queue if read_queue is not None else queue.Queue()
+        self._responder = responder
         self._send_queue = deque([], MAX_QUEUED_COMMANDS)
         self._device_path = device_path
         self._baudrate = baudrate
@@ -30,6 +65,24 @@ class CulIoThread(threading.Thread):
         self._cul_version = None
         self._com_port = None
         self._remaining_budget = 0
+        self.tracer = tracer if tracer is not None else Tracer()
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        # labeled by device path, several sticks may share a registry
+        self._lines_received = self.metrics.counter(
+            'maxcul_cul_lines_received_total', 'Lines read from the CUL',
+            ('device',)).labels(device_path)
+        self._frames_written = self.metrics.counter(
+            'maxcul_cul_frames_written_total', 'Frames written to the CUL',
+            ('device',)).labels(device_path)
+        self._fast_responses = self.metrics.counter(
+            'maxcul_cul_fast_responses_total', 'Frames answered by the IO thread',
+            ('device',)).labels(device_path)
+        self.metrics.gauge(
+            'maxcul_cul_send_queue_depth', 'Frames waiting to be written',
+            ('device',)).labels(device_path).function = lambda: len(self._send_queue)
+        self.metrics.gauge(
+            'maxcul_cul_send_budget_ms', 'Last known remaining 1% budget',
+            ('device',)).labels(device_path).function = lambda: self._remaining_budget
 
     @property
     def cul_version(self):
@@ -41,9 +94,19 @@ class CulIoThread(threading.Thread):
         """Ask CUL if we have enough budget of the 1 percent rule left"""
         return self._remaining_budget >= 2000
 
-    def enqueue_command(self, command):
+    @property
+    def send_budget(self):
+        """Last known remaining budget of the 1 percent rule in ms"""
+        return self._remaining_budget
+
+    @property
+    def pending_commands(self):
+        """Number of commands waiting to be sent"""
+        return len(self._send_queue)
+
+    def enqueue_command(self, command, trace=None):
         """Pushes a new command to be sent to the CUL stick onto the queue"""
-        self._send_queue.appendleft(command)
+        self._send_queue.appendleft((command, trace))
 
     def stop(self, timeout=None):
         """Stops the loop of this thread and waits for it to exit"""
@@ -72,22 +135,53 @@ class CulIoThread(threading.Thread):
         # Process pending received messages (if any)
         line = self._readline()
         if line is not None:
-            if line.startswith("21  "):
-                self._remaining_budget = int(line[3:].strip()) * 10 or 1
+            read_at = time.monotonic()
+            self._lines_received.inc()
+            budget = parse_budget(line)
+            if budget is not None:
+                self._remaining_budget = budget
                 LOGGER.debug(
                     "Got pending budget: %sms", self._remaining_budget)
             elif line.startswith("Z"):
-                self.read_queue.put(line)
+                trace = None
+                if self.tracer.hooks:
+                    trace = self.tracer.start(DIRECTION_RECEIVE, line)
+                if trace is not None:
+                    trace.mark(STAGE_READ, read_at)
+                    trace.mark(STAGE_FRAMED)
+                answered = self._answer(line)
+                if trace is not None:
+                    trace.mark(STAGE_ENQUEUED)
+                self.read_queue.put((line, answered, trace, self, read_at))
             else:
                 LOGGER.debug("Got unhandled response from CUL: '%s'", line)
 
+    def _answer(self, line):
+        """Writes the fast path response to a received frame, if any"""
+        if self._responder is None:
+            return False
+        response = self._responder.respond(line)
+        if response is None:
+            return False
+        cost = len(response) * 10
+        budget = self._remaining_budget
+        if budget <= cost:
+            return False
+        self._writeline(response)
+        self._fast_responses.inc()
+        # the frame costs about as much as it would be charged by the CUL
+        self._remaining_budget = budget - cost
+        return True
+
     def _send_pending_message(self):
         try:
-            pending_message = self._send_queue.pop()
+            pending_message, trace = self._send_queue.pop()
             if self._remaining_budget > len(pending_message) * 10:
                 self._writeline(pending_message)
+                if trace is not None:
+                    trace.mark(STAGE_WRITTEN)
             else:
-                self._send_queue.append(pending_message)
+                self._send_queue.append((pending_message, trace))
                 self._writeline(COMMAND_REQUEST_BUDGET)
         except IndexError:
             pass
@@ -126,15 +220,9 @@ class CulIoThread(threading.Thread):
             self._com_port.close()
             self._com_port = None
             return False
-        # enable reporting of message strength
-        self._writeline("X21")
-        time.sleep(0.3)
-        # receive Moritz messages
-        self._writeline("Zr")
-        time.sleep(0.3)
-        # disable FHT mode by setting station to 0000
-        self._writeline("T01")
-        time.sleep(0.3)
+        for command in INIT_COMMANDS:
+            self._writeline(command)
+            time.sleep(0.3)
         return True
 
     def _reopen_serial_device(self):
@@ -153,9 +241,10 @@ class CulIoThread(threading.Thread):
         return False
 
     def _writeline(self, command):
-        """Sends given command to CUL. Invalidates has_send_budget if command starts with Zs"""
+        """Sends given command to CUL. Invalidates has_send_budget if command sends a frame"""
         LOGGER.debug("Writing command %s", command)
-        if command.startswith("Zs"):
+        if command.startswith(SEND_COMMANDS):
+            self._frames_written.inc()
             self._remaining_budget = 0
         try:
             self._com_port.write((command + "\r\n").encode())
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.journal
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Write-ahead journal of commands still waiting for their ACK. Every change
+    is appended as a JSON line by a writer thread which fsyncs once per batch,
+    so journaling adds no latency to sending a command. The journal is
+    compacted when it is opened and whenever it grew much larger than the set
+    of commands still in flight.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import json
+import os
+import queue
+import threading
+import time
+
+# environment imports
+import logging
+
+# custom imports
+from maxcul._const import PRIORITY_NORMAL
+
+# local constants
+LOGGER = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 500
+MIN_COMPACTION_RECORDS = 1000
+
+_STOP = object()
+
+
+class CommandJournal(object):
+    """Append-only journal of outstanding commands keyed by (receiver, counter)"""
+
+    def __init__(self, path):
+        self._path = path
+        self._queue = queue.Queue()
+        self._thread = None
+        self._live = self._read()
+        self._file = None
+        self._records = 0
+        self._compact()
+
+    def load(self):
+        """Returns (frame, attempt, due, deadline, priority) for every command
+        still in flight, due is the wall clock time of the next transmission
+        and deadline the one after which the command is worthless or None"""
+        return [(entry['frame'], entry['attempt'], entry['due'],
+                 entry.get('deadline'), entry.get('priority', PRIORITY_NORMAL))
+                for entry in self._live.values()]
+
+    def start(self):
+        """Starts the writer thread"""
+        if self._thread is None:
+            self._open()
+            self._thread = threading.Thread(
+                target=self._write_loop, name="maxcul-journal", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Writes all pending records, stops the writer thread and closes
+        the journal"""
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+            self._thread = None
+        else:
+            self._close()
+
+    def record(self, msg, frame, attempt, due, deadline=None, priority=PRIORITY_NORMAL):
+        """Records that msg awaits an ACK and will be sent again at due,
+        deadline is a wall clock time as well"""
+        self._queue.put({
+            'key': [msg.receiver_id, msg.counter],
+            'frame': frame,
+            'attempt': attempt,
+            'due': due,
+            'deadline': deadline,
+            'priority': priority,
+        })
+
+    def forget(self, msg):
+        """Records that msg no longer awaits an ACK"""
+        self._queue.put({'key': [msg.receiver_id, msg.counter]})
+
+    def flush(self):
+        """Synchronously writes all queued records, for use without writer thread"""
+        self._open()
+        self._write_batch(self._drain([]))
+
+    def _read(self):
+        live = {}
+        try:
+            with open(self._path, 'r') as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn write at the end of the journal
+                        LOGGER.warning("Ignoring damaged journal record %r", line)
+                        continue
+                    self._apply(live, entry)
+        except FileNotFoundError:
+            pass
+        return live
+
+    @staticmethod
+    def _apply(live, entry):
+        key = tuple(entry['key'])
+        if 'frame' in entry:
+            live[key] = entry
+        else:
+            live.pop(key, None)
+
+    def _compact(self):
+        self._close()
+        temporary = self._path + '.tmp'
+        with open(temporary, 'w') as journal:
+            for entry in self._live.values():
+                journal.write(json.dumps(entry) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temporary, self._path)
+        self._open()
+        self._records = len(self._live)
+
+    def _drain(self, batch):
+        while len(batch) < MAX_BATCH_SIZE:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_loop(self):
+        try:
+            stop = False
+            while not stop:
+                batch = self._drain([self._queue.get()])
+                stop = _STOP in batch
+                self._write_batch([entry for entry in batch if entry is not _STOP])
+            while not self._queue.empty():
+                self._write_batch(self._drain([]))
+        finally:
+            self._close()
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self._path, 'a')
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        try:
+            for entry in batch:
+                self._apply(self._live, entry)
+                self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._records += len(batch)
+            if self._records > max(MIN_COMPACTION_RECORDS, 4 * len(self._live)):
+                self._compact()
+        except OSError as err:
+            LOGGER.error("Unable to write command journal: %s", err)
+
+
+def wall_clock_due(due):
+    """Converts a time.monotonic() based deadline into wall clock time"""
+    return time.time() + due - time.monotonic()
+
+
+def monotonic_due(due):
+    """Converts a wall clock deadline into a time.monotonic() based one"""
+    return time.monotonic() + due - time.time()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.links
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Recent history of the radio link to every device. Signal strength and
+    receive time of the last frames and the outcome of the last
+    transmissions are kept in fixed size ring buffers, the statistics over
+    them are maintained while recording so reading them costs constant time.
+    A link getting weaker or losing frames shows up here long before it
+    causes a storm of retransmissions.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+from array import array
+import math
+
+# environment imports
+
+# custom imports
+from maxcul._io import rssi_to_dbm
+
+# local constants
+DEFAULT_HISTORY_SIZE = 64
+
+# raw signal strength bytes ordered by the dBm value they stand for
+_RAW_BY_DBM = tuple(range(128, 256)) + tuple(range(128))
+
+
+def _signed(raw):
+    return raw - 256 if raw >= 128 else raw
+
+
+class LinkHistory(object):
+    """Ring buffers of the last size frames received from a device and of
+    the last size transmissions to it.
+
+    Signal strength is recorded as the raw byte reported by the CUL, a
+    histogram over those 256 possible values makes percentiles independent
+    of the history size."""
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, size=DEFAULT_HISTORY_SIZE):
+        self.size = size
+        self._signal = array('B', bytes(size))
+        self._seen = array('d', bytes(8 * size))
+        self._histogram = array('I', bytes(4 * 256))
+        self._frames = 0
+        self._signal_sum = 0
+        self._lost = array('B', bytes(size))
+        self._transmissions = 0
+        self._lost_sum = 0
+
+    @property
+    def frames(self):
+        """Number of frames in the history"""
+        return min(self._frames, self.size)
+
+    @property
+    def transmissions(self):
+        """Number of transmissions in the history"""
+        return min(self._transmissions, self.size)
+
+    def record_frame(self, signal_strength, timestamp):
+        """Adds a received frame, timestamp is a time.monotonic() value"""
+        index = self._frames % self.size
+        if self._frames >= self.size:
+            old = self._signal[index]
+            self._histogram[old] -= 1
+            self._signal_sum -= _signed(old)
+        self._signal[index] = signal_strength
+        self._seen[index] = timestamp
+        self._histogram[signal_strength] += 1
+        self._signal_sum += _signed(signal_strength)
+        self._frames += 1
+
+    def record_transmission(self, lost):
+        """Adds the outcome of a transmission, lost if it was not acknowledged"""
+        index = self._transmissions % self.size
+        if self._transmissions >= self.size:
+            self._lost_sum -= self._lost[index]
+        self._lost[index] = 1 if lost else 0
+        self._lost_sum += self._lost[index]
+        self._transmissions += 1
+
+    @property
+    def last_rssi(self):
+        """Signal strength of the last frame in dBm or None"""
+        if not self._frames:
+            return None
+        return rssi_to_dbm(self._signal[(self._frames - 1) % self.size])
+
+    @property
+    def last_seen(self):
+        """Receive time of the last frame or None"""
+        if not self._frames:
+            return None
+        return self._seen[(self._frames - 1) % self.size]
+
+    def mean_rssi(self):
+        """Mean signal strength over the history in dBm or None"""
+        if not self._frames:
+            return None
+        # the mean of signed raw values lies within the signed byte range
+        return rssi_to_dbm(self._signal_sum / float(self.frames))
+
+    def percentile_rssi(self, percent):
+        """Signal strength in dBm which percent of the frames in the history
+        did not exceed, None if no frame was received"""
+        frames = self.frames
+        if not frames:
+            return None
+        rank = max(1, int(math.ceil(percent / 100.0 * frames)))
+        total = 0
+        for raw in _RAW_BY_DBM:
+            total += self._histogram[raw]
+            if total >= rank:
+                return rssi_to_dbm(raw)
+        return None
+
+    def frame_interval(self):
+        """Mean time between the frames in the history or None"""
+        frames = self.frames
+        if frames < 2:
+            return None
+        oldest = self._seen[(self._frames - frames) % self.size]
+        return (self.last_seen - oldest) / (frames - 1)
+
+    def loss_ratio(self):
+        """Share of transmissions in the history which were not
+        acknowledged, None if nothing was sent"""
+        transmissions = self.transmissions
+        if not transmissions:
+            return None
+        return self._lost_sum / float(transmissions)
+
+    def rssi_values(self):
+        """Returns signal strengths in dBm in the order they were received"""
+        frames = self.frames
+        start = self._frames - frames
+        return [rssi_to_dbm(self._signal[index % self.size])
+                for index in range(start, self._frames)]
+
+    def statistics(self):
+        return {
+            'frames': self.frames,
+            'last_rssi': self.last_rssi,
+            'mean_rssi': self.mean_rssi(),
+            'median_rssi': self.percentile_rssi(50),
+            'low_rssi': self.percentile_rssi(10),
+            'frame_interval': self.frame_interval(),
+            'transmissions': self.transmissions,
+            'loss_ratio': self.loss_ratio(),
+        }
+
+
+class LinkMonitor(object):
+    """Link histories indexed by device id"""
+
+    def __init__(self, size=DEFAULT_HISTORY_SIZE):
+        self.size = size
+        self._histories = {}
+
+    def __len__(self):
+        return len(self._histories)
+
+    def __contains__(self, device_id):
+        return device_id in self._histories
+
+    def get(self, device_id):
+        """Returns the LinkHistory of a device or None if nothing was recorded"""
+        return self._histories.get(device_id)
+
+    def record_frame(self, device_id, signal_strength, timestamp):
+        self._history(device_id).record_frame(signal_strength, timestamp)
+
+    def record_transmission(self, device_id, lost):
+        self._history(device_id).record_transmission(lost)
+
+    def statistics(self):
+        """Returns the statistics of every device keyed by device id"""
+        return dict(
+            (device_id, history.statistics())
+            for device_id, history in list(self._histories.items()))
+
+    def _history(self, device_id):
+        history = self._histories.get(device_id)
+        if history is None:
+            history = self._histories[device_id] = LinkHistory(self.size)
+        return history
@@ -48,7 +48,7 @@ class MoritzMessage(object):
     def decode_message(input_string):
         """Decodes given message and returns content in matching message class"""
 
-        if input_string.startswith("Zs"):
+        if input_string.startswith(("Zs", "Zf")):
             # outgoing messages can be parsed too, just cut the Z off as it
             # doesn't matter
             input_string = input_string[1:]
@@ -98,8 +98,7 @@ class MoritzMessage(object):
     def encode_message(self):
         """Prepare message to be sent on wire"""
 
-        msg_ids = dict((v, k) for k, v in MORITZ_MESSAGE_IDS.items())
-        msg_id = msg_ids[self.__class__]
+        msg_id = MORITZ_MESSAGE_CLASSES[self.__class__]
 
         message = ""
         for (var, length) in ((self.counter, 2), (self.flag, 2), (msg_id, 2),
@@ -251,7 +250,7 @@ class ConfigTemperaturesMessage(MoritzMessage):
     max_Temperature = 0
     min_Temperature = 0
     measurement_Offset = 0
-    window_open_Temperature = 0
+    window_Open_Temperature = 0
     window_Open_Duration = 0
 
     @staticmethod
@@ -263,7 +262,7 @@ class ConfigTemperaturesMessage(MoritzMessage):
          offset,
          window_Open_Temperature,
          window_Open_Duration) = struct.unpack(">BBBBBBB",
-                                               bytearray.fromhex(self.payload[:14]))
+                                               bytearray.fromhex(payload[:14]))
 
         result = {
             'comfort_Temperature': comfort / 2,
@@ -297,9 +296,9 @@ class ConfigTemperaturesMessage(MoritzMessage):
         if self.measurement_Offset is None:
             raise MissingPayloadParameterError(
                 "Missing measurement_Offset in payload")
-        if self.window_Open_Temperatur is None:
+        if self.window_Open_Temperature is None:
             raise MissingPayloadParameterError(
-                "Missing window_Open_Temperatur in payload")
+                "Missing window_Open_Temperature in payload")
         if self.window_Open_Duration is None:
             raise MissingPayloadParameterError(
                 "Missing window_Open_Duration in payload")
@@ -329,7 +328,18 @@ class ConfigValveMessage(MoritzMessage):
 
     @staticmethod
     def decode_payload(payload):
-        pass
+        boost, decalc, max_valve_position, valve_offset = struct.unpack(
+            ">BBBB", bytearray.fromhex(payload[:8]))
+        boost_durations = dict((v, k) for k, v in BOOST_DURATION.items())
+        decalc_days = dict((v, k) for k, v in DECALC_DAYS.items())
+        return {
+            'boost_duration': boost_durations[boost >> 5],
+            'boost_valve_position': (boost & 0x1F) * 5,
+            'decalc_day': decalc_days[decalc >> 5],
+            'decalc_hour': decalc & 0x1F,
+            'max_valve_position': round(max_valve_position * 100 / 255),
+            'valve_offset': round(valve_offset * 100 / 255)
+        }
 
     @property
     def flag(self):
@@ -371,7 +381,10 @@ class AddLinkPartnerMessage(MoritzMessage):
 
     @staticmethod
     def decode_payload(payload):
-        pass
+        return {
+            'assocDevice': int(payload[:6], 16),
+            'assocDeviceType': DEVICE_TYPES[int(payload[6:8], 16)]
+        }
 
     @property
     def flag(self):
@@ -386,11 +399,7 @@ class AddLinkPartnerMessage(MoritzMessage):
                 "Missing assocDeviceType in payload")
 
         assocDevice = "%0.6X" % int(self.assocDevice)
-        assocDeviceType = "%0.2X" % list(
-            DEVICE_TYPES.keys())[
-            list(
-                DEVICE_TYPES.values()).index(
-                self.assocDeviceType)]
+        assocDeviceType = "%0.2X" % DEVICE_TYPES_BY_NAME[self.assocDeviceType]
         return assocDevice + assocDeviceType
 
 
@@ -401,7 +410,10 @@ class RemoveLinkPartnerMessage(MoritzMessage):
 
     @staticmethod
     def decode_payload(payload):
-        pass
+        return {
+            'assocDevice': int(payload[:6], 16),
+            'assocDeviceType': DEVICE_TYPES[int(payload[6:8], 16)]
+        }
 
     @property
     def flag(self):
@@ -415,8 +427,8 @@ class RemoveLinkPartnerMessage(MoritzMessage):
             raise MissingPayloadParameterError(
                 "Missing assocDeviceType in payload")
 
-        assocDevice = self.assocDevice
-        assocDeviceType = "%0.2X" % DEVICE_TYPES[self.assocDeviceType]
+        assocDevice = "%0.6X" % int(self.assocDevice)
+        assocDeviceType = "%0.2X" % DEVICE_TYPES_BY_NAME[self.assocDeviceType]
         return assocDevice + assocDeviceType
 
 
@@ -426,7 +438,7 @@ class SetGroupIdMessage(MoritzMessage):
 
     @staticmethod
     def decode_payload(payload):
-        return {'group_id': int(payload[0], 16)}
+        return {'new_group_id': int(payload[:2], 16)}
 
     @property
     def flag(self):
@@ -444,7 +456,7 @@ class RemoveGroupIdMessage(MoritzMessage):
 
     @staticmethod
     def decode_payload(payload):
-        pass
+        return {}
 
     @property
     def flag(self):
@@ -566,6 +578,7 @@ class PushButtonStateMessage(MoritzMessage):
 
     @staticmethod
     def decode_payload(payload):
+        payload = bytearray.fromhex(payload)
         return {
             'state': bool(payload[1] & 0x1),
             'rferror': bool(payload[0] & 0b100000),
@@ -720,7 +733,10 @@ class SetDisplayActualTemperatureMessage(MoritzMessage):
 
 
 class WakeUpMessage(MoritzMessage):
-    pass
+
+    @staticmethod
+    def decode_payload(payload):
+        return {}
 
 
 class ResetMessage(MoritzMessage):
@@ -769,3 +785,4 @@ MORITZ_MESSAGE_IDS = {
     0xF0: ResetMessage,
     # 0xFF: TestMessage,
 }
+MORITZ_MESSAGE_CLASSES = dict((v, k) for k, v in MORITZ_MESSAGE_IDS.items())
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.metrics
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Counters, gauges and histograms describing a running connection. Updating
+    a metric is a single attribute update, everything else happens when the
+    metrics are read as a dict or in the Prometheus text format, either from
+    a file or through a local HTTP handler.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler
+import os
+
+# environment imports
+
+# custom imports
+
+# local constants
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter(object):
+    """Monotonically increasing value"""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def collect(self):
+        return self.value
+
+
+class Gauge(object):
+    """Value which goes up and down, or is read from function when collected"""
+
+    __slots__ = ('value', 'function')
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def collect(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Histogram(object):
+    """Distribution of observed values in fixed buckets"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def collect(self):
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'buckets': cumulative, 'sum': self.sum, 'count': self.count}
+
+
+class MetricFamily(object):
+    """All metrics sharing a name, one per combination of label values"""
+
+    def __init__(self, kind, name, documentation, label_names, factory):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._factory = factory
+        self._children = {}
+
+    def labels(self, *values):
+        """Returns the metric for the given label values"""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._factory()
+        return child
+
+    def collect(self):
+        return [(values, child.collect())
+                for values, child in list(self._children.items())]
+
+
+class MetricsRegistry(object):
+    """Named metric families of a connection"""
+
+    def __init__(self):
+        self._families = {}
+
+    def counter(self, name, documentation, label_names=()):
+        """Returns a Counter, or its MetricFamily if label_names are given"""
+        return self._register('counter', name, documentation, label_names, Counter)
+
+    def gauge(self, name, documentation, label_names=(), function=None):
+        """Returns a Gauge, or its MetricFamily if label_names are given. A
+        gauge with function reports its result whenever it is collected."""
+        gauge = self._register(
+            'gauge', name, documentation, label_names,
+            lambda: Gauge(function))
+        if function is not None and not label_names:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        """Returns a Histogram, or its MetricFamily if label_names are given"""
+        return self._register(
+            'histogram', name, documentation, label_names,
+            lambda: Histogram(buckets))
+
+    def snapshot(self):
+        """Returns the current values by metric name. Unlabeled metrics map
+        to their value, labeled ones to a dict keyed by label values."""
+        result = {}
+        for name, family in list(self._families.items()):
+            values = family.collect()
+            if family.label_names:
+                result[name] = dict(values)
+            elif values:
+                result[name] = values[0][1]
+        return result
+
+    def prometheus_text(self):
+        """Returns all metrics in the Prometheus text exposition format"""
+        lines = []
+        for name, family in sorted(self._families.items()):
+            lines.append("# HELP %s %s" % (name, family.documentation))
+            lines.append("# TYPE %s %s" % (name, family.kind))
+            for values, value in family.collect():
+                labels = list(zip(family.label_names, values))
+                if family.kind != 'histogram':
+                    lines.append("%s%s %s" % (name, _format_labels(labels), _format_value(value)))
+                    continue
+                for bound, count in value['buckets']:
+                    lines.append("%s_bucket%s %d" % (
+                        name, _format_labels(labels + [('le', _format_value(bound))]), count))
+                lines.append("%s_sum%s %s" % (name, _format_labels(labels), _format_value(value['sum'])))
+                lines.append("%s_count%s %d" % (name, _format_labels(labels), value['count']))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Atomically replaces path with the current metrics, as read by the
+        textfile collector of the Prometheus node exporter"""
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as output:
+            output.write(self.prometheus_text())
+        os.replace(temporary, path)
+
+    def http_handler(self):
+        """Returns a request handler class serving the metrics, to be used
+        with http.server.HTTPServer"""
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return MetricsHandler
+
+    def _register(self, kind, name, documentation, label_names, factory):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = MetricFamily(
+                kind, name, documentation, label_names, factory)
+        elif family.kind != kind or family.label_names != tuple(label_names):
+            raise ValueError("Metric %s is already registered as %s with labels %r" % (
+                name, family.kind, family.label_names))
+        if family.label_names:
+            return family
+        return family.labels()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels)
+
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, bool):
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,1103 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.protocol
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Transport independent handling of the moritz protocol. MaxProtocol knows
+    how to answer incoming messages and how to track outstanding commands but
+    leaves moving bytes to its subclasses, so the threaded MaxConnection and
+    the asyncio based AsyncMaxConnection share the same logic.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+from datetime import datetime
+import time
+
+# environment imports
+import logging
+
+# custom imports
+from maxcul._messages import (
+    MoritzMessage,
+    PairPingMessage, PairPongMessage,
+    TimeInformationMessage,
+    SetTemperatureMessage,
+    ThermostatStateMessage,
+    AckMessage,
+    ShutterContactStateMessage,
+    PushButtonStateMessage,
+    WallThermostatStateMessage,
+    WallThermostatControlMessage,
+    WakeUpMessage,
+    SetGroupIdMessage, RemoveGroupIdMessage,
+    MORITZ_MESSAGE_IDS, MORITZ_MESSAGE_CLASSES
+)
+from maxcul._exceptions import MoritzError
+from maxcul._io import rssi_to_dbm
+from maxcul._registry import DeviceRegistry
+from maxcul._links import LinkMonitor
+from maxcul._store import DeviceStore
+from maxcul._groups import GroupIndex, GroupCommand, NO_GROUP
+from maxcul._sessions import WakeUpSession
+from maxcul._scheduler import Command, CommandScheduler, PIGGYBACK_TIMEOUT
+from maxcul._journal import CommandJournal, wall_clock_due, monotonic_due
+from maxcul._dispatch import CallbackDispatcher, DEFAULT_MAX_QUEUED_EVENTS
+from maxcul._metrics import MetricsRegistry
+from maxcul._tracing import Tracer
+from maxcul._diversity import frame_key
+from maxcul._duplicates import ReceiveCache
+from maxcul._const import (
+    EVENT_DEVICE_PAIRED, EVENT_DEVICE_REPAIRED, EVENT_THERMOSTAT_UPDATE,
+    EVENT_WALL_THERMOSTAT_UPDATE, EVENT_SHUTTER_CONTACT_UPDATE,
+    EVENT_PUSH_BUTTON_UPDATE, EVENT_COMMAND_DROPPED,
+    ATTR_DEVICE_ID, ATTR_CHANGES, ATTR_COMMAND, ATTR_REASON,
+    REASON_EXPIRED, REASON_SUPERSEDED, REASON_NOT_ACKNOWLEDGED,
+    REASON_SEND_FAILED,
+    PRIORITY_NORMAL,
+    DIRECTION_RECEIVE, DIRECTION_TRANSMIT,
+    STAGE_DEQUEUED, STAGE_DECODED, STAGE_CALLBACK, STAGE_HANDLED,
+    STAGE_CREATED, STAGE_ENCODED, STAGE_QUEUED, STAGE_ACKNOWLEDGED
+)
+
+# local constants
+LOGGER = logging.getLogger(__name__)
+
+# Hardcodings based on FHEM recommendations
+DEFAULT_CUBE_ID = 0x123456
+
+DEFAULT_PAIRING_TIMOUT = 30
+
+BACKOFF_INTERVAL = 10
+MAX_ATTEMPTS = 5
+
+# frames handed to the transport ahead of time, everything else waits in
+# the scheduler so it can still be reordered or dropped
+MAX_TRANSPORT_BACKLOG = 2
+
+# culfw sends frames starting with Zf without the long wake-up preamble,
+# only usable while the receiver is known to be listening
+FAST_SEND_PREFIX = "Zf"
+
+ACK_MESSAGE_ID = MORITZ_MESSAGE_CLASSES[AckMessage]
+
+# thermostats only listen right after sending these on their own, other
+# frames like ACKs do not open a window for held commands
+LISTENING_MESSAGES = (ThermostatStateMessage, TimeInformationMessage)
+
+
+class HandlerStatistics(object):
+    """Call counter and timings of a single message handler"""
+
+    __slots__ = ('calls', 'errors', 'total_time', 'max_time')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, duration):
+        self.calls += 1
+        self.total_time += duration
+        if duration > self.max_time:
+            self.max_time = duration
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'total_time': self.total_time,
+            'max_time': self.max_time,
+        }
+
+
+class MaxProtocol(object):
+    """High level message processing without any transport.
+
+    Subclasses have to implement _transmit, _transport_ready and
+    has_send_budget and feed received CUL lines into _process_frame.
+
+    With callback_workers set, the callback runs on that many worker threads
+    behind a queue of at most max_queued_events events per worker instead of
+    inline while processing received messages.
+
+    With store_path set, paired devices, device states and the message counter
+    are loaded from and written to a sqlite database at that path.
+
+    With journal_path set, commands awaiting their ACK are journaled to that
+    file and retransmission resumes after a restart.
+
+    A frame repeated by its sender within a few seconds is answered again
+    with the ACK or PairPong the first one got, without handling it again.
+
+    Received messages are dispatched by their type to handlers, which can
+    be replaced or extended through register_handler. Device updates are only
+    reported if at least one field changed compared to the last known state,
+    the changed fields are listed in the payload under ATTR_CHANGES.
+
+    Battery powered devices are configured best through wakeup_session,
+    which wakes a device once and sends a batch of commands while it is
+    awake.
+
+    Commands sent with urgent=False are held until their receiver transmits
+    on its own and are delivered right afterwards while it listens. They are
+    sent regularly after PIGGYBACK_TIMEOUT seconds if the receiver stays
+    silent.
+
+    Every device has at most one command in flight, devices with queued
+    commands take turns by priority and earliest deadline first. A
+    command given a deadline, in seconds from now, is dropped once it passed
+    instead of being sent or retried late, a set_temperature supersedes the
+    older ones for the same device. Dropped commands are reported with
+    EVENT_COMMAND_DROPPED and the reason in ATTR_REASON.
+
+    Signal strength and losses of the radio link to every device are
+    tracked in links, a LinkMonitor. Readings of thermostats are recorded in
+    timeseries if a TimeSeriesStore is given, their valve positions are fed
+    into demand if a HeatingDemand is given. All device states are published
+    to other processes through shared_state if a SharedStateTable is given.
+    Every received frame is archived in capture if a CaptureWriter is given.
+
+    Counters and timings are kept in metrics, a MetricsRegistry which may be
+    shared between connections. Hooks added to tracer are called with a
+    FrameTrace whenever a received or transmitted frame reaches a stage."""
+
+    def __init__(
+            self,
+            sender_id=DEFAULT_CUBE_ID,
+            callback=None,
+            paired_devices=None,
+            callback_workers=0,
+            max_queued_events=DEFAULT_MAX_QUEUED_EVENTS,
+            store_path=None,
+            journal_path=None,
+            metrics=None,
+            tracer=None,
+            timeseries=None,
+            demand=None,
+            shared_state=None,
+            capture=None):
+        self.sender_id = sender_id
+        self.callback = callback
+        self.devices = DeviceRegistry()
+        self.links = LinkMonitor()
+        self.timeseries = timeseries
+        self.demand = demand
+        self.shared_state = shared_state
+        self._shared_state_full = False
+        self.capture = capture
+        self._dispatcher = None
+        self._pairing_until = 0
+        self._paired_devices = set(paired_devices or ())
+        self._outstanding_acks = {}
+        self._outstanding_groups = {}
+        self._group_retries = {}
+        self._groups = GroupIndex()
+        self._sessions = {}
+        self._scheduler = CommandScheduler()
+        self._counters = {}
+        self._group_counters = {}
+        self._store = None
+        if store_path is not None:
+            self._store = DeviceStore(store_path)
+            paired, states, self._counters = self._store.load()
+            for device_id in self._paired_devices - paired:
+                self._store.add_paired_device(device_id)
+            self._paired_devices.update(paired)
+            self.devices.restore(states)
+            for state in states.values():
+                if state.group_id:
+                    self._groups.assign(state.device_id, state.group_id)
+                if shared_state is not None:
+                    self._publish_state(state)
+        self._handlers = {}
+        self._register_default_handlers()
+        self._answered = None
+        self._received_frames = ReceiveCache()
+        self._receiving = None
+        self.tracer = tracer if tracer is not None else Tracer()
+        self._trace = None
+        self._sending_trace = None
+        self._register_metrics(metrics)
+        if callback_workers:
+            # the dispatcher counts errors, it gets the exceptions raised
+            self._dispatcher = CallbackDispatcher(
+                self._invoke_callback, callback_workers, max_queued_events,
+                metrics=self.metrics)
+        self._journal = None
+        if journal_path is not None:
+            self._journal = CommandJournal(journal_path)
+            self._restore_outstanding()
+
+    def _register_metrics(self, metrics):
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self._frames_received = self.metrics.counter(
+            'maxcul_frames_received_total', 'Frames received from the CUL')
+        self._frames_decoded = self.metrics.counter(
+            'maxcul_frames_decoded_total', 'Frames decoded into messages')
+        self._decode_errors = self.metrics.counter(
+            'maxcul_decode_errors_total', 'Frames which failed to decode', ('error',))
+        self._commands_sent = self.metrics.counter(
+            'maxcul_commands_sent_total', 'Commands transmitted for the first time')
+        self._retransmits = self.metrics.counter(
+            'maxcul_retransmits_total', 'Retransmitted commands')
+        self._commands_dropped = self.metrics.counter(
+            'maxcul_commands_dropped_total', 'Commands given up', ('reason',))
+        self._duplicate_frames = self.metrics.counter(
+            'maxcul_duplicate_frames_total', 'Repeated frames answered from the cache')
+        self._ack_latency = self.metrics.histogram(
+            'maxcul_ack_latency_seconds', 'Time from the last transmission to the ACK')
+        self._device_rssi = self.metrics.gauge(
+            'maxcul_device_rssi_dbm', 'Signal strength of the last frame', ('device',))
+        # labeled by sender id, several connections may share a registry
+        connection = "%06X" % self.sender_id
+        self.metrics.gauge(
+            'maxcul_outstanding_commands', 'Commands awaiting an ACK',
+            ('connection',)).labels(connection).function = \
+            lambda: len(self._outstanding_acks)
+        self.metrics.gauge(
+            'maxcul_scheduled_commands', 'Commands queued or held for sending',
+            ('connection',)).labels(connection).function = \
+            lambda: len(self._scheduler)
+
+    @property
+    def has_send_budget(self):
+        """True if the transport has enough of the 1 percent budget left"""
+        raise NotImplementedError()
+
+    @property
+    def callback_statistics(self):
+        """Counters and latencies of the callback workers, None if callbacks run inline"""
+        if self._dispatcher is None:
+            return None
+        return self._dispatcher.statistics()
+
+    @property
+    def paired_devices(self):
+        """Ids of all devices paired with us"""
+        return frozenset(self._paired_devices)
+
+    @property
+    def pairing_enabled(self):
+        """True while new devices are allowed to pair"""
+        return time.monotonic() < self._pairing_until
+
+    def enable_pairing(self, duration=DEFAULT_PAIRING_TIMOUT):
+        LOGGER.info("Enable pairing for %d seconds", duration)
+        self._pairing_until = time.monotonic() + duration
+
+    def set_temperature(
+            self, receiver_id, temperature, mode, urgent=True,
+            deadline=None, priority=PRIORITY_NORMAL):
+        LOGGER.debug(
+            "Setting temperature for %d to %d %s",
+            receiver_id, temperature, mode)
+        msg = SetTemperatureMessage(
+            counter=self._next_counter(receiver_id),
+            sender_id=self.sender_id,
+            receiver_id=receiver_id,
+            desired_temperature=float(temperature),
+            mode=mode
+        )
+        self._supersede(msg)
+        return self._send_command(msg, urgent, deadline, priority)
+
+    @property
+    def groups(self):
+        """Members of all known groups by group id"""
+        return self._groups.as_dict()
+
+    def set_group_id(
+            self, receiver_id, group_id, urgent=True,
+            deadline=None, priority=PRIORITY_NORMAL):
+        """Assigns a device to a group, usually the one of its room"""
+        LOGGER.debug("Assigning %d to group %d", receiver_id, group_id)
+        msg = SetGroupIdMessage(
+            counter=self._next_counter(receiver_id),
+            sender_id=self.sender_id,
+            receiver_id=receiver_id,
+            new_group_id=group_id)
+        return self._send_command(msg, urgent, deadline, priority)
+
+    def remove_group_id(
+            self, receiver_id, urgent=True,
+            deadline=None, priority=PRIORITY_NORMAL):
+        """Removes a device from its group"""
+        LOGGER.debug("Removing %d from its group", receiver_id)
+        msg = RemoveGroupIdMessage(
+            counter=self._next_counter(receiver_id),
+            sender_id=self.sender_id,
+            receiver_id=receiver_id)
+        return self._send_command(msg, urgent, deadline, priority)
+
+    def set_group_temperature(self, group_id, temperature, mode):
+        """Sets the temperature of all members of a group with a single frame.
+        Members which do not acknowledge it in time get a unicast command."""
+        LOGGER.debug(
+            "Setting temperature for group %d to %d %s",
+            group_id, temperature, mode)
+        members = self._groups.members(group_id)
+        msg = SetTemperatureMessage(
+            counter=self._next_group_counter(group_id, members),
+            sender_id=self.sender_id,
+            receiver_id=0,
+            group_id=group_id,
+            desired_temperature=float(temperature),
+            mode=mode
+        )
+        return self._send_group_command(msg, members)
+
+    def wakeup(self, receiver_id):
+        LOGGER.debug("Waking device %d", receiver_id)
+        msg = WakeUpMessage(
+            counter=self._next_counter(receiver_id),
+            sender_id=self.sender_id,
+            receiver_id=receiver_id)
+        return self._send_command(msg)
+
+    def wakeup_session(self, receiver_id):
+        """Returns a WakeUpSession collecting commands for a device, which
+        are sent in a single wake cycle once the session is sent"""
+        return WakeUpSession(self, receiver_id)
+
+    def _transmit(self, raw_message):
+        """Hands an encoded message to the transport"""
+        raise NotImplementedError()
+
+    def _transport_ready(self):
+        """True if the transport is able to send messages"""
+        raise NotImplementedError()
+
+    def _transport_backlog(self):
+        """Number of frames the transport did not send yet"""
+        return 0
+
+    def _command_finished(self, msg, acknowledged):
+        """Called once an awaited command was acknowledged or given up"""
+        pass
+
+    def _next_counter(self, device_id):
+        """Returns the next 8 bit message counter for a device, skipping
+        counters the device or a group command to its group is still
+        waiting for"""
+        group_id = self._groups.group_of(device_id)
+        counter = self._counters.get(device_id, 0)
+        for _ in range(0x100):
+            counter = (counter + 1) & 0xFF
+            if (group_id, counter) not in self._outstanding_groups \
+                    and (device_id, counter) not in self._outstanding_acks:
+                break
+        self._counters[device_id] = counter
+        if self._store is not None:
+            self._store.save_counter(device_id, counter)
+        return counter
+
+    def _advance_counter(self, device_id, counter):
+        """Moves the counter of a device forward to counter, a counter at
+        most half the 8 bit range behind is considered older"""
+        current = self._counters.get(device_id)
+        if current is None or 0 < (counter - current) & 0xFF < 0x80:
+            self._counters[device_id] = counter
+
+    def _next_group_counter(self, group_id, members):
+        """Returns the next 8 bit message counter for a group, skipping
+        counters any member is still waiting for"""
+        counter = self._group_counters.get(group_id, 0)
+        for _ in range(0x100):
+            counter = (counter + 1) & 0xFF
+            if not any((member, counter) in self._outstanding_acks
+                       for member in members):
+                break
+        self._group_counters[group_id] = counter
+        return counter
+
+    def _update_device(self, device_id, **fields):
+        state = self.devices.update(device_id, **fields)
+        if self._store is not None:
+            self._store.save_state(state)
+        if self.shared_state is not None:
+            self._publish_state(state)
+        return state
+
+    def _publish_state(self, state):
+        """Publishes a state in the shared state table, a full table must
+        not keep frames from being handled"""
+        try:
+            self.shared_state.publish(state)
+        except MoritzError as err:
+            if not self._shared_state_full:
+                self._shared_state_full = True
+                LOGGER.error(
+                    "Unable to publish the state of %06X: %s", state.device_id, err)
+
+    def _process_frame(self, received_msg, answered=False, trace=None):
+        """Decodes a Z line received from the CUL and handles it, answered
+        tells that the transport already sent the ACK or PairPong for it and
+        trace continues the trace the transport started"""
+        self._frames_received.inc()
+        if self.capture is not None:
+            try:
+                self.capture.add_line(received_msg)
+            except MoritzError as err:
+                LOGGER.warning("%s", err)
+        key = frame_key(received_msg)
+        if key is not None and key[2] == ACK_MESSAGE_ID:
+            # ACKs answer our own counters and are matched by those already
+            key = None
+        now = time.monotonic()
+        received = None
+        if key is not None:
+            received = self._received_frames.lookup(key, now)
+        if received is not None:
+            self._answer_duplicate(received, answered)
+            return
+        if trace is None and self.tracer.hooks:
+            trace = self.tracer.start(DIRECTION_RECEIVE, received_msg)
+        if trace is not None:
+            trace.mark(STAGE_DEQUEUED)
+        try:
+            message = MoritzMessage.decode_message(received_msg[:-2])
+            signal_strength = int(received_msg[-2:], base=16)
+        except Exception as err:
+            self._decode_errors.labels(err.__class__.__name__).inc()
+            LOGGER.error(
+                "Exception <%s> was raised while parsing message '%s'. Please consider reporting this as a bug.",
+                err,
+                received_msg)
+            return
+        self._frames_decoded.inc()
+        if trace is not None:
+            trace.mark(STAGE_DECODED)
+        try:
+            if answered:
+                self._answered = message
+            if key is not None:
+                self._receiving = self._received_frames.add(key, now)
+            self._trace = trace
+            self._handle_message(message, signal_strength)
+        except Exception as err:
+            LOGGER.error(
+                "Exception <%s> was raised while handling message '%s'. Please consider reporting this as a bug.",
+                err,
+                received_msg)
+        finally:
+            self._answered = None
+            self._receiving = None
+            self._trace = None
+        if trace is not None:
+            trace.mark(STAGE_HANDLED)
+
+    def _answer_duplicate(self, received, answered):
+        """Sends the cached response to a repeated frame again"""
+        self._duplicate_frames.inc()
+        if answered or received.response is None:
+            return
+        if not self._transport_ready():
+            return
+        LOGGER.debug("Answering repeated frame with %s", received.response)
+        self._transmit(received.response)
+
+    def _remember_response(self, msg):
+        """Caches the response to the frame being handled"""
+        if self._receiving is not None:
+            self._receiving.response = msg.encode_message()
+
+    def _send_message(self, msg, fast=False, trace=None):
+        if not self._transport_ready():
+            LOGGER.error(
+                "Communication with serial device is not established, unable to send a message")
+            return False
+        LOGGER.debug("Sending message %s", msg)
+        if trace is None and self.tracer.hooks:
+            trace = self.tracer.start(DIRECTION_TRANSMIT, msg)
+        try:
+            raw_message = msg.encode_message()
+            if fast:
+                raw_message = FAST_SEND_PREFIX + raw_message[2:]
+            if trace is not None:
+                trace.mark(STAGE_ENCODED)
+            # picked up by transports which trace writing the frame
+            self._sending_trace = trace
+            self._transmit(raw_message)
+        except Exception as err:
+            LOGGER.error(
+                "Exception <%s> was raised while encoding message %s. Please consider reporting this as a bug.",
+                err,
+                msg)
+            return False
+        finally:
+            self._sending_trace = None
+        if trace is not None:
+            trace.mark(STAGE_QUEUED)
+        return True
+
+    def _send_command(
+            self, msg, urgent=True, deadline=None, priority=PRIORITY_NORMAL):
+        """Schedules a message the receiver has to acknowledge, non-urgent
+        ones are held until the receiver transmits"""
+        if not self._transport_ready():
+            LOGGER.error(
+                "Communication with serial device is not established, unable to send a message")
+            return False
+        now = time.monotonic()
+        command = Command(
+            msg, None if deadline is None else now + deadline, priority,
+            trace=self.tracer.start(DIRECTION_TRANSMIT, msg))
+        if command.trace is not None:
+            command.trace.mark(STAGE_CREATED)
+        if urgent:
+            self._scheduler.push(command)
+            self._dispatch_commands()
+            return True
+        fallback = now + PIGGYBACK_TIMEOUT
+        if command.deadline is not None:
+            # an expired command is dropped right when its deadline passed
+            fallback = min(fallback, command.deadline)
+        self._scheduler.hold(command, fallback)
+        self._journal_command(command, 0, fallback)
+        return True
+
+    def _dispatch_commands(self, listening=None):
+        """Hands queued commands to the transport as long as it keeps up,
+        the device listening right now is addressed without preamble"""
+        now = time.monotonic()
+        while self._transport_backlog() < MAX_TRANSPORT_BACKLOG:
+            command = self._scheduler.pop()
+            if command is None:
+                return
+            msg = command.msg
+            if command.attempt and not self._is_outstanding(msg):
+                # acknowledged while waiting for its retransmission
+                self._scheduler.finish(msg)
+                continue
+            if command.expired(now):
+                self._drop_command(msg, REASON_EXPIRED)
+            elif not self._send_message(
+                    msg, msg.receiver_id == listening, command.trace):
+                self._drop_command(msg, REASON_SEND_FAILED)
+            else:
+                if command.attempt:
+                    self._retransmits.inc()
+                else:
+                    self._commands_sent.inc()
+                self._set_outstanding(msg, now, command.attempt + 1, command)
+
+    def _release_held(self, device_id):
+        """Sends the next command of a device while it is listening"""
+        for command in self._scheduler.release(device_id):
+            LOGGER.debug("Piggybacking %s", command.msg)
+            self._scheduler.push(command)
+        self._dispatch_commands(listening=device_id)
+
+    def _supersede(self, msg):
+        """Drops older temperature commands for the receiver of msg"""
+        def superseded(old):
+            return isinstance(old, SetTemperatureMessage) \
+                and old.receiver_id == msg.receiver_id and not old.group_id
+        dropped = [command.msg for command in self._scheduler.discard(
+            msg.receiver_id, lambda command: superseded(command.msg))]
+        in_flight = self._scheduler.in_flight(msg.receiver_id)
+        if in_flight is not None and superseded(in_flight) \
+                and in_flight not in dropped and self._is_outstanding(in_flight):
+            dropped.append(in_flight)
+        for old in dropped:
+            self._drop_command(old, REASON_SUPERSEDED)
+
+    def _drop_command(self, msg, reason):
+        """Gives up a command and reports why"""
+        LOGGER.info("Dropping %s: %s", msg, reason)
+        self._commands_dropped.labels(reason).inc()
+        if self._is_outstanding(msg):
+            self._clear_outstanding((msg.receiver_id, msg.counter))
+        elif self._journal is not None:
+            self._journal.forget(msg)
+        self._call_callback(EVENT_COMMAND_DROPPED, {
+            ATTR_DEVICE_ID: msg.receiver_id,
+            ATTR_COMMAND: msg.__class__.__name__,
+            ATTR_REASON: reason})
+        self._finish_command(msg, False)
+
+    def _send_group_command(self, msg, members):
+        """Sends a group addressed message every member has to acknowledge"""
+        if not members:
+            LOGGER.warning("Group %d has no known members", msg.group_id)
+            return False
+        if not self._send_message(msg):
+            return False
+        self._outstanding_groups[(msg.group_id, msg.counter)] = GroupCommand(
+            msg, members, time.monotonic())
+        return True
+
+    def _retry_group_stragglers(self, now):
+        for group in list(self._outstanding_groups.values()):
+            if group.retrying or group.sent + BACKOFF_INTERVAL > now:
+                continue
+            group.retrying = True
+            LOGGER.info(
+                "Group %d members %s did not ACK, retrying with unicast",
+                group.msg.group_id, sorted(group.pending))
+            for member in list(group.pending):
+                unicast = SetTemperatureMessage(
+                    counter=self._next_counter(member),
+                    sender_id=self.sender_id,
+                    receiver_id=member,
+                    desired_temperature=group.msg.desired_temperature,
+                    mode=group.msg.mode)
+                self._group_retries[unicast] = group
+                self._scheduler.push(Command(unicast))
+        self._dispatch_commands()
+
+    def _finish_group(self, group):
+        del self._outstanding_groups[(group.msg.group_id, group.msg.counter)]
+        self._command_finished(group.msg, not group.failed)
+
+    def _send_session(self, session):
+        """Wakes the receiver of a session, its commands follow on the ACK"""
+        if not session.commands:
+            LOGGER.warning(
+                "Wake-up session for %d has no commands", session.receiver_id)
+            return False
+        LOGGER.debug(
+            "Waking device %d for %d commands",
+            session.receiver_id, len(session.commands))
+        session.wakeup = WakeUpMessage(
+            counter=self._next_counter(session.receiver_id),
+            sender_id=self.sender_id,
+            receiver_id=session.receiver_id)
+        if not self._send_message(session.wakeup):
+            return False
+        self._await_ack(session.wakeup)
+        self._sessions[session.wakeup] = session
+        return True
+
+    def _stream_session(self, session, awake):
+        if not awake:
+            LOGGER.warning(
+                "Device %d did not wake up, dropping %d commands",
+                session.receiver_id, len(session.commands))
+            session.failed.extend(session.commands)
+            self._finish_session(session)
+            return
+        for msg in session.commands:
+            msg.counter = self._next_counter(session.receiver_id)
+            msg.sender_id = self.sender_id
+            msg.receiver_id = session.receiver_id
+            if self._send_message(msg, fast=True):
+                self._await_ack(msg)
+                self._sessions[msg] = session
+                session.pending.add(msg)
+            else:
+                session.failed.append(msg)
+        if not session.pending:
+            self._finish_session(session)
+
+    def _finish_session(self, session):
+        LOGGER.debug(
+            "Releasing device %d, %d of %d commands failed",
+            session.receiver_id, len(session.failed), len(session.commands))
+        self._command_finished(session, not session.failed)
+
+    def _finish_command(self, msg, acknowledged):
+        self._scheduler.finish(msg)
+        self._command_finished(msg, acknowledged)
+        group = self._group_retries.pop(msg, None)
+        if group is not None and group.member_finished(msg.receiver_id, acknowledged):
+            self._finish_group(group)
+        session = self._sessions.pop(msg, None)
+        if session is None:
+            return
+        if msg is session.wakeup:
+            self._stream_session(session, acknowledged)
+        elif session.command_finished(msg, acknowledged):
+            self._finish_session(session)
+
+    def _await_ack(self, msg):
+        self._commands_sent.inc()
+        self._set_outstanding(msg, time.monotonic(), 1)
+
+    def _set_outstanding(self, msg, when, attempt, command=None):
+        self._outstanding_acks[(msg.receiver_id, msg.counter)] = (when, attempt, msg)
+        self._journal_command(
+            command or Command(msg), attempt, when + BACKOFF_INTERVAL * attempt)
+
+    def _journal_command(self, command, attempt, due):
+        if self._journal is None:
+            return
+        deadline = command.deadline
+        self._journal.record(
+            command.msg, command.msg.encode_message(), attempt, wall_clock_due(due),
+            None if deadline is None else wall_clock_due(deadline), command.priority)
+
+    def _is_outstanding(self, msg):
+        entry = self._outstanding_acks.get((msg.receiver_id, msg.counter))
+        return entry is not None and entry[2] is msg
+
+    def _clear_outstanding(self, key):
+        msg = self._outstanding_acks.pop(key)[2]
+        if self._journal is not None:
+            self._journal.forget(msg)
+        return msg
+
+    def _restore_outstanding(self):
+        for frame, attempt, due, deadline, priority in self._journal.load():
+            try:
+                msg = MoritzMessage.decode_message(frame)
+            except Exception as err:
+                LOGGER.error(
+                    "Unable to restore journaled command '%s': %s", frame, err)
+                continue
+            self._advance_counter(msg.receiver_id, msg.counter)
+            command = Command(
+                msg, None if deadline is None else monotonic_due(deadline),
+                priority, attempt)
+            due = monotonic_due(due)
+            if command.deadline is not None:
+                # expired commands are dropped by the next retransmission check
+                due = min(due, command.deadline)
+            if not attempt:
+                self._scheduler.hold(command, due)
+                continue
+            self._scheduler.resume(command)
+            when = due - BACKOFF_INTERVAL * attempt
+            self._outstanding_acks[(msg.receiver_id, msg.counter)] = (when, attempt, msg)
+            LOGGER.info("Resuming retransmission of %s", msg)
+
+    def _resend_message(self):
+        now = time.monotonic()
+        for command in self._scheduler.overdue(now):
+            LOGGER.debug("Receiver stayed silent, queueing %s", command.msg)
+            self._scheduler.push(command)
+        exhausted = []
+        for key, (when, attempt, msg) in self._outstanding_acks.items():
+            if when is None or when + BACKOFF_INTERVAL * attempt > now:
+                continue
+            if attempt == MAX_ATTEMPTS:
+                self.links.record_transmission(msg.receiver_id, True)
+                exhausted.append(msg)
+                continue
+            self.links.record_transmission(msg.receiver_id, True)
+            command = self._scheduler.get(msg) or Command(msg)
+            command.attempt = attempt
+            # waiting in the scheduler, not due again until it was sent
+            self._outstanding_acks[key] = (None, attempt, msg)
+            self._scheduler.retry(command)
+        for msg in exhausted:
+            LOGGER.warn("Did not receive an ACK for message %s", msg)
+            self._drop_command(msg, REASON_NOT_ACKNOWLEDGED)
+        self._retry_group_stragglers(now)
+        self._dispatch_commands()
+
+    def _send_ack(self, msg):
+        ack_msg = msg.respond_with(
+            AckMessage,
+            counter=msg.counter,
+            sender_id=self.sender_id)
+        self._remember_response(ack_msg)
+        if msg is self._answered:
+            LOGGER.debug("%s was acknowledged by the transport", msg)
+            return
+        self._send_message(ack_msg)
+
+    def _send_timeinformation(self, msg):
+        resp_msg = msg.respond_with(
+            TimeInformationMessage,
+            counter=self._next_counter(msg.sender_id),
+            sender_id=self.sender_id,
+            datetime=datetime.now()
+        )
+        self._send_message(resp_msg)
+
+    def _send_pong(self, msg):
+        if msg is self._answered:
+            LOGGER.debug("%s was answered by the transport", msg)
+            self._add_paired_device(msg.sender_id)
+            return True
+        resp_msg = msg.respond_with(
+            PairPongMessage,
+            counter=self._next_counter(msg.sender_id),
+            sender_id=self.sender_id,
+            devicetype='Cube'
+        )
+        if self.has_send_budget:
+            if self._send_message(resp_msg):
+                self._remember_response(resp_msg)
+                self._add_paired_device(msg.sender_id)
+                return True
+            return False
+        LOGGER.info(
+            "NOT responding to pair send budget is insufficient to be on time")
+        return False
+
+    def _add_paired_device(self, device_id):
+        self._paired_devices.add(device_id)
+        if self._store is not None:
+            self._store.add_paired_device(device_id)
+
+    def register_handler(self, message_type, handler):
+        """Registers handler(msg, signal_strength) for received messages of the
+        given class or message type id and returns the handler it replaces, so
+        plugins can chain to the built in behaviour."""
+        if not isinstance(message_type, int):
+            message_type = MORITZ_MESSAGE_CLASSES[message_type]
+        previous = self._handlers.get(message_type)
+        self._handlers[message_type] = (handler, HandlerStatistics())
+        return previous[0] if previous else None
+
+    def handler_statistics(self):
+        """Returns call counts and timings of all handlers by message class name"""
+        return dict(
+            (MORITZ_MESSAGE_IDS[msg_id].__name__, statistics.as_dict())
+            for msg_id, (_, statistics) in self._handlers.items())
+
+    def _register_default_handlers(self):
+        self.register_handler(PairPingMessage, self._handle_pair_ping)
+        self.register_handler(
+            TimeInformationMessage, self._handle_time_information)
+        self.register_handler(
+            ThermostatStateMessage, self._handle_thermostat_state)
+        self.register_handler(AckMessage, self._handle_ack)
+        self.register_handler(
+            ShutterContactStateMessage, self._handle_shutter_contact_state)
+        self.register_handler(
+            WallThermostatStateMessage, self._handle_wall_thermostat_state)
+        self.register_handler(
+            WallThermostatControlMessage, self._handle_wall_thermostat_control)
+        self.register_handler(
+            PushButtonStateMessage, self._handle_push_button_state)
+        self.register_handler(SetTemperatureMessage, self._handle_ack_required)
+
+    def _handle_message(self, msg, signal_strenth):
+        """Internal function to respond to incoming messages where appropriate"""
+        if msg.receiver_id != 0 and msg.receiver_id != self.sender_id:
+            # discard messages not addressed to us
+            return
+
+        LOGGER.debug("Received message %s (%d)", msg, signal_strenth)
+
+        if not isinstance(msg, PairPingMessage):
+            if msg.receiver_id == 0 and msg.sender_id not in self._paired_devices:
+                # discard broadcast messages from devices we are not paired with
+                return
+            rssi = rssi_to_dbm(signal_strenth)
+            self.links.record_frame(
+                msg.sender_id, signal_strenth, time.monotonic())
+            self._device_rssi.labels("%06X" % msg.sender_id).set(rssi)
+            self._update_device(msg.sender_id, rssi=rssi)
+
+        entry = self._handlers.get(MORITZ_MESSAGE_CLASSES.get(msg.__class__))
+        if entry is None:
+            LOGGER.warning(
+                "Unhandled Message of type %s, contains %s",
+                msg.__class__.__name__, msg)
+            return
+
+        handler, statistics = entry
+        started = time.perf_counter()
+        try:
+            handler(msg, signal_strenth)
+        except Exception:
+            statistics.errors += 1
+            raise
+        finally:
+            statistics.record(time.perf_counter() - started)
+        if isinstance(msg, LISTENING_MESSAGES):
+            self._release_held(msg.sender_id)
+        else:
+            self._dispatch_commands()
+
+    def _handle_pair_ping(self, msg, signal_strength):
+        # Some peer wants to pair. Let's see...
+        if msg.receiver_id == 0x0:
+            # pairing after factory reset
+            if not self.pairing_enabled:
+                LOGGER.info(
+                    "Pairing requested but pairing disabled, not pairing to new device")
+                return
+            if self._send_pong(msg):
+                self._record_pairing(msg, signal_strength)
+                self._call_callback(
+                    EVENT_DEVICE_PAIRED, {
+                        ATTR_DEVICE_ID: msg.sender_id})
+        elif msg.receiver_id == self.sender_id:
+            # pairing after battery replacement
+            if self._send_pong(msg):
+                self._record_pairing(msg, signal_strength)
+                self._call_callback(
+                    EVENT_DEVICE_REPAIRED, {
+                        ATTR_DEVICE_ID: msg.sender_id})
+        else:
+            # pair to someone else after battery replacement, don't care
+            LOGGER.debug(
+                "pair after battery replacement sent to other device 0x%X, ignoring",
+                msg.receiver_id)
+
+    def _handle_time_information(self, msg, signal_strength):
+        if not msg.datetime:
+            # time information requested
+            self._send_timeinformation(msg)
+
+    def _handle_thermostat_state(self, msg, signal_strength):
+        self._send_ack(msg)
+        self._propagate_thermostat_change(msg)
+
+    def _handle_ack(self, msg, signal_strength):
+        key = (msg.sender_id, msg.counter)
+        group_key = (
+            msg.group_id or self._groups.group_of(msg.sender_id), msg.counter)
+        if key in self._outstanding_acks:
+            when = self._outstanding_acks[key][0]
+            if when is not None:
+                self._ack_latency.observe(time.monotonic() - when)
+            acked = self._clear_outstanding(key)
+            self.links.record_transmission(acked.receiver_id, False)
+            command = self._scheduler.get(acked)
+            if command is not None and command.trace is not None:
+                command.trace.mark(STAGE_ACKNOWLEDGED)
+            if isinstance(acked, SetGroupIdMessage):
+                self._assign_group(acked.receiver_id, acked.new_group_id)
+            elif isinstance(acked, RemoveGroupIdMessage):
+                self._assign_group(acked.receiver_id, NO_GROUP)
+            self._finish_command(acked, True)
+        elif group_key in self._outstanding_groups:
+            group = self._outstanding_groups[group_key]
+            if not group.retrying and msg.sender_id in group.pending \
+                    and group.member_finished(msg.sender_id, True):
+                self._finish_group(group)
+        if msg.state == "ok":
+            self._propagate_thermostat_change(msg)
+
+    def _handle_ack_required(self, msg, signal_strength):
+        self._send_ack(msg)
+
+    def _handle_shutter_contact_state(self, msg, signal_strength):
+        self._send_ack(msg)
+        self._propagate_change(
+            EVENT_SHUTTER_CONTACT_UPDATE,
+            msg.sender_id,
+            state=msg.state,
+            battery_low=msg.battery_low)
+
+    def _handle_wall_thermostat_state(self, msg, signal_strength):
+        self._send_ack(msg)
+        self._record_reading(
+            msg.sender_id,
+            measured_temperature=msg.temperature,
+            desired_temperature=msg.desired_temperature)
+        self._propagate_change(
+            EVENT_WALL_THERMOSTAT_UPDATE,
+            msg.sender_id,
+            mode=msg.mode,
+            desired_temperature=msg.desired_temperature,
+            measured_temperature=msg.temperature,
+            battery_low=msg.battery_low)
+
+    def _handle_wall_thermostat_control(self, msg, signal_strength):
+        self._send_ack(msg)
+        self._propagate_change(
+            EVENT_WALL_THERMOSTAT_UPDATE,
+            msg.sender_id,
+            desired_temperature=msg.desired_temperature,
+            measured_temperature=msg.temperature)
+
+    def _handle_push_button_state(self, msg, signal_strength):
+        self._send_ack(msg)
+        self._propagate_change(
+            EVENT_PUSH_BUTTON_UPDATE,
+            msg.sender_id,
+            state=msg.state,
+            battery_low=msg.battery_low)
+
+    def _assign_group(self, device_id, group_id):
+        self._groups.assign(device_id, group_id)
+        self._update_device(device_id, group_id=group_id)
+
+    def _record_pairing(self, msg, signal_strength):
+        self._update_device(
+            msg.sender_id,
+            device_type=msg.device_type,
+            rssi=rssi_to_dbm(signal_strength))
+
+    def _propagate_thermostat_change(self, msg):
+        self._record_reading(
+            msg.sender_id,
+            measured_temperature=msg.measured_temperature,
+            desired_temperature=msg.desired_temperature,
+            valve_position=msg.valve_position)
+        if self.demand is not None and msg.valve_position is not None:
+            self.demand.update(msg.sender_id, msg.valve_position)
+        self._propagate_change(
+            EVENT_THERMOSTAT_UPDATE,
+            msg.sender_id,
+            mode=msg.mode,
+            desired_temperature=msg.desired_temperature,
+            measured_temperature=msg.measured_temperature,
+            valve_position=msg.valve_position,
+            battery_low=msg.battery_low)
+
+    def _record_reading(self, device_id, **readings):
+        if self.timeseries is not None and any(
+                value is not None for value in readings.values()):
+            self.timeseries.record(device_id, time.time(), **readings)
+
+    def _propagate_change(self, event, device_id, **fields):
+        """Records the given fields of a device and calls the callback with
+        all of them and a dict of (old, new) tuples if any of them changed"""
+        previous = self.devices.get_state(device_id)
+        state = self._update_device(device_id, **fields)
+        changes = {}
+        for field in fields:
+            old = getattr(previous, field) if previous is not None else None
+            new = getattr(state, field)
+            if old != new:
+                changes[field] = (old, new)
+        if not changes:
+            return
+        payload = dict((field, getattr(state, field)) for field in fields)
+        payload[ATTR_DEVICE_ID] = device_id
+        payload[ATTR_CHANGES] = changes
+        self._call_callback(event, payload)
+
+    def _start_workers(self):
+        if self._dispatcher is not None:
+            self._dispatcher.start()
+        if self._store is not None:
+            self._store.start()
+        if self._journal is not None:
+            self._journal.start()
+        if self.capture is not None:
+            self.capture.start()
+
+    def _stop_workers(self, timeout=None):
+        if self._dispatcher is not None:
+            self._dispatcher.stop(timeout)
+        if self._store is not None:
+            self._store.stop(timeout)
+        if self._journal is not None:
+            self._journal.stop(timeout)
+        if self.capture is not None:
+            self.capture.stop(timeout)
+
+    def _call_callback(self, event, payload):
+        if self._trace is not None:
+            self._trace.mark(STAGE_CALLBACK)
+        if self._dispatcher is not None:
+            self._dispatcher.dispatch(event, payload)
+        else:
+            self._run_callback(event, payload)
+
+    def _invoke_callback(self, event, payload):
+        if self.callback:
+            self.callback(event, payload)
+
+    def _run_callback(self, event, payload):
+        if self.callback:
+            try:
+                self._invoke_callback(event, payload)
+            except Exception as err:
+                LOGGER.warning(
+                    "Error while calling callback for thermostat update: %s", err)
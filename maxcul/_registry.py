@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.registry
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Last known state of every device heard by a connection. States are
+    immutable tuples which get replaced as a whole, so readers on any thread
+    always see a consistent state without taking a lock.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+from collections import namedtuple
+import time
+
+# environment imports
+
+# custom imports
+
+# local constants
+DEVICE_STATE_FIELDS = (
+    'device_id',
+    'device_type',
+    'group_id',
+    'mode',
+    'desired_temperature',
+    'measured_temperature',
+    'valve_position',
+    'battery_low',
+    'state',
+    'rssi',
+    'last_seen',
+)
+
+DeviceState = namedtuple('DeviceState', DEVICE_STATE_FIELDS)
+DeviceState.__new__.__defaults__ = (None,) * (len(DEVICE_STATE_FIELDS) - 1)
+DeviceState.__doc__ = """Last known state of a device, rssi is given in dBm"""
+
+
+class DeviceRegistry(object):
+    """Device states indexed by device id"""
+
+    def __init__(self):
+        self._states = {}
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, device_id):
+        return device_id in self._states
+
+    def update(self, device_id, **fields):
+        """Merges all given fields which are not None into the state of a device
+        and marks it as seen right now. Returns the new state."""
+        previous = self._states.get(device_id)
+        if previous is None:
+            previous = DeviceState(device_id)
+        changes = dict(
+            (key, value) for key, value in fields.items() if value is not None)
+        state = previous._replace(last_seen=time.time(), **changes)
+        # a single store is atomic, readers get either the old or the new state
+        self._states[device_id] = state
+        return state
+
+    def restore(self, states):
+        """Adds previously persisted states without touching them"""
+        self._states.update(states)
+
+    def remove(self, device_id):
+        """Forgets everything about a device"""
+        self._states.pop(device_id, None)
+
+    def get_state(self, device_id):
+        """Returns the state of a device or None if it was never heard of"""
+        return self._states.get(device_id)
+
+    def get_states(self, device_ids):
+        """Returns the states of all given devices in order, None for unknown ones"""
+        get = self._states.get
+        return [get(device_id) for device_id in device_ids]
+
+    def snapshot(self):
+        """Returns a consistent copy of all states keyed by device id"""
+        return self._states.copy()
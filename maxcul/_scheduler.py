@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.scheduler
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Commands which were not handed to the transport yet. Queued commands are
+    handed out by priority and earliest deadline first whenever the transport
+    is able to take more, so a late command is dropped instead of wasting
+    airtime. Devices are served in turns with at most one command in flight
+    each. Non-urgent commands are held until their receiver transmits on
+    its own, right afterwards it listens and accepts them on the first
+    attempt. If it stays silent they are queued once their fallback time
+    passed.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import heapq
+import itertools
+
+# environment imports
+
+# custom imports
+from maxcul._const import PRIORITY_NORMAL
+
+# local constants
+PIGGYBACK_TIMEOUT = 120
+
+_NO_DEADLINE = float('inf')
+
+
+class Command(object):
+    """A command together with its delivery constraints.
+
+    deadline is a time.monotonic() timestamp after which the command is
+    worthless, attempt the number of transmissions so far and trace its
+    FrameTrace if it is traced."""
+
+    __slots__ = ('msg', 'deadline', 'priority', 'attempt', 'trace')
+
+    def __init__(self, msg, deadline=None, priority=PRIORITY_NORMAL, attempt=0, trace=None):
+        self.msg = msg
+        self.deadline = deadline
+        self.priority = priority
+        self.attempt = attempt
+        self.trace = trace
+
+    def expired(self, now):
+        return self.deadline is not None and self.deadline <= now
+
+
+class CommandScheduler(object):
+    """Queued and held commands, all known commands are indexed by message
+    until they are finished.
+
+    Every device has a queue of its own and at most one command in flight.
+    Devices with a command to send take turns, ordered by priority and
+    deadline of their next command, so a device which never acknowledges
+    delays only its own commands while the others are served in parallel."""
+
+    def __init__(self):
+        self._commands = {}
+        self._held = {}
+        self._queues = {}
+        self._ready = []
+        self._scheduled = set()
+        self._in_flight = {}
+        self._turns = itertools.count()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values()) + \
+            sum(len(held) for held in self._held.values())
+
+    def get(self, msg):
+        """Returns the Command of a message or None if it is unknown"""
+        return self._commands.get(msg)
+
+    def in_flight(self, device_id):
+        """Returns the message a device has to acknowledge or None"""
+        return self._in_flight.get(device_id)
+
+    def finish(self, msg):
+        """Forgets a message which is done and lets its receiver take its
+        next turn if msg was in flight"""
+        self._commands.pop(msg, None)
+        device_id = msg.receiver_id
+        if self._in_flight.get(device_id) is msg:
+            del self._in_flight[device_id]
+            self._schedule(device_id)
+
+    def push(self, command):
+        """Queues a command for transmission"""
+        self._enqueue(command, 1)
+
+    def retry(self, command):
+        """Queues the retransmission of a command in flight, it is sent
+        before any other command of its receiver"""
+        self._enqueue(command, 0)
+
+    def pop(self):
+        """Returns the command to transmit next and puts it in flight, None
+        if no device is able to take a command"""
+        while self._ready:
+            priority, deadline, turn, device_id = heapq.heappop(self._ready)
+            self._scheduled.discard(device_id)
+            queue = self._queues.get(device_id)
+            if not queue:
+                continue
+            head = queue[0]
+            if head[0] and device_id in self._in_flight:
+                continue
+            if (head[1], head[2]) != (priority, deadline):
+                # the next command of the device changed since it got its turn
+                self._schedule(device_id, turn)
+                continue
+            heapq.heappop(queue)
+            if not queue:
+                del self._queues[device_id]
+            command = head[-1]
+            self._in_flight[device_id] = command.msg
+            return command
+        return None
+
+    def resume(self, command):
+        """Puts a command back in flight which was sent before a restart"""
+        self._commands[command.msg] = command
+        self._in_flight[command.msg.receiver_id] = command.msg
+
+    def hold(self, command, fallback):
+        """Holds a command until its receiver transmits or fallback passed"""
+        self._commands[command.msg] = command
+        self._held.setdefault(command.msg.receiver_id, []).append(
+            (fallback, command))
+
+    def release(self, device_id):
+        """Returns and forgets all commands held for a device"""
+        return [command for _, command in self._held.pop(device_id, ())]
+
+    def overdue(self, now):
+        """Returns and forgets all held commands whose fallback time passed"""
+        overdue = []
+        for device_id, held in list(self._held.items()):
+            count = 0
+            while count < len(held) and held[count][0] <= now:
+                count += 1
+            if not count:
+                continue
+            overdue.extend(command for _, command in held[:count])
+            if count == len(held):
+                del self._held[device_id]
+            else:
+                del held[:count]
+        return overdue
+
+    def discard(self, device_id, predicate):
+        """Removes and returns all queued or held commands of a device
+        matching predicate"""
+        discarded = []
+        queue = self._queues.get(device_id, ())
+        kept = [entry for entry in queue if not predicate(entry[-1])]
+        if len(kept) != len(queue):
+            discarded.extend(entry[-1] for entry in queue if predicate(entry[-1]))
+            if kept:
+                heapq.heapify(kept)
+                self._queues[device_id] = kept
+            else:
+                del self._queues[device_id]
+        held = self._held.get(device_id, ())
+        kept = [entry for entry in held if not predicate(entry[1])]
+        if len(kept) != len(held):
+            discarded.extend(entry[1] for entry in held if predicate(entry[1]))
+            if kept:
+                self._held[device_id] = kept
+            else:
+                del self._held[device_id]
+        return discarded
+
+    def _enqueue(self, command, rank):
+        self._commands[command.msg] = command
+        device_id = command.msg.receiver_id
+        deadline = _NO_DEADLINE if command.deadline is None else command.deadline
+        heapq.heappush(
+            self._queues.setdefault(device_id, []),
+            (rank, -command.priority, deadline, next(self._turns), command))
+        self._schedule(device_id)
+
+    def _schedule(self, device_id, turn=None):
+        """Gives a device a turn if it has a command it may send"""
+        queue = self._queues.get(device_id)
+        if device_id in self._scheduled or not queue:
+            return
+        head = queue[0]
+        if head[0] and device_id in self._in_flight:
+            return
+        if turn is None:
+            turn = next(self._turns)
+        heapq.heappush(self._ready, (head[1], head[2], turn, device_id))
+        self._scheduled.add(device_id)
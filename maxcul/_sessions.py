@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.sessions
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Wake-up sessions for battery powered devices. Those only listen briefly
+    after each of their own transmissions, so a batch of configuration
+    commands is delivered in a single wake cycle: the device is woken once
+    and all queued commands follow back to back while it is awake.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+
+# environment imports
+
+# custom imports
+from maxcul._exceptions import MoritzError
+from maxcul._messages import SetTemperatureMessage
+
+# local constants
+
+
+class WakeUpSession(object):
+    """Commands for a single device which are sent in one wake cycle.
+
+    Counter and addresses of added messages are filled in when they are sent.
+    Commands the device does not acknowledge while awake are retried like any
+    other command."""
+
+    def __init__(self, connection, receiver_id):
+        self.receiver_id = receiver_id
+        self.commands = []
+        self.wakeup = None
+        self.pending = set()
+        self.failed = []
+        self._connection = connection
+
+    @property
+    def started(self):
+        return self.wakeup is not None
+
+    def add(self, msg):
+        """Queues a command, returns the session for chaining"""
+        if self.started:
+            raise MoritzError("Wake-up session was already sent")
+        self.commands.append(msg)
+        return self
+
+    def set_temperature(self, temperature, mode):
+        return self.add(SetTemperatureMessage(
+            desired_temperature=float(temperature),
+            mode=mode))
+
+    def send(self):
+        """Wakes the device and streams all queued commands once it is awake"""
+        return self._connection._send_session(self)
+
+    def command_finished(self, msg, acknowledged):
+        """Marks a command as done, returns True once no command is pending"""
+        self.pending.discard(msg)
+        if not acknowledged:
+            self.failed.append(msg)
+        return not self.pending
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.sharedstate
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Device states published in a multiprocessing.shared_memory segment, so
+    other local processes read them straight from memory without talking
+    to the process owning the CUL stick. The segment holds a header and a
+    fixed size record per device in the order devices were first heard of.
+
+    Every record starts with a sequence number which the single writer
+    makes odd before and even again after changing the record. A reader
+    retries while the number is odd or changed while it copied the record,
+    so it never gets a half written state and never blocks the writer.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import math
+import os
+from multiprocessing import resource_tracker, shared_memory
+import struct
+
+# environment imports
+
+# custom imports
+from maxcul._exceptions import MoritzError
+from maxcul._registry import DeviceState
+from maxcul._const import DEVICE_TYPES, DEVICE_TYPES_BY_NAME, MODE_IDS
+
+# local constants
+DEFAULT_CAPACITY = 256
+
+MAGIC = b'MAXS'
+LAYOUT_VERSION = 1
+
+# magic, layout version, record size, capacity, number of records
+HEADER = struct.Struct('<4sHHII')
+HEADER_COUNT_OFFSET = 12
+
+# sequence number, device id, device type, group id, mode, valve position,
+# battery low, state, desired and measured temperature, rssi, last seen
+RECORD = struct.Struct('<IIbhbbbb5xfffd')
+SEQUENCE = struct.Struct('<I')
+
+_NAN = float('nan')
+_UNKNOWN = -1
+
+# the resource tracker only exists for posix shared memory
+_TRACKED = os.name == 'posix'
+
+# segments created by this process, still tracked by its resource tracker
+_CREATED = set()
+
+_MODES_BY_NAME = dict((name, mode_id) for mode_id, name in MODE_IDS.items())
+
+# states reported by shutter contacts and push buttons
+_STATES = (None, 'close', 'open', False, True)
+_STATE_IDS = dict((state, index) for index, state in enumerate(_STATES))
+
+
+def _code(value, codes):
+    return _UNKNOWN if value is None else codes.get(value, _UNKNOWN)
+
+
+def _number(value):
+    return _NAN if value is None else value
+
+
+def _optional(value):
+    return None if math.isnan(value) else value
+
+
+def _open_untracked(name):
+    """Opens an existing segment without the resource tracker removing it
+    when this process exits, the creating process owns it"""
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # python before 3.13 registers every opened segment
+        memory = shared_memory.SharedMemory(name)
+        if _TRACKED and memory._name not in _CREATED:
+            resource_tracker.unregister(memory._name, 'shared_memory')
+        return memory
+
+
+def encode_state(state, sequence):
+    """Returns the record of a DeviceState"""
+    if state.state is None:
+        state_id = 0
+    elif isinstance(state.state, bool):
+        state_id = 4 if state.state else 3
+    else:
+        state_id = _STATE_IDS.get(state.state, 0)
+    return RECORD.pack(
+        sequence,
+        state.device_id,
+        _code(state.device_type, DEVICE_TYPES_BY_NAME),
+        _UNKNOWN if state.group_id is None else state.group_id,
+        _code(state.mode, _MODES_BY_NAME),
+        _UNKNOWN if state.valve_position is None else state.valve_position,
+        _UNKNOWN if state.battery_low is None else int(state.battery_low),
+        state_id,
+        _number(state.desired_temperature),
+        _number(state.measured_temperature),
+        _number(state.rssi),
+        _number(state.last_seen))
+
+
+def decode_state(fields):
+    """Returns the DeviceState of unpacked record fields"""
+    (_, device_id, device_type, group_id, mode, valve_position, battery_low,
+     state_id, desired, measured, rssi, last_seen) = fields
+    return DeviceState(
+        device_id=device_id,
+        device_type=DEVICE_TYPES.get(device_type),
+        group_id=None if group_id == _UNKNOWN else group_id,
+        mode=MODE_IDS.get(mode),
+        desired_temperature=_optional(desired),
+        measured_temperature=_optional(measured),
+        valve_position=None if valve_position == _UNKNOWN else valve_position,
+        battery_low=None if battery_low == _UNKNOWN else bool(battery_low),
+        state=_STATES[state_id] if 0 <= state_id < len(_STATES) else None,
+        rssi=_optional(rssi),
+        last_seen=_optional(last_seen))
+
+
+class SharedStateTable(object):
+    """Device states in a named shared memory segment.
+
+    The process owning the connection creates the table and passes it to
+    the connection as shared_state, which publishes every state change.
+    Readers attach to it by name."""
+
+    def __init__(self, memory, owner):
+        self._memory = memory
+        self._buffer = memory.buf
+        self._owner = owner
+        magic, version, record_size, capacity, _ = HEADER.unpack_from(self._buffer)
+        if magic != MAGIC or version != LAYOUT_VERSION or record_size != RECORD.size:
+            raise MoritzError("Shared memory %s holds no device states" % memory.name)
+        self.capacity = capacity
+        self._indexes = {}
+        self._sequences = []
+
+    @classmethod
+    def create(cls, name=None, capacity=DEFAULT_CAPACITY):
+        """Creates a table for up to capacity devices"""
+        memory = shared_memory.SharedMemory(
+            name, create=True, size=HEADER.size + capacity * RECORD.size)
+        HEADER.pack_into(memory.buf, 0, MAGIC, LAYOUT_VERSION, RECORD.size, capacity, 0)
+        if _TRACKED:
+            _CREATED.add(memory._name)
+        return cls(memory, True)
+
+    @classmethod
+    def attach(cls, name):
+        """Opens a table created by another process for reading"""
+        return cls(_open_untracked(name), False)
+
+    @property
+    def name(self):
+        return self._memory.name
+
+    def __len__(self):
+        return HEADER.unpack_from(self._buffer)[4]
+
+    def publish(self, state):
+        """Writes the state of a device, only called by the creating process"""
+        index = self._indexes.get(state.device_id)
+        if index is None:
+            index = len(self._sequences)
+            if index == self.capacity:
+                raise MoritzError("Shared state table is full")
+            self._sequences.append(0)
+            self._indexes[state.device_id] = index
+        offset = HEADER.size + index * RECORD.size
+        sequence = self._sequences[index] + 1
+        # odd while the record is being written
+        SEQUENCE.pack_into(self._buffer, offset, sequence & 0xFFFFFFFF)
+        self._buffer[offset + SEQUENCE.size:offset + RECORD.size] = \
+            encode_state(state, 0)[SEQUENCE.size:]
+        sequence += 1
+        SEQUENCE.pack_into(self._buffer, offset, sequence & 0xFFFFFFFF)
+        self._sequences[index] = sequence
+        if index == len(self._sequences) - 1:
+            # the record is complete before readers get to see it
+            struct.pack_into('<I', self._buffer, HEADER_COUNT_OFFSET, index + 1)
+
+    def read(self, index):
+        """Returns the DeviceState stored at index"""
+        offset = HEADER.size + index * RECORD.size
+        buffer = self._buffer
+        while True:
+            before = SEQUENCE.unpack_from(buffer, offset)[0]
+            if before & 1:
+                continue
+            fields = RECORD.unpack_from(buffer, offset)
+            # the writer may have started while the record was copied
+            if SEQUENCE.unpack_from(buffer, offset)[0] == before:
+                return decode_state(fields)
+
+    def get_state(self, device_id):
+        """Returns the state of a device or None if it was never published"""
+        index = self._index_of(device_id)
+        if index is None:
+            return None
+        return self.read(index)
+
+    def get_states(self, device_ids):
+        """Returns the states of all given devices in order, None for unknown ones"""
+        return [self.get_state(device_id) for device_id in device_ids]
+
+    def snapshot(self):
+        """Returns all states keyed by device id"""
+        states = (self.read(index) for index in range(len(self)))
+        return dict((state.device_id, state) for state in states)
+
+    def close(self):
+        """Detaches from the segment, the creating process also removes it"""
+        self._buffer = None
+        self._memory.close()
+        if self._owner:
+            name = self._memory._name if _TRACKED else None
+            _CREATED.discard(name)
+            if _TRACKED:
+                # a reader sharing our resource tracker may have unregistered it
+                resource_tracker.register(name, 'shared_memory')
+            try:
+                self._memory.unlink()
+            except FileNotFoundError:
+                # already removed by someone else, stop tracking it anyway
+                if _TRACKED:
+                    resource_tracker.unregister(name, 'shared_memory')
+
+    def _index_of(self, device_id):
+        index = self._indexes.get(device_id)
+        if index is not None or self._owner:
+            return index
+        # device ids never change once written, only look at new records
+        for index in range(len(self._indexes), len(self)):
+            known_id = RECORD.unpack_from(
+                self._buffer, HEADER.size + index * RECORD.size)[1]
+            self._indexes[known_id] = index
+        return self._indexes.get(device_id)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.store
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Persists paired devices, their last known states and message counters
+    in a sqlite database, so a restarted connection knows its devices right
+    away. Writes are queued and committed in batches by a writer thread, the
+    protocol never waits for the disk.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import queue
+import sqlite3
+import threading
+
+# environment imports
+import logging
+
+# custom imports
+from maxcul._registry import DeviceState, DEVICE_STATE_FIELDS
+
+# local constants
+LOGGER = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 500
+
+_COLUMN_TYPES = {
+    'device_id': 'INTEGER PRIMARY KEY',
+    'device_type': 'TEXT',
+    'group_id': 'INTEGER',
+    'mode': 'TEXT',
+    'valve_position': 'INTEGER',
+    'battery_low': 'INTEGER',
+    'state': '',
+}
+
+_BOOLEAN_FIELDS = ('battery_low',)
+
+_STOP = object()
+
+
+class DeviceStore(object):
+    """sqlite backed store of devices and protocol state"""
+
+    def __init__(self, path):
+        self._path = path
+        self._queue = queue.Queue()
+        self._thread = None
+        connection = self._connect()
+        try:
+            with connection:
+                self._create_schema(connection)
+        finally:
+            connection.close()
+
+    def load(self):
+        """Returns the paired device ids, the stored device states by id and
+        the last message counter by device id"""
+        connection = self._connect()
+        try:
+            paired = set(row[0] for row in connection.execute(
+                "SELECT device_id FROM paired_devices"))
+            states = dict(
+                (row[0], self._to_state(row)) for row in connection.execute(
+                    "SELECT %s FROM device_states" % ", ".join(DEVICE_STATE_FIELDS)))
+            counters = dict(connection.execute(
+                "SELECT device_id, counter FROM counters"))
+        finally:
+            connection.close()
+        return paired, states, counters
+
+    def start(self):
+        """Starts the writer thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._write_loop, name="maxcul-store", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Writes all pending changes and stops the writer thread"""
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def add_paired_device(self, device_id):
+        self._queue.put(('paired', device_id, True))
+
+    def remove_paired_device(self, device_id):
+        self._queue.put(('paired', device_id, False))
+
+    def save_state(self, state):
+        self._queue.put(('state', state.device_id, state))
+
+    def save_counter(self, device_id, counter):
+        self._queue.put(('counter', device_id, counter))
+
+    def flush(self):
+        """Synchronously writes all queued changes, for use without writer thread"""
+        connection = self._connect()
+        try:
+            self._write_batch(connection, self._drain([]))
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _to_state(row):
+        state = DeviceState(*row)
+        booleans = dict(
+            (field, bool(getattr(state, field))) for field in _BOOLEAN_FIELDS
+            if getattr(state, field) is not None)
+        return state._replace(**booleans)
+
+    def _connect(self):
+        connection = sqlite3.connect(self._path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    @staticmethod
+    def _create_schema(connection):
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS paired_devices (device_id INTEGER PRIMARY KEY)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS counters (device_id INTEGER PRIMARY KEY, counter INTEGER)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS device_states (device_id INTEGER PRIMARY KEY)")
+        existing = set(row[1] for row in connection.execute(
+            "PRAGMA table_info(device_states)"))
+        for field in DEVICE_STATE_FIELDS:
+            if field not in existing:
+                connection.execute(
+                    "ALTER TABLE device_states ADD COLUMN %s %s" % (
+                        field, _COLUMN_TYPES.get(field, 'REAL')))
+
+    def _drain(self, batch):
+        while len(batch) < MAX_BATCH_SIZE:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_loop(self):
+        connection = self._connect()
+        try:
+            stop = False
+            while not stop:
+                batch = self._drain([self._queue.get()])
+                stop = _STOP in batch
+                self._write_batch(
+                    connection, [item for item in batch if item is not _STOP])
+            while not self._queue.empty():
+                self._write_batch(connection, self._drain([]))
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _write_batch(connection, batch):
+        # only the latest change per key needs to hit the disk
+        latest = {}
+        for kind, key, value in batch:
+            latest[(kind, key)] = value
+        try:
+            with connection:
+                for (kind, key), value in latest.items():
+                    if kind == 'state':
+                        connection.execute(
+                            "INSERT OR REPLACE INTO device_states (%s) VALUES (%s)" % (
+                                ", ".join(DEVICE_STATE_FIELDS),
+                                ", ".join("?" * len(DEVICE_STATE_FIELDS))),
+                            tuple(value))
+                    elif kind == 'paired' and value:
+                        connection.execute(
+                            "INSERT OR IGNORE INTO paired_devices VALUES (?)", (key,))
+                    elif kind == 'paired':
+                        connection.execute(
+                            "DELETE FROM paired_devices WHERE device_id = ?", (key,))
+                    else:
+                        connection.execute(
+                            "INSERT OR REPLACE INTO counters VALUES (?, ?)", (key, value))
+        except sqlite3.Error as err:
+            LOGGER.error("Unable to persist device state: %s", err)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.timeseries
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Embedded store of the readings thermostats report. Every device gets
+    preallocated ring buffers of timestamps, measured and desired
+    temperature and valve position, so a store needs the same amount of
+    memory no matter how long it runs. Samples older than the retention
+    period are dropped as well. Range and downsample queries return array
+    columns, or NumPy arrays if NumPy is installed and asked for.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+from array import array
+from collections import namedtuple
+import math
+
+# environment imports
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# custom imports
+from maxcul._exceptions import MoritzError
+
+# local constants
+# one week of thermostat reports, which arrive every 3 minutes or faster
+DEFAULT_CAPACITY = 4096
+DEFAULT_RETENTION = 7 * 24 * 3600
+
+_NAN = float('nan')
+
+READING_FIELDS = (
+    'time',
+    'measured_temperature',
+    'desired_temperature',
+    'valve_position',
+)
+
+Readings = namedtuple('Readings', READING_FIELDS)
+Readings.__doc__ = """Columns of readings, time in seconds since the epoch
+and NaN for values a device did not report"""
+
+
+def _value(value):
+    return _NAN if value is None else value
+
+
+class ReadingSeries(object):
+    """Readings of a single device in a ring of capacity samples"""
+
+    # bytes per sample: a double timestamp and three floats
+    SAMPLE_SIZE = 8 + 3 * 4
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, retention=DEFAULT_RETENTION):
+        self.capacity = capacity
+        self.retention = retention
+        self._time = array('d', bytes(8 * capacity))
+        self._measured = array('f', bytes(4 * capacity))
+        self._desired = array('f', bytes(4 * capacity))
+        self._valve = array('f', bytes(4 * capacity))
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, measured_temperature=None,
+               desired_temperature=None, valve_position=None):
+        """Adds a sample. Timestamps are wall clock times, a sample older than
+        the last one is stored with the time of the last one so the
+        timestamps stay sorted when the clock is set back."""
+        if self._count:
+            last = self._time[(self._start + self._count - 1) % self.capacity]
+            timestamp = max(timestamp, last)
+        if self._count == self.capacity:
+            self._start = (self._start + 1) % self.capacity
+            self._count -= 1
+        index = (self._start + self._count) % self.capacity
+        self._time[index] = timestamp
+        self._measured[index] = _value(measured_temperature)
+        self._desired[index] = _value(desired_temperature)
+        self._valve[index] = _value(valve_position)
+        self._count += 1
+        self.expire(timestamp - self.retention)
+
+    def expire(self, before):
+        """Drops all samples older than before"""
+        count = self._bisect(before)
+        self._start = (self._start + count) % self.capacity
+        self._count -= count
+
+    def range(self, start=None, end=None, as_numpy=False):
+        """Returns Readings of all samples taken from start until before end"""
+        first = 0 if start is None else self._bisect(start)
+        last = self._count if end is None else self._bisect(end)
+        columns = [self._slice(column, first, last) for column in (
+            self._time, self._measured, self._desired, self._valve)]
+        return _readings(columns, as_numpy)
+
+    def downsample(self, interval, start=None, end=None, as_numpy=False):
+        """Returns Readings with the mean of every interval seconds from start
+        until before end, the time of a bucket is its start. Buckets without
+        samples are left out."""
+        first = 0 if start is None else self._bisect(start)
+        last = self._count if end is None else self._bisect(end)
+        columns = [array('d'), array('f'), array('f'), array('f')]
+        if first == last:
+            return _readings(columns, as_numpy)
+        origin = self._time[(self._start + first) % self.capacity] if start is None else start
+        bucket = None
+        sums = counts = None
+        for offset in range(first, last):
+            index = (self._start + offset) % self.capacity
+            current = math.floor((self._time[index] - origin) / interval)
+            if current != bucket:
+                if bucket is not None:
+                    _close_bucket(columns, origin + bucket * interval, sums, counts)
+                bucket = current
+                sums = [0.0, 0.0, 0.0]
+                counts = [0, 0, 0]
+            for column, values in enumerate((self._measured, self._desired, self._valve)):
+                value = values[index]
+                if not math.isnan(value):
+                    sums[column] += value
+                    counts[column] += 1
+        _close_bucket(columns, origin + bucket * interval, sums, counts)
+        return _readings(columns, as_numpy)
+
+    def _bisect(self, timestamp):
+        """Returns the number of samples taken before timestamp"""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._time[(self._start + middle) % self.capacity] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _slice(self, column, first, last):
+        first = self._start + first
+        last = self._start + last
+        if last <= self.capacity:
+            return column[first:last]
+        if first >= self.capacity:
+            return column[first - self.capacity:last - self.capacity]
+        return column[first:] + column[:last - self.capacity]
+
+
+def _close_bucket(columns, timestamp, sums, counts):
+    columns[0].append(timestamp)
+    for column, (total, count) in enumerate(zip(sums, counts), 1):
+        columns[column].append(total / count if count else _NAN)
+
+
+def _readings(columns, as_numpy):
+    if not as_numpy:
+        return Readings(*columns)
+    if numpy is None:
+        raise MoritzError("NumPy is required for as_numpy")
+    return Readings(*(numpy.frombuffer(column, dtype=column.typecode)
+                      for column in columns))
+
+
+class TimeSeriesStore(object):
+    """Reading series indexed by device id, every device keeps at most
+    capacity samples and none older than retention seconds"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, retention=DEFAULT_RETENTION):
+        self.capacity = capacity
+        self.retention = retention
+        self._series = {}
+
+    def __len__(self):
+        return len(self._series)
+
+    def __contains__(self, device_id):
+        return device_id in self._series
+
+    @property
+    def memory_size(self):
+        """Bytes allocated for samples of all devices"""
+        return len(self._series) * self.capacity * ReadingSeries.SAMPLE_SIZE
+
+    def device_ids(self):
+        return list(self._series)
+
+    def record(self, device_id, timestamp, measured_temperature=None,
+               desired_temperature=None, valve_position=None):
+        series = self._series.get(device_id)
+        if series is None:
+            series = self._series[device_id] = ReadingSeries(
+                self.capacity, self.retention)
+        series.append(
+            timestamp, measured_temperature, desired_temperature, valve_position)
+
+    def range(self, device_id, start=None, end=None, as_numpy=False):
+        """Returns Readings of a device from start until before end"""
+        return self._get(device_id).range(start, end, as_numpy)
+
+    def downsample(self, device_id, interval, start=None, end=None, as_numpy=False):
+        """Returns Readings of a device averaged over interval seconds"""
+        return self._get(device_id).downsample(interval, start, end, as_numpy)
+
+    def _get(self, device_id):
+        series = self._series.get(device_id)
+        if series is None:
+            series = ReadingSeries(0, self.retention)
+        return series
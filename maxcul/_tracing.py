@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+    maxcul.tracing
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Per-frame traces of the stages a frame passes through, from reading it
+    off the serial port to running the callback, or from creating a command
+    to its ACK. Every stage gets a time.monotonic() timestamp and the
+    registered hooks are called with the trace. Without hooks no trace is
+    created at all and every stage costs a single comparison.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import time
+
+# environment imports
+import logging
+
+# custom imports
+
+# local constants
+LOGGER = logging.getLogger(__name__)
+
+
+class FrameTrace(object):
+    """Stages a single frame passed through so far.
+
+    frame is the received line or the transmitted message, stages a list
+    of (stage, timestamp) tuples in the order they were recorded. Stages of
+    transmitted frames repeat for every retransmission."""
+
+    __slots__ = ('direction', 'frame', 'stages', '_hooks')
+
+    def __init__(self, direction, frame, hooks):
+        self.direction = direction
+        self.frame = frame
+        self.stages = []
+        self._hooks = hooks
+
+    def mark(self, stage, timestamp=None):
+        """Records that the frame reached stage and calls the hooks"""
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self.stages.append((stage, timestamp))
+        for hook in self._hooks:
+            try:
+                hook(self, stage)
+            except Exception as err:
+                LOGGER.warning("Error while calling trace hook: %s", err)
+
+    def timestamp(self, stage):
+        """Returns when the frame last reached stage or None"""
+        for recorded, timestamp in reversed(self.stages):
+            if recorded == stage:
+                return timestamp
+        return None
+
+    def breakdown(self):
+        """Returns (stage, seconds since the previous stage) tuples"""
+        result = []
+        previous = None
+        for stage, timestamp in self.stages:
+            result.append((stage, 0.0 if previous is None else timestamp - previous))
+            previous = timestamp
+        return result
+
+
+class Tracer(object):
+    """Hooks called as hook(trace, stage) whenever a traced frame reaches
+    a stage. Hooks run on the thread processing the stage, which is the IO
+    thread for reading and writing, so they should be quick."""
+
+    def __init__(self):
+        self.hooks = ()
+
+    def add_hook(self, hook):
+        # replaced as a whole, threads reading hooks never see it half updated
+        self.hooks = self.hooks + (hook,)
+
+    def remove_hook(self, hook):
+        self.hooks = tuple(known for known in self.hooks if known != hook)
+
+    def start(self, direction, frame):
+        """Returns a new trace or None if no hook is registered"""
+        hooks = self.hooks
+        if not hooks:
+            return None
+        return FrameTrace(direction, frame, hooks)
@@ -0,0 +1,177 @@
+import os
+import sys
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../../')
+
+from maxcul import AsyncMaxConnection, CommunicationError
+from maxcul import _aio
+from maxcul._const import EVENT_THERMOSTAT_UPDATE, ATTR_DEVICE_ID, ATTR_MEASURED_TEMPERATURE
+
+THERMOSTAT_ID = 0x08FFE9
+
+
+class FakeCul(object):
+    """Minimal CUL stick speaking over TCP"""
+
+    def __init__(self):
+        self.written = []
+        self.writer = None
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._client, '127.0.0.1', 0)
+        return 'socket://127.0.0.1:%d' % self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def drop(self):
+        self.writer.close()
+
+    def send(self, line):
+        self.writer.write((line + "\r\n").encode())
+
+    async def _client(self, reader, writer):
+        self.writer = writer
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            line = line.decode().strip()
+            self.written.append(line)
+            if line == "V":
+                self.send("V 1.67 nanoCUL868")
+            elif line == "X":
+                self.send("21  900")
+            elif line.startswith("Zs") and line[8:10] == "40":
+                # acknowledge set temperature commands
+                self.send("Z0E%s0202%06X123456000119000B2C" % (line[4:6], THERMOSTAT_ID))
+
+
+class AsyncMaxConnectionTestCase(unittest.TestCase):
+    def run_async(self, coro):
+        return asyncio.run(coro)
+
+    def test_set_temperature_awaits_ack(self):
+        async def scenario():
+            cul = FakeCul()
+            path = await cul.start()
+            async with AsyncMaxConnection(path, paired_devices=[THERMOSTAT_ID]) as conn:
+                acked = await asyncio.wait_for(
+                    conn.set_temperature(THERMOSTAT_ID, 21, 'manual'), 5)
+            await cul.stop()
+            return acked, cul.written
+        acked, written = self.run_async(scenario())
+        self.assertTrue(acked)
+        self.assertIn("Zs0B010040123456%06X006A" % THERMOSTAT_ID, written)
+        self.assertEqual(written[1:4], ["X21", "Zr", "T01"])
+
+    def test_events_iterator(self):
+        async def scenario():
+            cul = FakeCul()
+            path = await cul.start()
+            async with AsyncMaxConnection(path, paired_devices=[THERMOSTAT_ID]) as conn:
+                events = conn.events()
+                next_event = asyncio.ensure_future(events.__anext__())
+                await asyncio.sleep(0)
+                cul.send("Z0F61046008FFE90000000019002000CA2C")
+                event = await asyncio.wait_for(next_event, 5)
+            await cul.stop()
+            return event
+        event, payload = self.run_async(scenario())
+        self.assertEqual(event, EVENT_THERMOSTAT_UPDATE)
+        self.assertEqual(payload[ATTR_DEVICE_ID], THERMOSTAT_ID)
+        self.assertEqual(payload[ATTR_MEASURED_TEMPERATURE], 20.2)
+
+    def test_connection_refused(self):
+        async def scenario():
+            conn = AsyncMaxConnection('socket://127.0.0.1:1')
+            with self.assertRaises(CommunicationError):
+                await conn.start()
+        self.run_async(scenario())
+
+    def test_stop_keeps_loop_running(self):
+        async def scenario():
+            cul = FakeCul()
+            path = await cul.start()
+            conn = AsyncMaxConnection(path)
+            await conn.start()
+            stop_workers = conn._stop_workers
+
+            def slow_stop_workers(*args):
+                time.sleep(0.2)
+                stop_workers(*args)
+            conn._stop_workers = slow_stop_workers
+            ticks = []
+
+            async def tick():
+                while True:
+                    ticks.append(None)
+                    await asyncio.sleep(0.01)
+            ticker = asyncio.ensure_future(tick())
+            await conn.stop()
+            ticker.cancel()
+            await cul.stop()
+            return len(ticks)
+        self.assertGreater(self.run_async(scenario()), 5)
+
+    def test_commands_dropped_while_sending(self):
+        async def scenario():
+            cul = FakeCul()
+            path = await cul.start()
+            async with AsyncMaxConnection(path, paired_devices=[THERMOSTAT_ID]) as conn:
+                expired = await asyncio.wait_for(
+                    conn.set_temperature(THERMOSTAT_ID, 21, 'manual', deadline=0), 5)
+                failed = await asyncio.wait_for(
+                    conn.set_temperature(THERMOSTAT_ID, 21, 'bogus'), 5)
+            await cul.stop()
+            return expired, failed
+        self.assertEqual(self.run_async(scenario()), (False, False))
+
+    def test_reconnect_after_disconnect(self):
+        async def scenario():
+            cul = FakeCul()
+            path = await cul.start()
+            async with AsyncMaxConnection(path, paired_devices=[THERMOSTAT_ID]) as conn:
+                cul.drop()
+                await asyncio.wait_for(self.reconnected(cul, conn), 5)
+                acked = await asyncio.wait_for(
+                    conn.set_temperature(THERMOSTAT_ID, 21, 'manual'), 5)
+            await cul.stop()
+            return acked
+        with mock.patch.object(_aio, 'RECONNECT_DELAYS', (0.1,)):
+            self.assertTrue(self.run_async(scenario()))
+
+    async def reconnected(self, cul, conn):
+        while cul.written.count("X21") < 2 or not conn.com.is_connected:
+            await asyncio.sleep(0.05)
+
+    def test_connection_lost(self):
+        async def scenario():
+            cul = FakeCul()
+            path = await cul.start()
+            async with AsyncMaxConnection(path, paired_devices=[THERMOSTAT_ID]) as conn:
+                events = [event async for event in self.lose(cul, conn.events())]
+                self.assertFalse(conn.com.is_connected)
+                with self.assertRaises(CommunicationError):
+                    await conn.set_temperature(THERMOSTAT_ID, 21, 'manual')
+            return events
+        with mock.patch.object(_aio, 'RECONNECT_DELAYS', (0.1, 0.1)):
+            self.assertEqual(self.run_async(scenario()), [])
+
+    async def lose(self, cul, events):
+        """Takes the CUL stick down while iterating over events"""
+        next_event = asyncio.ensure_future(events.__anext__())
+        await asyncio.sleep(0.1)
+        cul.drop()
+        await cul.stop()
+        try:
+            yield await asyncio.wait_for(next_event, 5)
+        except StopAsyncIteration:
+            return
@@ -0,0 +1,118 @@
+import os
+import sys
+import tempfile
+import unittest
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../../')
+
+from maxcul._archive import CaptureWriter, CaptureArchive, BUCKET_SECONDS, INDEX_SUFFIX
+from maxcul._exceptions import MoritzError
+from maxcul._messages import ThermostatStateMessage, AckMessage
+from maxcul.test.test_protocol import FakeProtocol, THERMOSTAT_ID, THERMOSTAT_STATE
+
+OTHER_ID = 0x039EA5
+ACK = "Z0E010202%06X123456000119000B2C"
+
+
+class CaptureArchiveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'capture.bin')
+        self.writer = CaptureWriter(self.path)
+        other_state = THERMOSTAT_STATE.replace("08FFE9", "%06X" % OTHER_ID)
+        for hour in range(4):
+            timestamp = hour * BUCKET_SECONDS
+            self.writer.add_line(THERMOSTAT_STATE, timestamp)
+            self.writer.add_line(other_state, timestamp + 1)
+            self.writer.add_line(ACK % OTHER_ID, timestamp + 2)
+
+    def tearDown(self):
+        self.writer.close()
+        self.directory.cleanup()
+
+    def open(self):
+        self.writer.flush()
+        archive = CaptureArchive(self.path)
+        self.addCleanup(archive.close)
+        return archive
+
+    def test_frames_round_trip(self):
+        frames = list(self.open().query(device_id=THERMOSTAT_ID))
+        self.assertEqual(len(frames), 4)
+        self.assertEqual(frames[0].frame + "2C", THERMOSTAT_STATE)
+        self.assertEqual(frames[0].rssi, -52.0)
+        self.assertIsInstance(frames[0].message, ThermostatStateMessage)
+        self.assertEqual(frames[0].message.measured_temperature, 20.2)
+
+    def test_queries(self):
+        archive = self.open()
+        frames = list(archive.query(OTHER_ID, start=BUCKET_SECONDS, end=3 * BUCKET_SECONDS))
+        self.assertEqual([frame.timestamp for frame in frames],
+                         [3601, 3602, 7201, 7202])
+        acks = list(archive.query(OTHER_ID, message_types=[AckMessage]))
+        self.assertEqual(len(acks), 4)
+        self.assertTrue(all(isinstance(frame.message, AckMessage) for frame in acks))
+        self.assertEqual(len(list(archive.query(start=2 * BUCKET_SECONDS))), 6)
+        self.assertEqual(list(archive.query(0x123)), [])
+
+    def test_frames_after_the_index_and_reopening(self):
+        archive = self.open()
+        self.writer.add_line(THERMOSTAT_STATE, 5 * BUCKET_SECONDS)
+        # written but not indexed yet
+        self.writer._write_batch(self.writer._drain([]))
+        archive.refresh()
+        self.assertEqual(len(list(archive.query(THERMOSTAT_ID))), 5)
+        self.writer.close()
+        self.writer = CaptureWriter(self.path)
+        self.assertEqual(len(self.writer), 13)
+        self.writer.add_line(THERMOSTAT_STATE, 6 * BUCKET_SECONDS)
+        self.assertEqual(len(list(self.open().query(THERMOSTAT_ID))), 6)
+
+    def test_index_is_appended_to(self):
+        self.writer.flush()
+        with open(self.path + INDEX_SUFFIX, 'rb') as index:
+            before = index.read()
+        self.writer.add_line(THERMOSTAT_STATE, 5 * BUCKET_SECONDS)
+        self.writer.flush()
+        with open(self.path + INDEX_SUFFIX, 'rb') as index:
+            after = index.read()
+        self.assertGreater(len(after), len(before))
+        self.assertEqual(after[:len(before)], before)
+        self.assertEqual(len(list(self.open().query(THERMOSTAT_ID))), 5)
+
+    def test_torn_index_block(self):
+        self.writer.close()
+        with open(self.path + INDEX_SUFFIX, 'r+b') as index:
+            index.truncate(os.path.getsize(self.path + INDEX_SUFFIX) - 3)
+        self.writer = CaptureWriter(self.path)
+        self.writer.add_line(THERMOSTAT_STATE, 5 * BUCKET_SECONDS)
+        frames = list(self.open().query(OTHER_ID, start=BUCKET_SECONDS))
+        self.assertEqual(len(frames), 6)
+
+    def test_clock_set_back(self):
+        self.writer.add_line(THERMOSTAT_STATE, BUCKET_SECONDS)
+        self.writer.add_line(THERMOSTAT_STATE, 4 * BUCKET_SECONDS)
+        archive = self.open()
+        self.assertEqual(
+            [frame.timestamp for frame in archive.query(THERMOSTAT_ID, start=3 * BUCKET_SECONDS)],
+            [3 * BUCKET_SECONDS, 3 * BUCKET_SECONDS + 2, 4 * BUCKET_SECONDS])
+        self.assertEqual(len(list(archive.query(end=3 * BUCKET_SECONDS))), 9)
+
+    def test_writer_thread(self):
+        self.writer.start()
+        for hour in range(4, 8):
+            self.writer.add_line(THERMOSTAT_STATE, hour * BUCKET_SECONDS)
+        self.writer.stop()
+        self.assertEqual(len(self.writer), 16)
+        self.assertEqual(len(list(self.open().query(THERMOSTAT_ID))), 8)
+
+    def test_malformed_lines(self):
+        self.assertRaises(MoritzError, self.writer.add_line, "Z0F6104")
+        self.assertRaises(MoritzError, self.writer.add_line, "LOVF")
+
+    def test_protocol_captures_frames(self):
+        protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID], capture=self.writer)
+        protocol._process_frame(THERMOSTAT_STATE)
+        protocol._stop_workers()
+        self.assertEqual(len(list(self.open().query(THERMOSTAT_ID))), 5)
@@ -0,0 +1,120 @@
+import os
+import sys
+import asyncio
+import json
+import tempfile
+import unittest
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../../')
+
+from maxcul import AsyncMaxConnection
+from maxcul._daemon import MaxDaemon
+from maxcul._const import EVENT_THERMOSTAT_UPDATE
+from maxcul.test.test_aio import FakeCul, THERMOSTAT_ID
+
+
+class MaxDaemonTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.directory.name, 'maxcul.sock')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_daemon(self, scenario, **kwargs):
+        async def run():
+            cul = FakeCul()
+            path = await cul.start()
+            async with AsyncMaxConnection(path, paired_devices=[THERMOSTAT_ID]) as conn:
+                daemon = MaxDaemon(conn, self.socket_path, **kwargs)
+                await daemon.start()
+                try:
+                    return await asyncio.wait_for(scenario(cul, daemon), 5)
+                finally:
+                    await daemon.stop()
+                    await cul.stop()
+        return asyncio.run(run())
+
+    async def connect(self):
+        return await asyncio.open_unix_connection(self.socket_path)
+
+    async def request(self, reader, writer, **request):
+        writer.write((json.dumps(request) + "\n").encode())
+        return await self.response(reader)
+
+    async def response(self, reader):
+        while True:
+            response = json.loads(await reader.readline())
+            if 'event' not in response:
+                return response
+
+    def test_filtered_events_and_commands(self):
+        async def scenario(cul, daemon):
+            reader, writer = await self.connect()
+            other_reader, other_writer = await self.connect()
+            self.assertEqual(
+                await self.request(reader, writer, op='subscribe', id=1,
+                                   events=[EVENT_THERMOSTAT_UPDATE], devices=[THERMOSTAT_ID]),
+                {'id': 1, 'result': True})
+            await self.request(other_reader, other_writer, op='subscribe', devices=[0x123])
+            cul.send("Z0F61046008FFE90000000019002000CA2C")
+            event = json.loads(await reader.readline())
+            acked = await self.request(
+                reader, writer, op='set_temperature', id=2,
+                device_id=THERMOSTAT_ID, temperature=21, mode='manual')
+            unknown = await self.request(reader, writer, op='reboot', id=3)
+            missing = await self.request(reader, writer, op='wakeup', id=4)
+            other_writer.close()
+            writer.close()
+            return event, acked, unknown, missing
+        event, acked, unknown, missing = self.run_daemon(scenario)
+        self.assertEqual(event['event'], EVENT_THERMOSTAT_UPDATE)
+        self.assertEqual(event['payload']['measured_temperature'], 20.2)
+        self.assertEqual(acked, {'id': 2, 'result': True})
+        self.assertIn('error', unknown)
+        self.assertEqual(missing['error'], "KeyError: 'device_id'")
+
+    def test_slow_clients_are_disconnected(self):
+        async def scenario(cul, daemon):
+            reader, writer = await self.connect()
+            await self.request(reader, writer, op='subscribe')
+            payload = {'device_id': THERMOSTAT_ID, 'padding': 'x' * 1000}
+            for _ in range(2000):
+                daemon.publish(EVENT_THERMOSTAT_UPDATE, payload)
+                if not daemon.clients:
+                    break
+            clients = len(daemon.clients)
+            writer.close()
+            return clients
+        self.assertEqual(self.run_daemon(scenario, max_buffered=1024), 0)
+
+    def test_malformed_requests(self):
+        async def scenario(cul, daemon):
+            reader, writer = await self.connect()
+            writer.write(b'[1, 2]\n')
+            not_an_object = await self.response(reader)
+            acked = await self.request(
+                reader, writer, op='set_temperature', id=1,
+                device_id=THERMOSTAT_ID, temperature=21, mode='manual')
+            running = len(daemon._tasks)
+            bad_devices = await self.request(reader, writer, op='subscribe', id=2, devices=5)
+            bad_events = await self.request(
+                reader, writer, op='subscribe', id=3, events='thermostat_update')
+            nested = await self.request(reader, writer, op='subscribe', id=4, devices=[[1]])
+            self.assertEqual(bad_devices, {'id': 2, 'error': "devices has to be a list"})
+            self.assertEqual(bad_events, {'id': 3, 'error': "events has to be a list"})
+            self.assertIn('error', nested)
+            self.assertIsNone(next(iter(daemon.clients)).events)
+            writer.write(b'x' * 100000 + b'\n')
+            too_long = await self.response(reader)
+            # the daemon hangs up, at most events are still pending
+            closed = await reader.read()
+            writer.close()
+            return not_an_object, acked, running, too_long, closed
+        not_an_object, acked, running, too_long, closed = self.run_daemon(scenario)
+        self.assertEqual(not_an_object, {'error': "Requests have to be JSON objects"})
+        self.assertEqual(acked, {'id': 1, 'result': True})
+        self.assertEqual(running, 0)
+        self.assertIn('error', too_long)
+        self.assertNotIn(b'"id"', closed)
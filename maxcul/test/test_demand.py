@@ -0,0 +1,56 @@
+import os
+import sys
+import unittest
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../../')
+
+from maxcul._demand import HeatingDemand, DEMAND_MAX, DEMAND_MEAN, DEMAND_ABOVE
+from maxcul.test.test_protocol import FakeProtocol, THERMOSTAT_ID, THERMOSTAT_STATE
+
+
+class HeatingDemandTestCase(unittest.TestCase):
+    def setUp(self):
+        self.demand = HeatingDemand(threshold=30)
+        self.calls = []
+        self.demand.watch(DEMAND_MAX, 50, lambda *args: self.calls.append(args))
+
+    def test_aggregates(self):
+        self.assertEqual(self.demand.as_dict(), {DEMAND_MAX: None, DEMAND_MEAN: None, DEMAND_ABOVE: 0})
+        self.demand.update(1, 20)
+        self.demand.update(2, 80)
+        self.demand.set_weight(2, 3)
+        self.assertEqual(self.demand.max, 80)
+        self.assertEqual(self.demand.mean, 65)
+        self.assertEqual(self.demand.above, 1)
+        self.demand.update(2, 10)
+        self.assertEqual(self.demand.max, 20)
+        self.assertEqual(self.demand.mean, 12.5)
+        self.assertEqual(self.demand.above, 0)
+        self.demand.remove(1)
+        self.demand.remove(2)
+        self.assertEqual(self.demand.as_dict(), {DEMAND_MAX: None, DEMAND_MEAN: None, DEMAND_ABOVE: 0})
+
+    def test_watchers_are_called_on_crossings_only(self):
+        self.demand.update(1, 40)
+        self.demand.update(2, 60)
+        self.demand.update(3, 70)
+        self.demand.update(2, 10)
+        self.demand.update(3, 50)
+        self.assertEqual(self.calls, [(DEMAND_MAX, 60, True), (DEMAND_MAX, 50, False)])
+
+    def test_watching_several_aggregates(self):
+        above = []
+        self.demand.watch(DEMAND_ABOVE, 1, lambda *args: above.append(args))
+        for device_id in range(3):
+            self.demand.update(device_id, 35)
+        self.assertEqual(above, [(DEMAND_ABOVE, 2, True)])
+
+
+class ProtocolDemandTestCase(unittest.TestCase):
+    def test_valve_positions_are_fed(self):
+        demand = HeatingDemand()
+        protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID], demand=demand)
+        protocol._process_frame(THERMOSTAT_STATE)
+        self.assertEqual(len(demand), 1)
+        self.assertEqual(demand.max, 0)
@@ -0,0 +1,129 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../../')
+
+from maxcul._dispatch import CallbackDispatcher
+from maxcul._metrics import MetricsRegistry
+from maxcul._const import ATTR_DEVICE_ID
+from maxcul.test.test_protocol import FakeProtocol, THERMOSTAT_ID, THERMOSTAT_STATE
+
+
+class CallbackDispatcherTestCase(unittest.TestCase):
+    def test_keeps_order_per_device(self):
+        received = {}
+
+        def callback(event, payload):
+            received.setdefault(payload[ATTR_DEVICE_ID], []).append(event)
+
+        dispatcher = CallbackDispatcher(callback, workers=3, max_queued=1000)
+        dispatcher.start()
+        for index in range(200):
+            for device_id in (1, 2, 3, 4):
+                dispatcher.dispatch(index, {ATTR_DEVICE_ID: device_id})
+        dispatcher.stop(5)
+        for device_id in (1, 2, 3, 4):
+            self.assertEqual(received[device_id], list(range(200)))
+        self.assertEqual(dispatcher.statistics()['calls'], 800)
+
+    def test_dispatch_never_blocks(self):
+        release = threading.Event()
+        dispatcher = CallbackDispatcher(
+            lambda event, payload: release.wait(), workers=1, max_queued=4)
+        dispatcher.start()
+        started = time.monotonic()
+        results = [dispatcher.dispatch('event', {ATTR_DEVICE_ID: 1})
+                   for _ in range(20)]
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertFalse(all(results))
+        self.assertTrue(dispatcher.slow_consumer)
+        release.set()
+        dispatcher.stop(5)
+        statistics = dispatcher.statistics()
+        self.assertEqual(statistics['dropped'], results.count(False))
+        self.assertEqual(statistics['queued'], 0)
+        self.assertFalse(dispatcher.slow_consumer)
+
+    def test_stop_with_stuck_consumer(self):
+        release = threading.Event()
+        dispatcher = CallbackDispatcher(
+            lambda event, payload: release.wait(), workers=1, max_queued=4)
+        dispatcher.start()
+        for _ in range(10):
+            dispatcher.dispatch('event', {ATTR_DEVICE_ID: 1})
+        started = time.monotonic()
+        dispatcher.stop(0.2)
+        self.assertLess(time.monotonic() - started, 1)
+        release.set()
+        self.assertEqual(dispatcher.statistics()['dropped'], 6)
+
+    def test_callback_errors_are_counted(self):
+        def callback(event, payload):
+            raise ValueError(event)
+
+        dispatcher = CallbackDispatcher(callback, workers=2)
+        dispatcher.start()
+        dispatcher.dispatch('event', {ATTR_DEVICE_ID: 1})
+        dispatcher.stop(5)
+        self.assertEqual(dispatcher.statistics()['errors'], 1)
+
+    def test_falling_behind_per_worker(self):
+        release = threading.Event()
+        done = threading.Event()
+
+        def callback(event, payload):
+            if payload[ATTR_DEVICE_ID] == 0:
+                release.wait()
+            else:
+                done.set()
+
+        dispatcher = CallbackDispatcher(callback, workers=2, max_queued=4)
+        dispatcher.start()
+        for _ in range(3):
+            dispatcher.dispatch('event', {ATTR_DEVICE_ID: 0})
+        self.assertTrue(dispatcher.slow_consumer)
+        # the other worker catching up does not hide the blocked one
+        dispatcher.dispatch('event', {ATTR_DEVICE_ID: 1})
+        self.assertTrue(done.wait(5))
+        time.sleep(0.05)
+        self.assertTrue(dispatcher.slow_consumer)
+        release.set()
+        dispatcher.stop(5)
+        self.assertFalse(dispatcher.slow_consumer)
+
+    def test_metrics(self):
+        def callback(event, payload):
+            if event == 'slow':
+                time.sleep(0.02)
+            elif event == 'error':
+                raise ValueError(event)
+
+        metrics = MetricsRegistry()
+        dispatcher = CallbackDispatcher(
+            callback, workers=1, slow_threshold=0.01, metrics=metrics)
+        dispatcher.start()
+        for event in ('fast', 'slow', 'error'):
+            dispatcher.dispatch(event, {ATTR_DEVICE_ID: 1})
+        dispatcher.stop(5)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['maxcul_callback_latency_seconds'][('0',)]['count'], 3)
+        self.assertEqual(snapshot['maxcul_callback_slow_calls_total'], {('0',): 1})
+        self.assertEqual(snapshot['maxcul_callback_errors_total'], {('0',): 1})
+        self.assertEqual(snapshot['maxcul_callback_events_dropped_total'], 0)
+
+    def test_protocol_counts_callback_errors(self):
+        protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID], callback_workers=1)
+
+        def callback(event, payload):
+            raise ValueError(event)
+        protocol.callback = callback
+        protocol._start_workers()
+        protocol._process_frame(THERMOSTAT_STATE)
+        protocol._stop_workers(5)
+        self.assertEqual(protocol.callback_statistics['errors'], 1)
+        self.assertEqual(
+            protocol.metrics.snapshot()['maxcul_callback_errors_total'], {('0',): 1})
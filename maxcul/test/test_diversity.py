@@ -0,0 +1,100 @@
+import os
+import sys
+import unittest
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../../')
+
+from maxcul._communication import MaxConnection
+from maxcul._diversity import DuplicateFilter, StickRouter
+from maxcul._fastpath import FastResponder
+from maxcul._messages import MoritzMessage
+from maxcul.test.test_protocol import THERMOSTAT_ID, THERMOSTAT_STATE
+
+
+class FakeStick(object):
+    def __init__(self, send_budget=5000):
+        self.send_budget = send_budget
+        self.enqueued = []
+
+    @property
+    def has_send_budget(self):
+        return self.send_budget >= 2000
+
+    def is_alive(self):
+        return True
+
+    def enqueue_command(self, command, trace=None):
+        self.enqueued.append(command)
+
+
+def heard_with(line, rssi_byte):
+    return line[:-2] + "%02X" % rssi_byte
+
+
+class DuplicateFilterTestCase(unittest.TestCase):
+    def test_window(self):
+        duplicates = DuplicateFilter(window=0.5)
+        self.assertTrue(duplicates.first_copy('a', 10.0))
+        self.assertFalse(duplicates.first_copy('a', 10.4))
+        self.assertTrue(duplicates.first_copy('b', 10.4))
+        self.assertTrue(duplicates.first_copy('a', 10.6))
+        self.assertEqual(len(duplicates), 2)
+
+
+class StickRouterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.near, self.far = FakeStick(), FakeStick(send_budget=9000)
+        self.router = StickRouter([self.near, self.far])
+
+    def test_copies_are_processed_once(self):
+        self.assertTrue(self.router.receive(self.far, heard_with(THERMOSTAT_STATE, 0x10), 1.0))
+        self.assertFalse(self.router.receive(self.near, heard_with(THERMOSTAT_STATE, 0x40), 1.1))
+        self.assertEqual(
+            self.router.signal_strengths(THERMOSTAT_ID, 1.1),
+            {self.far: -66.0, self.near: -42.0})
+
+    def test_routing(self):
+        # nobody heard the device yet, the stick with most budget sends
+        self.assertIs(self.router.route(THERMOSTAT_ID, 1.0), self.far)
+        self.router.receive(self.far, heard_with(THERMOSTAT_STATE, 0x10), 1.0)
+        self.router.receive(self.near, heard_with(THERMOSTAT_STATE, 0x40), 1.0)
+        self.assertIs(self.router.route(THERMOSTAT_ID, 2.0), self.near)
+        self.near.send_budget = 1000
+        self.assertIs(self.router.route(THERMOSTAT_ID, 2.0), self.far)
+
+
+class MultiStickConnectionTestCase(unittest.TestCase):
+    def test_receive_and_transmit(self):
+        connection = MaxConnection(['/dev/ttyUSB0', '/dev/ttyUSB1'], paired_devices=[THERMOSTAT_ID])
+        near, far = connection.com_threads
+        connection._transport_ready = lambda: True
+        events = []
+        connection.callback = lambda event, payload: events.append(event)
+        connection.com_thread.read_queue.put((heard_with(THERMOSTAT_STATE, 0x10), False, None, far, 1.0))
+        connection.com_thread.read_queue.put((heard_with(THERMOSTAT_STATE, 0x40), False, None, near, 1.1))
+        connection._receive_message()
+        connection._receive_message()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(near.pending_commands, 1)
+        ack = MoritzMessage.decode_message(near._send_queue[0][0])
+        self.assertEqual(ack.receiver_id, THERMOSTAT_ID)
+        self.assertEqual(far.pending_commands, 0)
+
+    def test_copies_are_matched_by_read_time(self):
+        connection = MaxConnection(['/dev/ttyUSB0', '/dev/ttyUSB1'], paired_devices=[THERMOSTAT_ID])
+        near, far = connection.com_threads
+        connection._transport_ready = lambda: True
+        received = []
+        connection._process_frame = lambda line, answered, trace: received.append(line)
+        # read seconds apart, the second one is a repetition and no copy
+        for thread, read_at in ((far, 1.0), (near, 3.0)):
+            connection.com_thread.read_queue.put((THERMOSTAT_STATE, False, None, thread, read_at))
+        connection._receive_message()
+        connection._receive_message()
+        self.assertEqual(len(received), 2)
+
+    def test_shared_fast_path_answers_once(self):
+        responder = FastResponder(0x123456, [THERMOSTAT_ID], lambda: False, duplicate_window=0.5)
+        self.assertIsNotNone(responder.respond(THERMOSTAT_STATE))
+        self.assertIsNone(responder.respond(heard_with(THERMOSTAT_STATE, 0x40)))
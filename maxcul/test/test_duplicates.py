@@ -0,0 +1,49 @@
+import os
+import sys
+import unittest
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../../')
+
+from maxcul._duplicates import ReceiveCache
+from maxcul.test.test_protocol import FakeProtocol, THERMOSTAT_ID, THERMOSTAT_STATE
+
+
+class ReceiveCacheTestCase(unittest.TestCase):
+    def test_ttl(self):
+        cache = ReceiveCache(ttl=10)
+        cache.add('a', 0)
+        self.assertIsNotNone(cache.lookup('a', 9.9))
+        self.assertIsNone(cache.lookup('a', 10))
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_seen_are_evicted(self):
+        cache = ReceiveCache(max_entries=2)
+        cache.add('a', 0)
+        cache.add('b', 0)
+        cache.lookup('a', 1)
+        cache.add('c', 1)
+        self.assertIsNotNone(cache.lookup('a', 1))
+        self.assertIsNone(cache.lookup('b', 1))
+
+
+class DuplicateFramesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID])
+        self.protocol._process_frame(THERMOSTAT_STATE)
+
+    def test_repeated_frame_is_acknowledged_again(self):
+        self.protocol._process_frame(THERMOSTAT_STATE)
+        self.assertEqual(len(self.protocol.events), 1)
+        self.assertEqual(len(self.protocol.sent), 2)
+        self.assertEqual(self.protocol.sent[0].encode_message(), self.protocol.sent[1].encode_message())
+        self.assertEqual(self.protocol.metrics.snapshot()['maxcul_duplicate_frames_total'], 1)
+
+    def test_repeated_frame_answered_by_transport(self):
+        self.protocol._process_frame(THERMOSTAT_STATE, answered=True)
+        self.assertEqual(len(self.protocol.sent), 1)
+
+    def test_new_counter_is_handled(self):
+        self.protocol._process_frame(THERMOSTAT_STATE[:3] + "62" + THERMOSTAT_STATE[5:])
+        self.assertEqual(self.protocol.sent[1].counter, 0x62)
+        self.assertEqual(self.protocol.metrics.snapshot()['maxcul_duplicate_frames_total'], 0)
@@ -0,0 +1,61 @@
+import os
+import sys
+import unittest
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../../')
+
+from maxcul._links import LinkHistory
+from maxcul._protocol import BACKOFF_INTERVAL
+from maxcul.test.test_protocol import FakeProtocol, THERMOSTAT_ID, THERMOSTAT_STATE
+
+
+def raw(dbm):
+    return int((dbm + 74) * 2) & 0xFF
+
+
+class LinkHistoryTestCase(unittest.TestCase):
+    def test_rolling_signal_statistics(self):
+        history = LinkHistory(size=4)
+        for second, dbm in enumerate((-90, -60, -70, -80, -50, -100)):
+            history.record_frame(raw(dbm), float(second))
+        self.assertEqual(history.frames, 4)
+        self.assertEqual(history.rssi_values(), [-70, -80, -50, -100])
+        self.assertEqual(history.mean_rssi(), -75)
+        self.assertEqual(history.percentile_rssi(50), -80)
+        self.assertEqual(history.percentile_rssi(100), -50)
+        self.assertEqual(history.percentile_rssi(0), -100)
+        self.assertEqual(history.last_rssi, -100)
+        self.assertEqual(history.last_seen, 5.0)
+        self.assertEqual(history.frame_interval(), 1.0)
+
+    def test_loss_ratio(self):
+        history = LinkHistory(size=4)
+        self.assertIsNone(history.loss_ratio())
+        for lost in (True, True, False, True, False, False):
+            history.record_transmission(lost)
+        self.assertEqual(history.transmissions, 4)
+        self.assertEqual(history.loss_ratio(), 0.25)
+
+    def test_empty_history(self):
+        statistics = LinkHistory().statistics()
+        self.assertEqual(statistics['frames'], 0)
+        self.assertIsNone(statistics['mean_rssi'])
+        self.assertIsNone(statistics['median_rssi'])
+        self.assertIsNone(statistics['frame_interval'])
+
+
+class ProtocolLinksTestCase(unittest.TestCase):
+    def test_frames_and_retransmissions_are_recorded(self):
+        protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID])
+        protocol._process_frame(THERMOSTAT_STATE)
+        protocol.set_temperature(THERMOSTAT_ID, 21, 'manual')
+        key, (when, attempt, msg) = next(iter(protocol._outstanding_acks.items()))
+        protocol._outstanding_acks[key] = (when - BACKOFF_INTERVAL, attempt, msg)
+        protocol._resend_message()
+        protocol.ack(msg)
+        history = protocol.links.get(THERMOSTAT_ID)
+        self.assertEqual(history.last_rssi, -52.0)
+        self.assertEqual(history.transmissions, 2)
+        self.assertEqual(history.loss_ratio(), 0.5)
+        self.assertEqual(protocol.links.statistics()[THERMOSTAT_ID]['frames'], 2)
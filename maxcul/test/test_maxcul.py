@@ -439,6 +439,19 @@ class MessageSampleInputTestCase(unittest.TestCase):
         #wallthermostat updated <WallThermostatStateMessage counter:c0 flag:4 sender:17a955 receiver:0 group:0 payload:59011900D9>
 
 
+    def test_push_button_state(self):
+        sample = "Z0C0B04501234560000000050012C"
+        msg = MoritzMessage.decode_message(sample[:-2])
+        self.assertTrue(isinstance(msg, PushButtonStateMessage))
+        self.assertEqual(msg.sender_id, 0x123456)
+        self.assertEqual(msg.decode_payload("5001"), {
+            'state': True,
+            'rferror': False,
+            'battery_low': True,
+            'is_retransmission': True,
+        })
+
+
 class MessageGeneralOutputTestCase(unittest.TestCase):
     def test_encoding_without_payload(self):
         expected_result = "Zs0AB900F11234560B355400"
@@ -0,0 +1,90 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.request
+from http.server import HTTPServer
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../../')
+
+from maxcul._metrics import MetricsRegistry
+from maxcul.test.test_protocol import FakeProtocol, THERMOSTAT_ID, THERMOSTAT_STATE
+
+
+class MetricsRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.registry.counter('frames_total', 'Frames').inc(3)
+        self.registry.counter('errors_total', 'Errors', ('error',)).labels('ValueError').inc()
+        self.registry.gauge('depth', 'Depth', function=lambda: 7)
+        histogram = self.registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+
+    def test_snapshot(self):
+        snapshot = self.registry.snapshot()
+        self.assertEqual(snapshot['frames_total'], 3)
+        self.assertEqual(snapshot['errors_total'], {('ValueError',): 1})
+        self.assertEqual(snapshot['depth'], 7)
+        self.assertEqual(snapshot['latency_seconds']['count'], 3)
+
+    def test_prometheus_text(self):
+        text = self.registry.prometheus_text()
+        self.assertIn('# TYPE frames_total counter\nframes_total 3\n', text)
+        self.assertIn('errors_total{error="ValueError"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 2\n', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3\n', text)
+        self.assertIn('latency_seconds_count 3\n', text)
+
+    def test_conflicting_registration(self):
+        self.assertIs(self.registry.counter('frames_total', 'Frames'),
+                      self.registry.counter('frames_total', 'Frames'))
+        self.assertRaises(ValueError, self.registry.gauge, 'frames_total', 'Frames')
+        self.assertRaises(ValueError, self.registry.counter, 'errors_total', 'Errors')
+
+    def test_file_and_http_exposition(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'maxcul.prom')
+            self.registry.write_prometheus(path)
+            with open(path) as exported:
+                self.assertEqual(exported.read(), self.registry.prometheus_text())
+
+        server = HTTPServer(('127.0.0.1', 0), self.registry.http_handler())
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % server.server_port) as response:
+                self.assertEqual(response.read().decode(), self.registry.prometheus_text())
+        finally:
+            thread.join()
+            server.server_close()
+
+
+class ProtocolMetricsTestCase(unittest.TestCase):
+    def test_protocol_is_instrumented(self):
+        protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID])
+        protocol._process_frame(THERMOSTAT_STATE)
+        protocol._process_frame("Z0F")
+        protocol.set_temperature(THERMOSTAT_ID, 21, 'manual')
+        protocol.ack(protocol.sent[-1])
+        snapshot = protocol.metrics.snapshot()
+        self.assertEqual(snapshot['maxcul_frames_received_total'], 3)
+        self.assertEqual(snapshot['maxcul_frames_decoded_total'], 2)
+        self.assertEqual(list(snapshot['maxcul_decode_errors_total'].values()), [1])
+        self.assertEqual(snapshot['maxcul_commands_sent_total'], 1)
+        self.assertEqual(snapshot['maxcul_ack_latency_seconds']['count'], 1)
+        self.assertEqual(snapshot['maxcul_device_rssi_dbm'], {('08FFE9',): -52.0})
+        self.assertEqual(snapshot['maxcul_outstanding_commands'], {('123456',): 0})
+
+    def test_connections_share_a_registry(self):
+        registry = MetricsRegistry()
+        first = FakeProtocol(metrics=registry)
+        second = FakeProtocol(sender_id=0x123457, metrics=registry)
+        first.set_temperature(THERMOSTAT_ID, 21, 'manual')
+        self.assertEqual(
+            registry.snapshot()['maxcul_outstanding_commands'],
+            {('123456',): 1, ('123457',): 0})
+        self.assertIs(second.metrics, registry)
@@ -0,0 +1,644 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../../')
+
+from maxcul._protocol import MaxProtocol, BACKOFF_INTERVAL
+from maxcul._communication import MaxConnection
+from maxcul._fastpath import FastResponder
+from maxcul._io import CulIoThread
+from maxcul._scheduler import PIGGYBACK_TIMEOUT
+from maxcul._journal import CommandJournal
+from maxcul._messages import (
+    MoritzMessage, ConfigTemperaturesMessage, ConfigValveMessage, AddLinkPartnerMessage,
+    WakeUpMessage, SetTemperatureMessage)
+from maxcul._const import (
+    EVENT_THERMOSTAT_UPDATE, EVENT_SHUTTER_CONTACT_UPDATE, EVENT_COMMAND_DROPPED,
+    ATTR_CHANGES, ATTR_REASON, REASON_EXPIRED, REASON_SUPERSEDED, PRIORITY_HIGH)
+
+THERMOSTAT_ID = 0x08FFE9
+THERMOSTAT_STATE = "Z0F61046008FFE90000000019002000CA2C"
+PAIR_PING = "Z170004000E016C000000001001A04B4551303939323437362C"
+
+
+class FakeProtocol(MaxProtocol):
+    """MaxProtocol which records sent messages instead of using a CUL"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.sent = []
+        self.events = []
+        self.finished = []
+        self.callback = lambda event, payload: self.events.append((event, payload))
+
+    @property
+    def has_send_budget(self):
+        return True
+
+    def _transmit(self, raw_message):
+        self.sent.append(MoritzMessage.decode_message(raw_message))
+
+    def _transport_ready(self):
+        return True
+
+    def _command_finished(self, msg, acknowledged):
+        self.finished.append((msg, acknowledged))
+
+    def ack(self, msg, sender_id=None):
+        self._process_frame("Z0E%02X0202%06X123456000119000B2C" % (
+            msg.counter, sender_id or msg.receiver_id))
+
+
+class DeviceRegistryTestCase(unittest.TestCase):
+    def test_thermostat_state_is_recorded(self):
+        protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID])
+        protocol._process_frame(THERMOSTAT_STATE)
+        state = protocol.devices.get_state(THERMOSTAT_ID)
+        self.assertEqual(state.mode, 'manual')
+        self.assertEqual(state.desired_temperature, 16.0)
+        self.assertEqual(state.measured_temperature, 20.2)
+        self.assertEqual(state.valve_position, 0)
+        self.assertFalse(state.battery_low)
+        self.assertEqual(state.rssi, -52.0)
+        self.assertIsNotNone(state.last_seen)
+
+    def test_unknown_fields_keep_previous_values(self):
+        protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID])
+        protocol._process_frame(THERMOSTAT_STATE)
+        before = protocol.devices.get_state(THERMOSTAT_ID)
+        after = protocol.devices.update(THERMOSTAT_ID, measured_temperature=None, valve_position=40)
+        self.assertEqual(after.measured_temperature, 20.2)
+        self.assertEqual(after.valve_position, 40)
+        self.assertEqual(before.valve_position, 0)
+
+    def test_bulk_lookup(self):
+        protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID])
+        protocol._process_frame(THERMOSTAT_STATE)
+        states = protocol.devices.get_states([THERMOSTAT_ID, 0x123])
+        self.assertEqual(states[0].device_id, THERMOSTAT_ID)
+        self.assertIsNone(states[1])
+        self.assertEqual(list(protocol.devices.snapshot()), [THERMOSTAT_ID])
+
+    def test_unpaired_devices_are_ignored(self):
+        protocol = FakeProtocol()
+        protocol._process_frame(THERMOSTAT_STATE)
+        self.assertNotIn(THERMOSTAT_ID, protocol.devices)
+
+    def test_pairing_records_device_type(self):
+        protocol = FakeProtocol()
+        protocol.enable_pairing()
+        protocol._process_frame(PAIR_PING)
+        self.assertEqual(protocol.devices.get_state(0xE016C).device_type, 'HeatingThermostat')
+
+
+class DeviceStoreTestCase(unittest.TestCase):
+    def test_warm_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'maxcul.db')
+            protocol = FakeProtocol(store_path=path, paired_devices=[THERMOSTAT_ID])
+            protocol._start_workers()
+            protocol.enable_pairing()
+            protocol._process_frame(PAIR_PING)
+            protocol._process_frame(THERMOSTAT_STATE)
+            protocol._stop_workers()
+
+            restarted = FakeProtocol(store_path=path)
+            self.assertEqual(restarted.paired_devices, {THERMOSTAT_ID, 0xE016C})
+            self.assertEqual(restarted._counters, protocol._counters)
+            self.assertEqual(
+                restarted.devices.get_state(THERMOSTAT_ID),
+                protocol.devices.get_state(THERMOSTAT_ID))
+            self.assertEqual(
+                restarted.devices.get_state(0xE016C).device_type, 'HeatingThermostat')
+
+
+class CommandJournalTestCase(unittest.TestCase):
+    def test_outstanding_commands_survive_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'commands.journal')
+            protocol = FakeProtocol(journal_path=path)
+            protocol._start_workers()
+            protocol.set_temperature(THERMOSTAT_ID, 21, 'manual')
+            protocol.set_temperature(0x0B3554, 18, 'manual')
+            protocol.ack(protocol.sent[-1])
+            protocol._stop_workers()
+
+            restarted = FakeProtocol(journal_path=path)
+            self.assertEqual(len(restarted._outstanding_acks), 1)
+            when, attempt, msg = list(restarted._outstanding_acks.values())[0]
+            self.assertEqual(attempt, 1)
+            self.assertEqual(msg.receiver_id, THERMOSTAT_ID)
+            self.assertEqual(msg.desired_temperature, 21.0)
+            self.assertEqual(restarted._next_counter(THERMOSTAT_ID), msg.counter + 1)
+
+    def test_journal_is_closed_on_stop(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'commands.journal')
+            protocol = FakeProtocol(journal_path=path)
+            protocol._start_workers()
+            protocol.set_temperature(THERMOSTAT_ID, 21, 'manual')
+            journal = protocol._journal._file
+            protocol._stop_workers()
+            self.assertTrue(journal.closed)
+
+            idle = CommandJournal(path)
+            journal = idle._file
+            idle.stop()
+            self.assertTrue(journal.closed)
+            self.assertEqual(len(idle.load()), 1)
+
+    def test_deadline_and_priority_survive_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'commands.journal')
+            protocol = FakeProtocol(journal_path=path)
+            protocol._start_workers()
+            protocol.set_temperature(THERMOSTAT_ID, 21, 'manual', deadline=60, priority=PRIORITY_HIGH)
+            protocol.set_temperature(0x0B3554, 18, 'manual', deadline=60)
+            protocol._stop_workers()
+            key = (THERMOSTAT_ID, protocol.sent[0].counter)
+            deadline = protocol._scheduler.get(protocol._outstanding_acks[key][2]).deadline
+
+            with mock.patch('time.time', return_value=time.time() + 30):
+                restarted = FakeProtocol(journal_path=path)
+            command = restarted._scheduler.get(restarted._outstanding_acks[key][2])
+            self.assertEqual(command.priority, PRIORITY_HIGH)
+            self.assertAlmostEqual(command.deadline, deadline - 30, places=1)
+            self.assertEqual(command.attempt, 1)
+
+            with mock.patch('time.time', return_value=time.time() + 90):
+                expired = FakeProtocol(journal_path=path)
+                expired._resend_message()
+            self.assertEqual(expired._outstanding_acks, {})
+            self.assertEqual(expired.sent, [])
+            self.assertEqual(
+                [payload[ATTR_REASON] for event, payload in expired.events
+                 if event == EVENT_COMMAND_DROPPED], [REASON_EXPIRED, REASON_EXPIRED])
+
+
+class HandlerRegistryTestCase(unittest.TestCase):
+    def test_shutter_contact_is_acknowledged(self):
+        protocol = FakeProtocol(paired_devices=[0x035BCC])
+        protocol._process_frame("Z0B370630035BCC12345600102C")
+        self.assertEqual(len(protocol.sent), 1)
+        self.assertEqual(protocol.sent[0].__class__.__name__, 'AckMessage')
+        self.assertEqual(protocol.sent[0].receiver_id, 0x035BCC)
+
+    def test_plugin_handler_chains_to_default(self):
+        protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID])
+        seen = []
+
+        def handler(msg, signal_strength):
+            seen.append(msg)
+            previous(msg, signal_strength)
+
+        previous = protocol.register_handler(0x60, handler)
+        protocol._process_frame(THERMOSTAT_STATE)
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(len(protocol.events), 1)
+        statistics = protocol.handler_statistics()['ThermostatStateMessage']
+        self.assertEqual(statistics['calls'], 1)
+        self.assertEqual(statistics['errors'], 0)
+
+
+class ChangeEventTestCase(unittest.TestCase):
+    def test_unchanged_state_is_not_reported(self):
+        protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID])
+        protocol._process_frame(THERMOSTAT_STATE)
+        protocol._process_frame(THERMOSTAT_STATE)
+        self.assertEqual(len(protocol.events), 1)
+        protocol._process_frame("Z0F62046008FFE90000000019002000CB2C")
+        self.assertEqual(len(protocol.events), 2)
+        event, payload = protocol.events[1]
+        self.assertEqual(event, EVENT_THERMOSTAT_UPDATE)
+        self.assertEqual(payload[ATTR_CHANGES], {'measured_temperature': (20.2, 20.3)})
+        self.assertEqual(payload['desired_temperature'], 16.0)
+
+    def test_shutter_contact_events(self):
+        protocol = FakeProtocol(paired_devices=[0x035BCC])
+        protocol._process_frame("Z0B370630035BCC00000000102C")
+        protocol._process_frame("Z0B380630035BCC00000000122C")
+        protocol._process_frame("Z0B390630035BCC00000000122C")
+        self.assertEqual(
+            [(event, payload[ATTR_CHANGES]) for event, payload in protocol.events],
+            [(EVENT_SHUTTER_CONTACT_UPDATE, {'state': (None, 'close'), 'battery_low': (None, False)}),
+             (EVENT_SHUTTER_CONTACT_UPDATE, {'state': ('close', 'open')})])
+
+
+class GroupCommandTestCase(unittest.TestCase):
+    MEMBERS = (0x0B3554, 0x0B3555, 0x0B3556)
+
+    def setUp(self):
+        self.protocol = FakeProtocol(paired_devices=self.MEMBERS)
+        for member in self.MEMBERS:
+            self.protocol.set_group_id(member, 3)
+            self.protocol.ack(self.protocol.sent[-1])
+        self.protocol.sent = []
+
+    def test_membership_is_tracked(self):
+        self.assertEqual(self.protocol.groups, {3: frozenset(self.MEMBERS)})
+        self.assertEqual(self.protocol.devices.get_state(0x0B3554).group_id, 3)
+        self.protocol.remove_group_id(0x0B3554)
+        self.protocol.ack(self.protocol.sent[-1])
+        self.assertEqual(self.protocol.groups, {3: frozenset(self.MEMBERS[1:])})
+
+    def test_single_frame_and_straggler_retry(self):
+        self.assertTrue(self.protocol.set_group_temperature(3, 21, 'manual'))
+        self.assertEqual(len(self.protocol.sent), 1)
+        group_msg = self.protocol.sent[0]
+        self.assertEqual((group_msg.receiver_id, group_msg.group_id, group_msg.flag), (0, 3, 0x4))
+        self.protocol.ack(group_msg, self.MEMBERS[0])
+        self.protocol.ack(group_msg, self.MEMBERS[1])
+
+        self.protocol._outstanding_groups[(3, group_msg.counter)].sent -= BACKOFF_INTERVAL
+        self.protocol._resend_message()
+        retry = self.protocol.sent[-1]
+        self.assertEqual(retry.receiver_id, self.MEMBERS[2])
+        self.assertEqual(retry.desired_temperature, 21.0)
+        finished = len(self.protocol.finished)
+        self.protocol.ack(retry)
+        self.assertEqual(
+            [(msg.counter, acknowledged) for msg, acknowledged in self.protocol.finished[finished:]],
+            [(retry.counter, True), (group_msg.counter, True)])
+        self.assertEqual(self.protocol._outstanding_groups, {})
+
+
+class WakeUpSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID])
+        self.session = self.protocol.wakeup_session(THERMOSTAT_ID)
+        self.session.add(ConfigTemperaturesMessage(
+            comfort_Temperature=21, eco_Temperature=17, max_Temperature=30.5,
+            min_Temperature=4.5, measurement_Offset=0,
+            window_Open_Temperature=12, window_Open_Duration=15))
+        self.session.add(ConfigValveMessage(
+            boost_duration=5, boost_valve_position=80, decalc_day='Sat',
+            decalc_hour=12, max_valve_position=100, valve_offset=0))
+        self.session.add(AddLinkPartnerMessage(
+            assocDevice=0x035BCC, assocDeviceType='ShutterContact'))
+        self.session.set_temperature(21, 'manual')
+
+    def test_commands_follow_wakeup_ack(self):
+        self.assertTrue(self.session.send())
+        self.assertEqual([msg.__class__.__name__ for msg in self.protocol.sent], ['WakeUpMessage'])
+        self.protocol.ack(self.protocol.sent[0])
+        streamed = self.protocol.sent[1:]
+        self.assertEqual(
+            [msg.__class__.__name__ for msg in streamed],
+            ['ConfigTemperaturesMessage', 'ConfigValveMessage',
+             'AddLinkPartnerMessage', 'SetTemperatureMessage'])
+        self.assertEqual(streamed[0].window_Open_Temperature, 12)
+        self.assertEqual(streamed[1].boost_valve_position, 80)
+        self.assertEqual(streamed[2].assocDeviceType, 'ShutterContact')
+        for msg in streamed:
+            self.assertEqual(msg.receiver_id, THERMOSTAT_ID)
+            self.protocol.ack(msg)
+        self.assertEqual(self.protocol.finished[-1], (self.session, True))
+        self.assertEqual(self.protocol._sessions, {})
+
+    def test_commands_are_sent_without_preamble(self):
+        raw = []
+        self.protocol._transmit = raw.append
+        self.session.send()
+        self.protocol.ack(MoritzMessage.decode_message(raw[0]))
+        self.assertTrue(raw[0].startswith("Zs"))
+        self.assertTrue(all(frame.startswith("Zf") for frame in raw[1:]))
+
+    def test_device_which_does_not_wake_up(self):
+        self.session.send()
+        self.protocol._finish_command(self.session.wakeup, False)
+        self.assertEqual(len(self.protocol.sent), 1)
+        self.assertEqual(len(self.session.failed), 4)
+        self.assertEqual(self.protocol.finished[-1], (self.session, False))
+
+
+class PiggybackTestCase(unittest.TestCase):
+    def setUp(self):
+        self.protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID])
+        self.raw = []
+        transmit = self.protocol._transmit
+
+        def record(raw_message):
+            self.raw.append(raw_message)
+            transmit(raw_message)
+        self.protocol._transmit = record
+
+    def test_held_until_receiver_transmits(self):
+        self.assertTrue(self.protocol.set_temperature(THERMOSTAT_ID, 21, 'manual', urgent=False))
+        self.protocol._resend_message()
+        self.assertEqual(self.protocol.sent, [])
+        self.protocol._process_frame(THERMOSTAT_STATE)
+        self.assertEqual(
+            [msg.__class__.__name__ for msg in self.protocol.sent],
+            ['AckMessage', 'SetTemperatureMessage'])
+        self.assertTrue(self.raw[1].startswith("Zf"))
+        self.protocol.ack(self.protocol.sent[1])
+        self.assertEqual(self.protocol.finished[-1][1], True)
+
+    def test_not_released_by_other_frames(self):
+        self.protocol.set_temperature(THERMOSTAT_ID, 21, 'manual', urgent=False)
+        self.protocol._process_frame("Z0E050202%06X123456000119000B2C" % THERMOSTAT_ID)
+        self.assertEqual(self.protocol.sent, [])
+        self.assertEqual(len(self.protocol._scheduler), 1)
+
+    def test_held_no_longer_than_deadline(self):
+        self.protocol.set_temperature(THERMOSTAT_ID, 21, 'manual', urgent=False, deadline=30)
+        fallback, command = self.protocol._scheduler._held[THERMOSTAT_ID][0]
+        self.assertEqual(fallback, command.deadline)
+        self.protocol._scheduler._held[THERMOSTAT_ID][0] = (fallback - 30, command)
+        command.deadline -= 30
+        self.protocol._resend_message()
+        self.assertEqual(self.protocol.sent, [])
+        self.assertEqual(
+            [payload[ATTR_REASON] for event, payload in self.protocol.events
+             if event == EVENT_COMMAND_DROPPED], [REASON_EXPIRED])
+
+    def test_fallback_when_receiver_stays_silent(self):
+        self.protocol.set_temperature(THERMOSTAT_ID, 21, 'manual', urgent=False)
+        fallback, command = self.protocol._scheduler._held[THERMOSTAT_ID][0]
+        self.protocol._scheduler._held[THERMOSTAT_ID][0] = (fallback - PIGGYBACK_TIMEOUT, command)
+        self.protocol._resend_message()
+        msg = command.msg
+        self.assertEqual(len(self.protocol.sent), 1)
+        self.assertTrue(self.raw[0].startswith("Zs"))
+        self.assertIn((THERMOSTAT_ID, msg.counter), self.protocol._outstanding_acks)
+
+    def test_held_commands_survive_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'commands.journal')
+            protocol = FakeProtocol(journal_path=path, paired_devices=[THERMOSTAT_ID])
+            protocol._start_workers()
+            protocol.set_temperature(THERMOSTAT_ID, 21, 'manual', urgent=False)
+            protocol._stop_workers()
+
+            restarted = FakeProtocol(journal_path=path, paired_devices=[THERMOSTAT_ID])
+            self.assertEqual(restarted._outstanding_acks, {})
+            self.assertEqual(len(restarted._scheduler), 1)
+            restarted._process_frame(THERMOSTAT_STATE)
+            self.assertEqual(restarted.sent[-1].desired_temperature, 21.0)
+
+
+class DeadlineSchedulingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID])
+        self.backlog = 2
+        self.protocol._transport_backlog = lambda: self.backlog
+
+    def dropped(self):
+        return [payload[ATTR_REASON] for event, payload in self.protocol.events
+                if event == EVENT_COMMAND_DROPPED]
+
+    def test_priority_and_earliest_deadline_first(self):
+        self.protocol.set_temperature(0x0B3554, 18, 'manual')
+        self.protocol.set_temperature(0x0B3555, 19, 'manual', deadline=60)
+        self.protocol.set_temperature(0x0B3556, 20, 'manual', deadline=30)
+        self.protocol.set_temperature(0x0B3557, 21, 'manual', priority=PRIORITY_HIGH)
+        self.assertEqual(self.protocol.sent, [])
+        self.backlog = 0
+        self.protocol._dispatch_commands()
+        self.assertEqual(
+            [msg.receiver_id for msg in self.protocol.sent],
+            [0x0B3557, 0x0B3556, 0x0B3555, 0x0B3554])
+
+    def test_expired_command_is_dropped(self):
+        self.protocol.set_temperature(THERMOSTAT_ID, 21, 'manual', deadline=0)
+        self.backlog = 0
+        self.protocol._dispatch_commands()
+        self.assertEqual(self.protocol.sent, [])
+        self.assertEqual(self.dropped(), [REASON_EXPIRED])
+        self.assertFalse(self.protocol.finished[-1][1])
+
+    def test_expired_command_is_not_retried(self):
+        self.backlog = 0
+        self.protocol.set_temperature(THERMOSTAT_ID, 21, 'manual', deadline=5)
+        key = (THERMOSTAT_ID, self.protocol.sent[0].counter)
+        when, attempt, msg = self.protocol._outstanding_acks[key]
+        self.protocol._scheduler.get(msg).deadline -= 5
+        self.protocol._outstanding_acks[key] = (when - BACKOFF_INTERVAL, attempt, msg)
+        self.protocol._resend_message()
+        self.assertEqual(len(self.protocol.sent), 1)
+        self.assertEqual(self.protocol._outstanding_acks, {})
+        self.assertEqual(self.dropped(), [REASON_EXPIRED])
+
+    def test_newer_setpoint_supersedes_older(self):
+        self.protocol.set_temperature(THERMOSTAT_ID, 21, 'manual')
+        self.protocol.set_temperature(THERMOSTAT_ID, 19, 'manual')
+        self.backlog = 0
+        self.protocol._dispatch_commands()
+        self.assertEqual([msg.desired_temperature for msg in self.protocol.sent], [19.0])
+        self.assertEqual(self.dropped(), [REASON_SUPERSEDED])
+
+
+class FairQueueingTestCase(unittest.TestCase):
+    SILENT = 0x0B3554
+    HEALTHY = (0x0B3555, 0x0B3556)
+
+    def setUp(self):
+        self.protocol = FakeProtocol(paired_devices=(self.SILENT,) + self.HEALTHY)
+
+    def test_one_command_in_flight_per_device(self):
+        for group_id in (1, 2, 3):
+            self.protocol.set_group_id(self.SILENT, group_id)
+        for device_id in self.HEALTHY:
+            self.protocol.set_group_id(device_id, 4)
+        self.assertEqual(
+            [msg.receiver_id for msg in self.protocol.sent],
+            [self.SILENT] + list(self.HEALTHY))
+
+        for msg in self.protocol.sent[1:]:
+            self.protocol.ack(msg)
+        self.assertEqual(self.protocol.groups, {4: frozenset(self.HEALTHY)})
+
+        for key, (when, attempt, msg) in list(self.protocol._outstanding_acks.items()):
+            self.protocol._outstanding_acks[key] = (when - BACKOFF_INTERVAL, attempt, msg)
+        self.protocol._resend_message()
+        retry = self.protocol.sent[-1]
+        self.assertEqual((retry.receiver_id, retry.new_group_id), (self.SILENT, 1))
+        self.assertEqual(len(self.protocol.sent), 4)
+
+    def test_devices_take_turns(self):
+        for device_id in self.HEALTHY:
+            for group_id in (1, 2):
+                self.protocol.set_group_id(device_id, group_id)
+        while len(self.protocol.sent) < 4:
+            self.protocol.ack(self.protocol.sent[len(self.protocol.finished)])
+        self.assertEqual(
+            [(msg.receiver_id, msg.new_group_id) for msg in self.protocol.sent],
+            [(self.HEALTHY[0], 1), (self.HEALTHY[1], 1),
+             (self.HEALTHY[0], 2), (self.HEALTHY[1], 2)])
+
+
+class MaxConnectionWaiterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.connection = MaxConnection('/dev/null', paired_devices=[THERMOSTAT_ID])
+        self.connection._transport_ready = lambda: True
+        self.connection._transmit = lambda raw_message: None
+
+    def test_expired_while_sending(self):
+        future = self.connection._send_command(
+            SetTemperatureMessage(
+                counter=1, sender_id=0x123456, receiver_id=THERMOSTAT_ID,
+                desired_temperature=21.0, mode='manual'), deadline=0)
+        self.assertFalse(future.result(1))
+        self.assertEqual(self.connection._ack_waiters, {})
+
+    def test_send_failed_while_sending(self):
+        future = self.connection._send_command(
+            SetTemperatureMessage(
+                counter=1, sender_id=0x123456, receiver_id=THERMOSTAT_ID,
+                desired_temperature=21.0, mode='bogus'))
+        self.assertFalse(future.result(1))
+        self.assertEqual(self.connection._ack_waiters, {})
+
+
+class CounterTestCase(unittest.TestCase):
+    def test_counters_wrap_per_device(self):
+        protocol = FakeProtocol()
+        for _ in range(300):
+            protocol.wakeup(THERMOSTAT_ID)
+            protocol.ack(protocol.sent[-1])
+        protocol.wakeup(0x0B3554)
+        self.assertEqual(protocol.sent[-1].counter, 1)
+        self.assertEqual([msg.counter for msg in protocol.sent[254:258]], [255, 0, 1, 2])
+        self.assertTrue(all(len(msg.encode_message()) == 24 for msg in protocol.sent))
+
+    def test_restored_counters_only_move_forward(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store_path = os.path.join(directory, 'maxcul.db')
+            journal_path = os.path.join(directory, 'commands.journal')
+            protocol = FakeProtocol(store_path=store_path, journal_path=journal_path)
+            protocol._start_workers()
+            protocol._counters[THERMOSTAT_ID] = 250
+            held = WakeUpMessage(
+                counter=protocol._next_counter(THERMOSTAT_ID),
+                sender_id=protocol.sender_id, receiver_id=THERMOSTAT_ID)
+            protocol._send_command(held, urgent=False)
+            # wrapped around while the held command waits
+            protocol._counters[THERMOSTAT_ID] = 2
+            protocol.wakeup(THERMOSTAT_ID)
+            protocol.ack(protocol.sent[-1])
+            protocol._stop_workers()
+
+            restarted = FakeProtocol(store_path=store_path, journal_path=journal_path)
+            self.assertEqual(restarted._counters[THERMOSTAT_ID], 3)
+            self.assertEqual(len(restarted._scheduler), 1)
+
+    def test_outstanding_counters_are_skipped(self):
+        protocol = FakeProtocol()
+        protocol.wakeup(THERMOSTAT_ID)
+        self.assertEqual(protocol.sent[0].counter, 1)
+        protocol._counters[THERMOSTAT_ID] = 0
+        self.assertEqual(protocol._next_counter(THERMOSTAT_ID), 2)
+
+    def test_ack_matches_sender_and_counter(self):
+        protocol = FakeProtocol()
+        protocol.wakeup(THERMOSTAT_ID)
+        protocol.wakeup(0x0B3554)
+        self.assertEqual(protocol.sent[0].counter, protocol.sent[1].counter)
+        protocol.ack(protocol.sent[1])
+        self.assertEqual(
+            [msg.receiver_id for _, _, msg in protocol._outstanding_acks.values()],
+            [THERMOSTAT_ID])
+
+    def test_stress_many_devices(self):
+        protocol = FakeProtocol()
+        devices = [0x100000 + index for index in range(300)]
+        for round_number in range(100):
+            for device_id in devices:
+                protocol.set_group_id(device_id, round_number % 5 + 1)
+            for msg in protocol.sent:
+                protocol.ack(msg)
+            protocol.sent = []
+        self.assertEqual(protocol._outstanding_acks, {})
+        self.assertEqual(len(protocol.finished), 30000)
+        self.assertTrue(all(acknowledged for _, acknowledged in protocol.finished))
+        self.assertEqual(set(protocol._counters.values()), {100})
+        self.assertEqual(protocol.groups[5], frozenset(devices))
+
+
+class CommandInboxTestCase(unittest.TestCase):
+    def setUp(self):
+        self.connection = MaxConnection()
+        self.sent = []
+        self.connection._transmit = lambda raw: self.sent.append(MoritzMessage.decode_message(raw))
+        self.connection._transport_ready = lambda: True
+        self.connection._transport_backlog = lambda: 0
+
+    def test_commands_from_many_threads(self):
+        futures = []
+
+        def produce(first_device):
+            for device_id in range(first_device, first_device + 50):
+                futures.append(self.connection.set_group_id(device_id, 1))
+        producers = [threading.Thread(target=produce, args=(0x100000 + index * 100,))
+                     for index in range(4)]
+        for producer in producers:
+            producer.start()
+        for producer in producers:
+            producer.join()
+        self.assertEqual(self.sent, [])
+
+        self.connection._process_inbox()
+        self.assertEqual(len(self.sent), 200)
+        self.assertFalse(any(future.done() for future in futures))
+        for msg in self.sent:
+            self.connection._process_frame(
+                "Z0E%02X0202%06X123456000119000B2C" % (msg.counter, msg.receiver_id))
+        self.assertTrue(all(future.result(0) for future in futures))
+        self.assertEqual(len(self.connection.groups[1]), 200)
+
+    def test_stop_resolves_pending_commands(self):
+        future = self.connection.wakeup(THERMOSTAT_ID)
+        self.connection.stop_requested.set()
+        self.connection.com_thread.stop = lambda timeout=None: None
+        self.connection.join = lambda timeout=None: None
+        self.connection.stop()
+        self.assertFalse(future.result(0))
+
+
+class FastPathTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pairing = False
+        self.responder = FastResponder(0x123456, [THERMOSTAT_ID], lambda: self.pairing)
+
+    def test_ack_matches_regular_ack(self):
+        protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID])
+        raw = []
+        protocol._transmit = raw.append
+        protocol._process_frame(THERMOSTAT_STATE)
+        self.assertEqual(self.responder.respond(THERMOSTAT_STATE), raw[0])
+
+    def test_pong_only_while_pairing(self):
+        self.assertIsNone(self.responder.respond(PAIR_PING))
+        self.pairing = True
+        pong = MoritzMessage.decode_message(self.responder.respond(PAIR_PING))
+        self.assertEqual(pong.__class__.__name__, 'PairPongMessage')
+        self.assertEqual((pong.sender_id, pong.receiver_id), (0x123456, 0xE016C))
+
+    def test_unpaired_devices_are_not_answered(self):
+        self.responder.paired_devices = frozenset()
+        self.assertIsNone(self.responder.respond(THERMOSTAT_STATE))
+
+    def test_io_thread_answers_and_reports(self):
+        io = CulIoThread('/dev/null', 38400, self.responder)
+        written = []
+        io._writeline = written.append
+        io._readline = lambda: THERMOSTAT_STATE
+        io._remaining_budget = 5000
+        io._receive_message()
+        self.assertEqual(written, [self.responder.respond(THERMOSTAT_STATE)])
+        line, answered, trace, thread, read_at = io.read_queue.get_nowait()
+        self.assertEqual((line, answered, trace, thread), (THERMOSTAT_STATE, True, None, io))
+        self.assertLessEqual(read_at, time.monotonic())
+        self.assertEqual(io._remaining_budget, 5000 - len(written[0]) * 10)
+
+    def test_answered_frames_are_not_acknowledged_twice(self):
+        protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID])
+        protocol._process_frame(THERMOSTAT_STATE, answered=True)
+        self.assertEqual(protocol.sent, [])
+        self.assertEqual(protocol.devices.get_state(THERMOSTAT_ID).measured_temperature, 20.2)
@@ -0,0 +1,156 @@
+import os
+import sys
+import multiprocessing
+from multiprocessing import shared_memory
+import subprocess
+import tempfile
+import unittest
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../../')
+
+from maxcul._exceptions import MoritzError
+from maxcul._registry import DeviceState
+from maxcul._sharedstate import SharedStateTable
+from maxcul.test.test_protocol import FakeProtocol, THERMOSTAT_ID, THERMOSTAT_STATE
+
+
+READ_IN_PROCESS = '''
+import sys
+sys.path.insert(0, sys.argv[2])
+from maxcul._sharedstate import SharedStateTable
+table = SharedStateTable.attach(sys.argv[1])
+print(table.get_state(int(sys.argv[3])).valve_position)
+table.close()
+'''
+
+
+def read_in_child(name, device_id, results):
+    table = SharedStateTable.attach(name)
+    try:
+        results.put(table.get_state(device_id))
+    finally:
+        table.close()
+
+
+def consistent_state(value):
+    return DeviceState(
+        THERMOSTAT_ID, group_id=value, valve_position=value, desired_temperature=value,
+        measured_temperature=value, rssi=-value, last_seen=value)
+
+
+def publish_in_child(names, stop):
+    table = SharedStateTable.create(capacity=1)
+    try:
+        table.publish(consistent_state(0))
+        names.put(table.name)
+        value = 0
+        while not stop.is_set():
+            value = (value + 1) % 100
+            table.publish(consistent_state(value))
+    finally:
+        table.close()
+
+
+class SharedStateTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.table = SharedStateTable.create(capacity=2)
+        self.reader = SharedStateTable.attach(self.table.name)
+
+    def tearDown(self):
+        self.reader.close()
+        self.table.close()
+
+    def test_round_trip(self):
+        state = DeviceState(
+            0x0B3554, device_type='ShutterContact', group_id=3, state='open',
+            battery_low=True, rssi=-60.5, last_seen=1500000000.25)
+        self.table.publish(state)
+        self.assertEqual(self.reader.get_state(0x0B3554), state)
+        self.assertIsNone(self.reader.get_state(0x123))
+
+        updated = state._replace(state='close', battery_low=False)
+        self.table.publish(updated)
+        self.assertEqual(self.reader.get_state(0x0B3554), updated)
+        self.assertEqual(len(self.reader), 1)
+
+    def test_capacity(self):
+        self.table.publish(DeviceState(1))
+        self.table.publish(DeviceState(2))
+        self.assertRaises(MoritzError, self.table.publish, DeviceState(3))
+        self.assertEqual(sorted(self.reader.snapshot()), [1, 2])
+
+    def test_protocol_publishes_states(self):
+        protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID], shared_state=self.table)
+        protocol._process_frame(THERMOSTAT_STATE)
+        self.assertEqual(
+            self.reader.get_state(THERMOSTAT_ID)._replace(measured_temperature=20.2),
+            protocol.devices.get_state(THERMOSTAT_ID))
+
+    def test_full_table_does_not_stop_frames(self):
+        self.table.publish(DeviceState(1))
+        self.table.publish(DeviceState(2))
+        protocol = FakeProtocol(paired_devices=[0x035BCC], shared_state=self.table)
+        protocol._process_frame("Z0B370630035BCC12345600102C")
+        protocol._process_frame("Z0B380630035BCC12345600122C")
+        self.assertEqual(
+            [msg.__class__.__name__ for msg in protocol.sent], ['AckMessage', 'AckMessage'])
+        self.assertEqual(len(protocol.events), 2)
+
+    def test_restore_into_full_table(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'maxcul.db')
+            protocol = FakeProtocol(store_path=path, paired_devices=[THERMOSTAT_ID, 1, 2])
+            for device_id in (THERMOSTAT_ID, 1, 2):
+                protocol._update_device(device_id, valve_position=10)
+            protocol._stop_workers()
+            protocol._store.flush()
+            restarted = FakeProtocol(store_path=path, shared_state=self.table)
+            self.assertEqual(len(restarted.devices.snapshot()), 3)
+            self.assertEqual(len(self.table), 2)
+
+    def test_other_process_reads(self):
+        self.table.publish(DeviceState(THERMOSTAT_ID, mode='boost', valve_position=80))
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        child = context.Process(target=read_in_child, args=(self.table.name, THERMOSTAT_ID, results))
+        child.start()
+        state = results.get(timeout=30)
+        child.join()
+        self.assertEqual((state.mode, state.valve_position), ('boost', 80))
+
+    def test_independent_reader_leaves_segment(self):
+        self.table.publish(DeviceState(THERMOSTAT_ID, valve_position=42))
+        for _ in range(2):
+            output = subprocess.check_output(
+                [sys.executable, '-c', READ_IN_PROCESS, self.table.name,
+                 myPath + '/../../', str(THERMOSTAT_ID)],
+                stderr=subprocess.STDOUT)
+            self.assertEqual(output.strip(), b'42')
+        # the readers' resource trackers did not remove the segment
+        reader = SharedStateTable.attach(self.table.name)
+        self.assertEqual(reader.get_state(THERMOSTAT_ID).valve_position, 42)
+        reader.close()
+
+    def test_owner_tolerates_removed_segment(self):
+        table = SharedStateTable.create(capacity=1)
+        other = shared_memory.SharedMemory(table.name)
+        other.unlink()
+        other.close()
+        table.close()
+
+    def test_reader_never_sees_torn_record(self):
+        context = multiprocessing.get_context('spawn')
+        names = context.Queue()
+        stop = context.Event()
+        writer = context.Process(target=publish_in_child, args=(names, stop))
+        writer.start()
+        reader = SharedStateTable.attach(names.get(timeout=30))
+        try:
+            for _ in range(50000):
+                state = reader.get_state(THERMOSTAT_ID)
+                self.assertEqual(state, consistent_state(state.group_id))
+        finally:
+            reader.close()
+            stop.set()
+            writer.join()
@@ -0,0 +1,60 @@
+import math
+import os
+import sys
+import unittest
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../../')
+
+from maxcul._timeseries import TimeSeriesStore, ReadingSeries
+from maxcul.test.test_protocol import FakeProtocol, THERMOSTAT_ID, THERMOSTAT_STATE
+
+
+class ReadingSeriesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.series = ReadingSeries(capacity=5, retention=100)
+        for second in range(7):
+            self.series.append(10.0 * second, 20 + second, 21, second * 10)
+
+    def test_capacity_is_bounded(self):
+        self.assertEqual(len(self.series), 5)
+        self.assertEqual(list(self.series.range().time), [20, 30, 40, 50, 60])
+
+    def test_range(self):
+        readings = self.series.range(25, 50)
+        self.assertEqual(list(readings.time), [30, 40])
+        self.assertEqual(list(readings.measured_temperature), [23, 24])
+        self.assertEqual(list(readings.valve_position), [30, 40])
+        self.assertEqual(list(self.series.range(100).time), [])
+
+    def test_downsample(self):
+        readings = self.series.downsample(20, start=20)
+        self.assertEqual(list(readings.time), [20, 40, 60])
+        self.assertEqual(list(readings.measured_temperature), [22.5, 24.5, 26])
+
+    def test_retention(self):
+        self.series.append(125, 30)
+        self.assertEqual(list(self.series.range().time), [30, 40, 50, 60, 125])
+        self.assertTrue(math.isnan(self.series.range(125).desired_temperature[0]))
+
+    def test_clock_set_back(self):
+        self.series.append(35, 30)
+        self.series.append(70, 31)
+        self.assertEqual(list(self.series.range().time), [40, 50, 60, 60, 70])
+        self.assertEqual(list(self.series.range(60).measured_temperature), [26, 30, 31])
+
+
+class TimeSeriesStoreTestCase(unittest.TestCase):
+    def test_protocol_records_thermostat_readings(self):
+        store = TimeSeriesStore(capacity=16)
+        protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID], timeseries=store)
+        protocol._process_frame(THERMOSTAT_STATE)
+        readings = store.range(THERMOSTAT_ID)
+        self.assertEqual(len(readings.time), 1)
+        self.assertAlmostEqual(readings.measured_temperature[0], 20.2, places=5)
+        self.assertEqual(readings.desired_temperature[0], 16.0)
+        self.assertEqual(readings.valve_position[0], 0)
+        self.assertEqual(store.memory_size, 16 * ReadingSeries.SAMPLE_SIZE)
+
+    def test_unknown_device(self):
+        self.assertEqual(len(TimeSeriesStore().range(0x123).time), 0)
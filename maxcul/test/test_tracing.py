@@ -0,0 +1,68 @@
+import os
+import sys
+import unittest
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../../')
+
+from maxcul._io import CulIoThread
+from maxcul._tracing import Tracer
+from maxcul._const import DIRECTION_RECEIVE, DIRECTION_TRANSMIT
+from maxcul.test.test_protocol import FakeProtocol, THERMOSTAT_ID, THERMOSTAT_STATE
+
+
+class TracingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tracer = Tracer()
+        self.traces = []
+        self.tracer.add_hook(self.record)
+
+    def record(self, trace, stage):
+        if trace not in self.traces:
+            self.traces.append(trace)
+
+    def stages(self, trace):
+        return [stage for stage, _ in trace.stages]
+
+    def test_no_trace_without_hooks(self):
+        self.tracer.remove_hook(self.record)
+        self.assertIsNone(self.tracer.start(DIRECTION_RECEIVE, THERMOSTAT_STATE))
+        protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID], tracer=self.tracer)
+        protocol._process_frame(THERMOSTAT_STATE)
+        self.assertEqual(self.traces, [])
+
+    def test_received_frame(self):
+        io = CulIoThread('/dev/null', 38400, tracer=self.tracer)
+        io._readline = lambda: THERMOSTAT_STATE
+        io._receive_message()
+        line, answered, trace, _, _ = io.read_queue.get_nowait()
+        protocol = FakeProtocol(paired_devices=[THERMOSTAT_ID], tracer=self.tracer)
+        protocol._process_frame(line, answered, trace)
+        self.assertEqual(self.stages(trace), [
+            'read', 'framed', 'enqueued', 'dequeued', 'decoded', 'callback', 'handled'])
+        timestamps = [timestamp for _, timestamp in trace.stages]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertEqual([stage for stage, _ in trace.breakdown()], self.stages(trace))
+        # the ACK sent while handling is traced as well
+        self.assertEqual(self.traces[1].direction, DIRECTION_TRANSMIT)
+        self.assertEqual(self.stages(self.traces[1]), ['encoded', 'queued'])
+
+    def test_transmitted_command(self):
+        protocol = FakeProtocol(tracer=self.tracer)
+        protocol.set_temperature(THERMOSTAT_ID, 21, 'manual')
+        trace = self.traces[0]
+        self.assertEqual(trace.frame.counter, protocol.sent[0].counter)
+        protocol.ack(protocol.sent[0])
+        self.assertEqual(self.stages(trace), ['created', 'encoded', 'queued', 'acknowledged'])
+        self.assertGreaterEqual(trace.timestamp('acknowledged'), trace.timestamp('created'))
+
+    def test_written_by_io_thread(self):
+        io = CulIoThread('/dev/null', 38400, tracer=self.tracer)
+        written = []
+        io._writeline = written.append
+        io._remaining_budget = 5000
+        trace = self.tracer.start(DIRECTION_TRANSMIT, None)
+        io.enqueue_command("Zs0B", trace)
+        io._send_pending_message()
+        self.assertEqual(written, ["Zs0B"])
+        self.assertEqual(self.stages(trace), ['written'])
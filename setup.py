@@ -44,6 +44,9 @@ setup(
     tests_require=['pytest>=3.0.5'],
     install_requires=['pyserial>=3.1.1'],
     cmdclass={'test': PyTest},
+    entry_points={
+        'console_scripts': ['maxcul = maxcul._daemon:main'],
+    },
     author_email='github@maufl.de',
     description='Talk to eq-3 MAX! devices using a CUL stick',
     long_description=long_description,
@@ -64,5 +67,6 @@ setup(
     ],
     extras_require={
         'testing': ['pytest'],
+        'numpy': ['numpy'],
     }
 )